@@ -0,0 +1,166 @@
+import os
+import selectors
+import socket
+import time
+
+import outbound_queue
+
+"""Largest request accepted; admin requests are one line plus a few HTTP headers"""
+MAX_REQUEST_LENGTH = 8 * 1024
+"""A reply the peer has not read within this long is dropped"""
+SEND_TIMEOUT = 1.0
+
+
+def parse_address(address):
+    """'host:port' for TCP, anything else is a Unix socket path"""
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+    return socket.AF_UNIX, address
+
+
+def worker_address(address, worker_id):
+    """Each --workers worker listens on its own endpoint: the port plus the worker id, or the path
+    with the worker id appended"""
+    family, parsed = parse_address(address)
+    if family == socket.AF_INET:
+        return f'{parsed[0]}:{parsed[1] + worker_id}'
+
+    return f'{address}.{worker_id}'
+
+
+class AdminEndpoint:
+    """Local admin listener served from the server's own selector.
+
+    A request is either a plain line naming a route (`echo metrics | nc -U admin.sock`) or an HTTP GET
+    (`curl localhost:9100/metrics`, or a Prometheus scrape). routes maps a path such as '/metrics' to
+    a function returning the response text. A reply is written like any client's outbound queue:
+    what the socket does not take at once waits for write readiness, so a large /metrics reply to a
+    slow scraper never blocks the event loop. The socket is closed once the reply is written.
+    """
+
+    def __init__(self, address, selector, routes):
+        self.family, self.address = parse_address(address)
+        self.selector = selector
+        self.routes = routes
+        self.requests = {}
+        self.replies = {}
+
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+
+        self.listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        self.listener.bind(self.address)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self)
+
+    def handle_event(self, fileobj):
+        if fileobj is self.listener:
+            self.accept()
+        elif fileobj in self.replies:
+            self.flush_reply(fileobj)
+        else:
+            self.handle_readable(fileobj)
+
+    def accept(self):
+        self.drop_stalled_replies()
+
+        while True:
+            try:
+                request_socket, _ = self.listener.accept()
+            except BlockingIOError:
+                return
+
+            request_socket.setblocking(False)
+            self.requests[request_socket] = bytearray()
+            self.selector.register(request_socket, selectors.EVENT_READ, self)
+
+    def handle_readable(self, request_socket):
+        try:
+            data = request_socket.recv(MAX_REQUEST_LENGTH)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        buffer = self.requests[request_socket]
+        buffer += data
+
+        if not data or len(buffer) > MAX_REQUEST_LENGTH:
+            self.close_request(request_socket)
+            return
+
+        line, newline, _ = bytes(buffer).partition(b'\n')
+        words = line.decode('utf-8', errors='replace').split()
+
+        if not newline:
+            return
+
+        http = len(words) == 3 and words[2].startswith('HTTP/')
+        if http and b'\n\r\n' not in buffer and b'\n\n' not in buffer:
+            """Wait for the end of the headers so nothing is left unread when the socket closes"""
+            return
+
+        path = words[1] if http else ('/' + words[0].lstrip('/') if words else '/')
+        self.respond(request_socket, path.split('?')[0], http)
+
+    def respond(self, request_socket, path, http):
+        route = self.routes.get(path)
+
+        if route is None:
+            status, body = '404 Not Found', f'unknown admin path {path}; try one of {", ".join(sorted(self.routes))}\n'
+        else:
+            status, body = '200 OK', route()
+
+        body = body.encode('utf-8')
+        if http:
+            body = (f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                    f'Content-Length: {len(body)}\r\n\r\n').encode('utf-8') + body
+
+        reply = outbound_queue.OutboundQueue(len(body))
+        reply.push(body)
+        self.replies[request_socket] = (reply, time.monotonic() + SEND_TIMEOUT)
+        self.selector.modify(request_socket, selectors.EVENT_WRITE, self)
+        self.flush_reply(request_socket)
+
+    def flush_reply(self, request_socket):
+        reply, _ = self.replies[request_socket]
+
+        try:
+            reply.flush_to(request_socket)
+            if reply:
+                return
+
+            request_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+        self.close_request(request_socket)
+
+    def drop_stalled_replies(self):
+        """Checked whenever a request arrives, which is all a peer that stopped reading can hold up"""
+        now = time.monotonic()
+        for request_socket, (_, deadline) in list(self.replies.items()):
+            if now >= deadline:
+                self.close_request(request_socket)
+
+    def close_request(self, request_socket):
+        del self.requests[request_socket]
+        self.replies.pop(request_socket, None)
+        self.selector.unregister(request_socket)
+        request_socket.close()
+
+    def close(self):
+        for request_socket in list(self.requests):
+            self.close_request(request_socket)
+
+        self.selector.unregister(self.listener)
+        self.listener.close()
+
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
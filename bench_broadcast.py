@@ -0,0 +1,112 @@
+"""Microbenchmark: allocations and time per broadcast, per-recipient encoding vs encode-once.
+
+Recipients are stand-in sockets whose send buffer is always full, so every frame stays referenced
+from the recipient's outbound queue and tracemalloc sees exactly what one broadcast leaves behind.
+
+    python3 bench_broadcast.py [--recipients 10 100 1000] [--broadcasts 200]
+"""
+import argparse
+import errno
+import time
+import tracemalloc
+
+import chat_server
+import protocol
+
+
+class BlockedSocket:
+    """Recipient whose kernel buffer is full: every send would block"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def send(self, data):
+        raise BlockingIOError(errno.EAGAIN, 'would block')
+
+    def sendmsg(self, buffers):
+        raise BlockingIOError(errno.EAGAIN, 'would block')
+
+    def close(self):
+        pass
+
+
+def per_recipient_broadcast(server, read_socket, message):
+    """The previous fan-out: the frame is rebuilt for every recipient"""
+    for connection in server.usernames.values():
+        if connection.socket != read_socket:
+            sender = server.connections[read_socket]
+            server.send_frame(connection.socket, protocol.encode_frame(sender.username) + message['header'] + message['data'])
+
+
+def build_room(server, recipients):
+    """Fills the server with fake clients that are never registered with the selector"""
+    server.connections.clear()
+    server.usernames.clear()
+    server.rooms.clear()
+
+    sockets = [BlockedSocket(1000000 + i) for i in range(recipients + 1)]
+    for number, client_socket in enumerate(sockets):
+        username = f'user{number}'.encode('utf-8')
+        connection = server.connections[client_socket] = chat_server.Connection(
+            client_socket, None, server.high_water_mark, receive_chunk=server.receive_chunk
+        )
+        connection.username = username
+        server.usernames[username] = connection
+        server.join_room(connection, chat_server.DEFAULT_ROOM)
+
+    return sockets[0]
+
+
+def measure(server, broadcast, recipients, broadcasts, message):
+    sender = build_room(server, recipients)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    for _ in range(broadcasts):
+        broadcast(server, sender, message)
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    sender = build_room(server, recipients)
+    started = time.perf_counter()
+
+    for _ in range(broadcasts):
+        broadcast(server, sender, message)
+
+    elapsed = time.perf_counter() - started
+    return blocks / broadcasts, size / broadcasts, elapsed / broadcasts * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-broadcast')
+    parser.add_argument('--recipients', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--broadcasts', type=int, default=200)
+    parser.add_argument('--message-size', type=int, default=64)
+    args = parser.parse_args()
+
+    server = chat_server.Server('127.0.0.1', 0, high_water_mark=1 << 30)
+    message = {'header': protocol.encode_frame(b'x' * args.message_size)[:protocol.HEADER_LENGTH],
+               'data': b'x' * args.message_size}
+    strategies = [
+        ('per-recipient', per_recipient_broadcast),
+        ('encode-once', chat_server.Server.broadcast_messages),
+    ]
+
+    print(f'{"strategy":<15}{"recipients":>12}{"allocs/bcast":>15}{"bytes/bcast":>15}{"us/bcast":>12}')
+    for recipients in args.recipients:
+        for name, broadcast in strategies:
+            blocks, size, micros = measure(server, broadcast, recipients, args.broadcasts, message)
+            print(f'{name:<15}{recipients:>12}{blocks:>15.1f}{size:>15.0f}{micros:>12.1f}')
+
+    server.close()
+
+
+if __name__ == '__main__':
+    main()
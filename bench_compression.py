@@ -0,0 +1,124 @@
+"""Benchmark: wire bytes and CPU of negotiated compression on chat-like corpora.
+
+Each corpus is a list of messages as they would be typed or pasted into a room:
+    chatter  short conversational lines, nearly all under the compression threshold
+    logs     pasted application log excerpts
+    code     pasted source snippets, taken from this repository's own .py files
+    json     pasted API responses
+
+For every corpus and zlib level it reports the share of messages compressed, wire bytes as a
+percentage of the raw payload, and compress/decompress time per message. Compress time is what the
+server spends per broadcast, since it compresses once; per-recip shows what compressing for each of
+--recipients v2 clients would cost instead, and the last column the bytes saved per broadcast.
+
+    python3 bench_compression.py [--recipients 100] [--levels 1 6 9] [--threshold 512]
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+import protocol
+
+WORDS = ('ok', 'yeah', 'lol', 'anyone', 'seen', 'the', 'deploy', 'is', 'it', 'down', 'again', 'brb', 'thanks',
+         'can', 'you', 'check', 'logs', 'meeting', 'in', 'five', 'minutes', 'sure', 'nice', 'works', 'for', 'me')
+LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARN', 'ERROR')
+MODULES = ('chat_server', 'db_pool', 'worker_bus', 'history_store', 'server_socket')
+
+
+def chatter_corpus(rng, count):
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 14))).encode('utf-8') for _ in range(count)]
+
+
+def logs_corpus(rng, count):
+    messages = []
+    for _ in range(count):
+        lines = []
+        for line in range(rng.randint(5, 60)):
+            lines.append(f'2024-03-{rng.randint(1, 28):02d} 12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} | '
+                         f'{rng.choice(LEVELS):<5} | {rng.choice(MODULES):20}: handled request {rng.randint(1, 10 ** 6)} '
+                         f'in {rng.randint(1, 900)}ms from 10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}')
+        messages.append('\n'.join(lines).encode('utf-8'))
+    return messages
+
+
+def code_corpus(rng, count):
+    lines = []
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(path, encoding='utf-8') as source:
+            lines.extend(source.read().splitlines())
+
+    messages = []
+    for _ in range(count):
+        start = rng.randrange(len(lines))
+        messages.append('\n'.join(lines[start:start + rng.randint(5, 80)]).encode('utf-8'))
+    return messages
+
+
+def json_corpus(rng, count):
+    messages = []
+    for _ in range(count):
+        users = [{'id': rng.randint(1, 10 ** 6), 'name': ''.join(rng.choice('abcdefghij') for _ in range(8)),
+                  'online': rng.random() < 0.5, 'rooms': [f'room{rng.randint(1, 50)}' for _ in range(rng.randint(0, 4))]}
+                 for _ in range(rng.randint(2, 40))]
+        messages.append(json.dumps({'status': 'ok', 'users': users}, indent=2).encode('utf-8'))
+    return messages
+
+
+CORPORA = {'chatter': chatter_corpus, 'logs': logs_corpus, 'code': code_corpus, 'json': json_corpus}
+
+
+def measure(messages, threshold, level, recipients):
+    raw = sum(len(message) for message in messages)
+    wire = 0
+    compressed = 0
+    payloads = []
+
+    start = time.perf_counter()
+    for message in messages:
+        payload, flags = protocol.compress_payload(message, threshold, level)
+        payloads.append((payload, flags))
+        wire += len(payload)
+        compressed += bool(flags)
+    compress_time = (time.perf_counter() - start) / len(messages)
+
+    start = time.perf_counter()
+    for payload, flags in payloads:
+        if flags:
+            protocol.decompress_payload(payload)
+    decompress_time = (time.perf_counter() - start) / len(messages)
+
+    return {
+        'compressed': compressed / len(messages) * 100,
+        'wire': wire / raw * 100,
+        'compress_us': compress_time * 1e6,
+        'decompress_us': decompress_time * 1e6,
+        'per_recipient_us': compress_time * recipients * 1e6,
+        'saved_kb': (raw - wire) * recipients / len(messages) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-compression')
+    parser.add_argument('--messages', type=int, default=500, help='messages per corpus')
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--levels', nargs='+', type=int, default=[1, 6, 9])
+    parser.add_argument('--threshold', type=int, default=protocol.DEFAULT_COMPRESSION_THRESHOLD)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f'{"corpus":<9}{"level":>6}{"compressed%":>13}{"wire%":>8}{"comp us":>9}{"decomp us":>11}'
+          f'{"per-recip us":>14}{"saved KiB/bcast":>17}')
+    for name, corpus in CORPORA.items():
+        messages = corpus(random.Random(args.seed), args.messages)
+        for level in args.levels:
+            result = measure(messages, args.threshold, level, args.recipients)
+            print(f'{name:<9}{level:>6}{result["compressed"]:>13.0f}{result["wire"]:>8.1f}{result["compress_us"]:>9.1f}'
+                  f'{result["decompress_us"]:>11.1f}{result["per_recipient_us"]:>14.0f}'
+                  f'{result["saved_kb"]:>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Soak benchmark: server memory held per idle logged in connection.
+
+Starts chat_server on loopback, logs in --connections v1 clients that then sit idle, and reports how
+much the server's resident set grew per connection. Clients are v1 because v2 clients are sent a
+USER_JOINED delta for every later login, which is a fan-out cost rather than the cost of holding a
+user. Timeouts are off so nothing is dropped however long the soak runs.
+
+Both processes raise their open file limit to the hard limit, which must allow --connections plus a
+little headroom. Clients connect from several 127.0.0.x addresses, so more connections can be opened
+than one address has ephemeral ports.
+
+    python3 bench_idle.py [--connections 50000] [--hold 10]
+"""
+import argparse
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_suite
+import protocol
+
+CONNECTIONS_PER_ADDRESS = 20000
+"""Linux: leaves the port to connect(), so ports still in TIME_WAIT from an earlier run are not refused"""
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, 'IP_BIND_ADDRESS_NO_PORT', 24)
+"""Below the listen backlog, so no SYN is dropped and retried a second later"""
+BATCH = 100
+
+
+def rss_bytes(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+    raise RuntimeError('no VmRSS in /proc status')
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def receive_frame(client):
+    header = b''
+    while len(header) < protocol.HEADER_LENGTH:
+        chunk = client.recv(protocol.HEADER_LENGTH - len(header))
+        if not chunk:
+            raise ConnectionError('server closed a connection during login')
+        header += chunk
+
+    length = int(header)
+    data = b''
+    while len(data) < length:
+        data += client.recv(length - len(data))
+
+    return data
+
+
+def open_clients(port, count, nonce):
+    """Logs in count clients, a batch at a time so the listen backlog never overflows"""
+    clients = []
+
+    for start in range(0, count, BATCH):
+        batch = []
+        for number in range(start, min(start + BATCH, count)):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            client.bind((f'127.0.0.{2 + number // CONNECTIONS_PER_ADDRESS}', 0))
+            client.connect(('127.0.0.1', port))
+            client.sendall(protocol.encode_frame(f'idle{nonce}_{number}'.encode('utf-8')))
+            batch.append(client)
+
+        for client in batch:
+            receive_frame(client)
+
+        clients.extend(batch)
+
+    return clients
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-idle')
+    parser.add_argument('--connections', type=int, default=50000)
+    parser.add_argument('--hold', type=float, default=5.0, help='seconds to stay idle before measuring')
+    args = parser.parse_args()
+
+    limit = raise_file_limit()
+    if limit < args.connections + 100:
+        parser.error(f'the open file limit is {limit}; raise the hard limit (ulimit -Hn) to run {args.connections} connections')
+
+    port = bench_suite.free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen(
+            [sys.executable, bench_suite.SERVER, '127.0.0.1', str(port), '--log-mode', 'queue', '--log-rate', '1',
+             '--storage', 'memory', '--handshake-timeout', '0', '--idle-timeout', '0', '--max-accepts', '0'],
+            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(bench_suite.SERVER))
+        )
+        clients = []
+
+        try:
+            bench_suite.wait_for_port(port, server)
+            time.sleep(1)
+            before = rss_bytes(server.pid)
+
+            started = time.monotonic()
+            clients = open_clients(port, args.connections, os.getpid())
+            opened = time.monotonic() - started
+
+            time.sleep(args.hold)
+            after = rss_bytes(server.pid)
+
+            print(f'{"connections":>12}{"login s":>10}{"RSS before MiB":>16}{"RSS after MiB":>15}{"bytes/conn":>12}')
+            print(f'{len(clients):>12}{opened:>10.1f}{before / 2 ** 20:>16.1f}{after / 2 ** 20:>15.1f}'
+                  f'{(after - before) / len(clients):>12.0f}')
+        finally:
+            """The server goes first, so TIME_WAIT lands on its side and not on the clients' ports"""
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+            for client in clients:
+                client.close()
+
+
+if __name__ == '__main__':
+    main()
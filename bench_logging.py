@@ -0,0 +1,56 @@
+"""Microbenchmark: cost of the per-message log line to the event loop, by logging mode.
+
+Times Server.log_message as the loop calls it for every chat message. The stream handler is raised
+to WARNING so the terminal is not flooded; the file handler still writes every emitted record.
+
+    python3 bench_logging.py [--messages 20000]
+"""
+import argparse
+import logging
+import time
+
+import chat_server
+
+
+MODES = [
+    ('off', {}),
+    ('sync', {}),
+    ('queue', {'queued_logging': True}),
+    ('queue, 1 in 10', {'queued_logging': True, 'log_sample_every': 10}),
+    ('queue, 100/s', {'queued_logging': True, 'log_max_per_second': 100}),
+]
+
+
+def measure(name, options, messages, data):
+    server = chat_server.Server('127.0.0.1', 0, **options)
+    server.instantiated_logger.stream_handler.setLevel(logging.WARNING)
+    if name == 'off':
+        server.instantiated_logger.logger.setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        server.log_message(b'bench_user', data)
+    elapsed = time.perf_counter() - start
+
+    """Includes draining the queue, to show what the listener thread still had to do"""
+    server.close()
+    drained = time.perf_counter() - start
+    server.instantiated_logger.logger.setLevel(logging.DEBUG)
+    return elapsed / messages * 1e6, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-logging')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--message-size', type=int, default=64)
+    args = parser.parse_args()
+    data = b'x' * args.message_size
+
+    print(f'{"mode":<18}{"us/message":>12}{"s until written":>18}')
+    for name, options in MODES:
+        micros, drained = measure(name, options, args.messages, data)
+        print(f'{name:<18}{micros:>12.2f}{drained:>18.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark: latency of each storage engine applying write-behind username batches.
+
+Every round persists one batch of logins and then the matching batch of logouts, as
+UsernameRegistry would hand them to the database pool. Postgres is skipped if it cannot be reached.
+The SQLite file is created in a scratch directory.
+
+    python3 bench_storage.py [--rounds 200] [--batch-sizes 1 10 100] [--engines memory sqlite]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import storage
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def measure(engine, rounds, batch_size):
+    connection = engine.connect()
+    samples = []
+
+    try:
+        for round_number in range(rounds):
+            names = [f'user{round_number}_{i}' for i in range(batch_size)]
+            for inserts, deletes in ((names, []), ([], names)):
+                start = time.perf_counter()
+                engine.persist_usernames(connection, inserts, deletes)
+                samples.append(time.perf_counter() - start)
+    finally:
+        connection.close()
+
+    return {
+        'p50_us': percentile(samples, 0.5) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'per_username_us': sum(samples) / (len(samples) * batch_size) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-storage')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--engines', nargs='+', choices=storage.ENGINES, default=list(storage.ENGINES))
+    args = parser.parse_args()
+
+    print(f'{"engine":<10}{"batch":>7}{"p50 us":>10}{"p99 us":>10}{"us/username":>13}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.engines:
+            try:
+                engine = storage.create(name, os.path.join(directory, 'bench.db'))
+                engine.prepare()
+            except Exception as e:
+                print(f'{name:<10} skipped: {e}')
+                continue
+
+            for batch_size in args.batch_sizes:
+                result = measure(engine, args.rounds, batch_size)
+                print(f'{name:<10}{batch_size:>7}{result["p50_us"]:>10.1f}{result["p99_us"]:>10.1f}'
+                      f'{result["per_username_us"]:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
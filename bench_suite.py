@@ -0,0 +1,112 @@
+"""Benchmark suite: starts chat_server on loopback for each scenario, drives it with load_generator
+and prints one line of results per scenario. Settings are fixed per scenario so runs before and
+after a change are comparable; save them with --output and compare with --baseline.
+
+The server runs in a scratch directory, so its logs and history never mix with earlier runs, and
+with the in-process storage engine, so no database service is needed.
+
+    python3 bench_suite.py [--scenarios fanout-100 rooms-2000] [--output after.json] [--baseline before.json]
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import load_generator
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_server.py')
+
+"""name: (server arguments, load generator settings)"""
+SCENARIOS = {
+    'fanout-100': ([], {'connections': 100, 'rooms': 1, 'rate': 200}),
+    'rooms-2000': ([], {'connections': 2000, 'rooms': 100, 'rate': 2000, 'processes': 2}),
+    'large-messages': ([], {'connections': 200, 'rooms': 10, 'rate': 500, 'message_size': 4096}),
+    'coalesced-flush': (['--flush-delay', '1'], {'connections': 2000, 'rooms': 100, 'rate': 2000, 'processes': 2}),
+    'workers-4': (['--workers', '4'], {'connections': 4000, 'rooms': 200, 'rate': 4000, 'processes': 4}),
+}
+REPORTED = ('ready', 'errors', 'sent_per_second', 'delivered_per_second', 'p50_ms', 'p99_ms', 'p999_ms')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'chat_server exited with status {process.returncode}')
+
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError('chat_server did not start listening')
+
+
+def run_scenario(server_args, settings, duration, warmup):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen(
+            [sys.executable, SERVER, '127.0.0.1', str(port), '--log-mode', 'queue', '--storage', 'memory',
+             *server_args],
+            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.path.dirname(SERVER), os.environ.get('PYTHONPATH')))))
+        )
+        try:
+            wait_for_port(port, server)
+            return load_generator.run(('127.0.0.1', port), duration=duration, warmup=warmup, **settings)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench-suite')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--duration', default=10.0, type=float)
+    parser.add_argument('--warmup', default=2.0, type=float)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    load_generator.raise_open_file_limit()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print(f'{"scenario":<18}' + ''.join(f'{column:>18}' for column in REPORTED))
+    results = {}
+    for name in args.scenarios:
+        server_args, settings = SCENARIOS[name]
+        results[name] = run_scenario(server_args, settings, args.duration, args.warmup)
+        cells = []
+        for column in REPORTED:
+            cell = f'{results[name][column]:.1f}'
+            if name in baseline:
+                before = baseline[name][column]
+                cell += f' ({(results[name][column] - before) / before * 100:+.0f}%)' if before else ' (n/a)'
+            cells.append(f'{cell:>18}')
+        print(f'{name:<18}' + ''.join(cells))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,45 @@
-import socket
-import errno
-import sys
 import argparse
-import threading
+import collections
 import logger
+import client_core
 import tkinter as tk
 
 
+DEFAULT_SCROLLBACK = 1000
+DRAIN_INTERVAL_MS = 50
+MAX_BATCH_LINES = 2000
+
+
 class Client:
-    def __init__(self, IP, PORT):
+    """tkinter window on top of client_core.ChatClient, which does all the networking.
+
+    Callbacks run on the client core's I/O thread and never touch tkinter: they append lines to a
+    hand-off deque that the main thread drains every DRAIN_INTERVAL_MS, inserting each batch with a
+    single insert so the Text widget redraws once per batch rather than once per message. Only the
+    last scrollback lines are kept.
+    """
+
+    def __init__(self, IP, PORT, scrollback=DEFAULT_SCROLLBACK, version=1):
         self.IP = IP
         self.PORT = PORT
         self.my_username = None
-        self.HEADER_LENGTH = 16
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.instantiated_logger = logger.Logger(__name__)
         self.instantiated_logger.initialise_logging()
-        self.username_taken_message = 'Username already taken - please enter another'
-        self.username_accepted_message = 'Username assigned to you'
+        self.username_taken_message = client_core.USERNAME_TAKEN_MESSAGE
+        self.username_accepted_message = client_core.USERNAME_ACCEPTED_MESSAGE
         self.server_disconnected_message = 'Server disconnected - please try reconnecting. sorry :('
         self.client_closed = False
         self.chat_bot_name = 'chatbot'
+        self.scrollback = scrollback
+        self.incoming = collections.deque()
+        self.connection = client_core.ChatClient(
+            IP, PORT,
+            on_message=self.show_message,
+            on_username_accepted=self.username_accepted,
+            on_username_rejected=self.username_rejected,
+            on_disconnect=self.server_disconnected,
+            version=version
+        )
 
         """initialise tkinter gui"""
         self.window = tk.Tk()
@@ -32,126 +51,81 @@ class Client:
         self.msg_list.pack(side=tk.LEFT, fill=tk.BOTH)
         self.messages_frame.pack()
         self.entry_field = tk.Entry(self.window, textvariable=self.my_msg)
-        self.entry_field.bind('<Return>', self.send_username_thread)
+        self.entry_field.bind('<Return>', self.send)
         self.entry_field.pack()
-        self.send_button = tk.Button(self.window, text='Send', command=self.send_username_thread)
+        self.send_button = tk.Button(self.window, text='Send', command=self.send)
         self.send_button.pack()
         self.window.protocol('WM_DELETE_WINDOW', self.close_window)
-        self.send_pressed = False
+        self.window.after(DRAIN_INTERVAL_MS, self.drain_incoming)
+
+    def display(self, line):
+        """Safe from any thread: deque.append is atomic"""
+        self.incoming.append(line)
+
+    def drain_incoming(self):
+        lines = []
+        while self.incoming and len(lines) < MAX_BATCH_LINES:
+            lines.append(self.incoming.popleft())
 
-    def send_username_thread(self, event=None):
-        thread = threading.Thread(target=self.send_username)
-        thread.daemon = True
-        thread.start()
+        if lines:
+            """Only follow new lines if the user has not scrolled up"""
+            at_bottom = self.msg_list.yview()[1] >= 1.0
+            self.msg_list.insert(tk.END, ''.join(lines))
+            self.trim_scrollback()
 
-    def receive_message_thread(self, event=None):
-        receive_thread = threading.Thread(target=client.receive_message)
-        receive_thread.daemon = True
-        receive_thread.start()
+            if at_bottom:
+                self.msg_list.see(tk.END)
 
-    def send_message_thread(self, event=None):
-        send_thread = threading.Thread(target=client.send_message)
-        send_thread.daemon = True
-        send_thread.start()
+        if not self.client_closed:
+            self.window.after(DRAIN_INTERVAL_MS, self.drain_incoming)
+
+    def trim_scrollback(self):
+        line_count = int(self.msg_list.index('end-1c').split('.')[0])
+
+        if line_count > self.scrollback:
+            self.msg_list.delete('1.0', f'{line_count - self.scrollback}.0')
+
+    def connect(self):
+        self.connection.connect()
+        self.connection.start()
 
     def close_window(self, event=None):
         self.client_closed = True
-        self.client_socket.close()
+        self.connection.close()
         self.window.quit()
 
-    def send_username(self):
-        username = self.my_msg.get()
-        while username and self.my_username is None:
-            try:
-                encoded_username = username.encode('utf-8')
-                username_header = f'{len(encoded_username):<{self.HEADER_LENGTH}}'.encode('utf-8')
-                self.client_socket.send(username_header + encoded_username)
-                response_header = self.client_socket.recv(self.HEADER_LENGTH)
-
-                if not len(response_header):
-                    sys.exit()
-
-                response_length = int(response_header.decode('utf-8').strip())
-                response_message = self.client_socket.recv(response_length).decode('utf-8').strip()
-
-                if response_message == self.username_taken_message:
-                    self.msg_list.insert(tk.END, self.username_taken_message + '\n')
-                elif response_message == self.username_accepted_message:
-                    self.msg_list.insert(tk.END, self.username_accepted_message + '\n')
-                    self.my_username = encoded_username.decode('utf-8')
-                    self.send_button.configure(text='Send', command=self.send_message_thread)
-                    self.entry_field.bind('<Return>', self.send_message_thread)
-                    self.receive_message_thread()
-                else:
-                    self.msg_list.insert(
-                        tk.END, f'{self.chat_bot_name} > Error: {response_message} re-enter username please + \n'
-                    )
-
-                self.my_msg.set('')
-                return
-
-            except IOError as e:
-                """When there is no incoming data, error is going to be raised. Some operating systems will 
-                indicate using EGAIN, some EWOULDBLOCK.We check for both - if one of them - that's
-                expected, means no incoming data, continue as normal. If we got different error code - something 
-                happened"""
-                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                    self.msg_list.insert(tk.END, f'{self.chat_bot_name} > Error -  {str(e)} \n')
-                    sys.exit()
-
-                """Did not receive anything"""
-                continue
-
-            except Exception as e:
-                """ Any other exception - something happened. Exit"""
-                self.msg_list.insert(tk.END, f'{self.chat_bot_name} >  Error: {str(e)} \n')
-                sys.exit()
-
-    def send_message(self):
-        message = self.my_msg.get()
-        self.msg_list.insert(tk.END, f'{self.my_username} > {message} \n')
+    def send(self, event=None):
+        """Hands the entry to the client core, which sends it from its I/O loop"""
+        text = self.my_msg.get()
         self.my_msg.set('')
-        if message:
-            message = message.encode('utf-8')
-            message_header = f'{len(message):<{self.HEADER_LENGTH}}'.encode('utf-8')
-            self.client_socket.send(message_header + message)
-        return
-
-    def receive_message(self):
-        while True:
-            if not self.client_closed and self.my_username:
-                try:
-                    username_header = self.client_socket.recv(self.HEADER_LENGTH)
-                    if not len(username_header):
-                        self.msg_list.insert(tk.END, f'{self.chat_bot_name} > {self.server_disconnected_message} \n')
-                        sys.exit()
-
-                    username_length = int(username_header.decode('utf-8').strip())
-                    sender_username = self.client_socket.recv(username_length).decode('utf-8').strip()
-                    message_header = self.client_socket.recv(self.HEADER_LENGTH)
-                    message_length = int(message_header.decode('utf-8').strip())
-                    message = self.client_socket.recv(message_length).decode('utf-8')
-                    self.msg_list.insert(tk.END, f'{sender_username} > {message} \n')
-
-                except IOError as e:
-                    """When there is no incoming data, error is going to be raised. Some operating systems will 
-                    indicate using EGAIN, some EWOULDBLOCK.We check for both - if one of them - that's
-                    expected, means no incoming data, continue as normal. If we got different error code - something 
-                    happened"""
-                    if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                        self.instantiated_logger.logger.info('Reading error: {}'.format(str(e)))
-
-                    """Client did not receive anything"""
-                    continue
-
-                except Exception as e:
-                    """Something happened. Exit"""
-                    self.msg_list.insert(tk.END, f'{self.chat_bot_name} > {self.server_disconnected_message} \n')
-                    self.instantiated_logger.logger.info('Reading error: {}'.format(str(e)))
-                    sys.exit()
-
-            if self.client_closed:
-                return
+
+        if not text:
+            return
+
+        if self.my_username is None:
+            self.connection.send_username(text)
+            return
+
+        self.display(f'{self.my_username} > {text} \n')
+        self.connection.send_message(text)
+
+    def username_accepted(self, username):
+        self.my_username = username
+        self.display(self.username_accepted_message + '\n')
+
+    def username_rejected(self, reason):
+        if reason == self.username_taken_message:
+            self.display(self.username_taken_message + '\n')
+        else:
+            self.display(f'{self.chat_bot_name} > Error: {reason} re-enter username please + \n')
+
+    def show_message(self, sender, message):
+        self.display(f'{sender} > {message} \n')
+
+    def server_disconnected(self):
+        if not self.client_closed:
+            self.instantiated_logger.logger.info('Server disconnected')
+            self.display(f'{self.chat_bot_name} > {self.server_disconnected_message} \n')
 
 
 parser = argparse.ArgumentParser(
@@ -172,24 +146,32 @@ parser.add_argument(
     nargs='?',
     default=1234,
     metavar='Port',
-    type=str,
+    type=int,
     help='the port of the client socket')
 
-args = parser.parse_args()
-client = Client(args.IP, args.PORT)
-client.client_socket.connect((client.IP, client.PORT))
-
-
-client.msg_list.insert(
-    tk.END, f'{client.chat_bot_name} > Please enter your username \n'
-)
-
-tk.mainloop()
-
+parser.add_argument(
+    '--scrollback',
+    default=DEFAULT_SCROLLBACK,
+    type=int,
+    help='number of lines kept in the chat window')
 
+parser.add_argument(
+    '--protocol',
+    default=1,
+    choices=(1, 2),
+    type=int,
+    help='protocol version to speak; 2 is binary and has the server compress large messages')
 
 
+def main():
+    args = parser.parse_args()
+    client = Client(args.IP, args.PORT, args.scrollback, args.protocol)
+    client.connect()
 
+    client.display(f'{client.chat_bot_name} > Please enter your username \n')
 
+    tk.mainloop()
 
 
+if __name__ == '__main__':
+    main()
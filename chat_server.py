@@ -1,103 +1,1322 @@
 import server_socket
+import protocol
+import outbound_queue
+import worker_bus
+import username_registry
+import db_pool
+import history_store
+import admin_endpoint
+import metrics
+import timer_wheel
+import handoff
+import storage
+import rate_limit
+import diagnostics
+import resource
 import argparse
 import logger
-import psycopg2
-import psycopg2.errors
-from psycopg2 import sql
-import select
+import selectors
 import errno
+import asyncio
+import collections
+import itertools
+import time
+import os
+import signal
+import sys
+
+
+DEFAULT_HIGH_WATER_MARK = 256 * 1024
+DEFAULT_FLUSH_SIZE = 64 * 1024
+SLOW_CONSUMER_POLICIES = ('disconnect', 'drop')
+DEFAULT_ROOM = 'lobby'
+CHATBOT_NAME = 'chatbot'
+"""Reported from the start, even while still zero"""
+COUNTERS = (
+    'accepts', 'username_rejects', 'messages_received', 'messages_sent', 'bytes_received', 'bytes_queued',
+    'bytes_sent', 'frames_dropped', 'clients_evicted', 'handshake_timeouts', 'idle_timeouts', 'pings_sent',
+    'direct_messages', 'direct_undeliverable', 'connection_errors', 'accept_limit_reached', 'connections_rejected',
+    'messages_rate_limited', 'reads_paused'
+)
+"""Generous, since the GUI client connects before its user has typed a username"""
+DEFAULT_HANDSHAKE_TIMEOUT = 120.0
+DEFAULT_IDLE_TIMEOUT = 90.0
+DEFAULT_PING_INTERVAL = 30.0
+DEFAULT_MESSAGE_RATE = 20.0
+DEFAULT_MESSAGE_BURST = 40
+DEFAULT_BYTE_RATE = 256 * 1024
+"""A full size frame always fits in the burst"""
+DEFAULT_BYTE_BURST = protocol.MAX_FRAME_LENGTH
+DEFAULT_MAX_ACCEPTS = 64
+"""Descriptors kept back from max_connections for the listener, DB, bus, logs and history files"""
+RESERVED_DESCRIPTORS = 64
+RATE_LIMITED_MESSAGE = 'You are sending messages too fast - some were not delivered'
+SERVER_FULL_MESSAGE = 'Server is full - please try again later'
+"""A v1 client shows a direct message like any other, so the text says it was only sent to them"""
+DIRECT_PREFIX = b'(direct) '
+CHATBOT_USERNAME = CHATBOT_NAME.encode('utf-8')
+
+
+def default_max_connections(reserved=RESERVED_DESCRIPTORS):
+    return max(resource.getrlimit(resource.RLIMIT_NOFILE)[0] - reserved, 1)
+
+
+class Connection:
+    """Everything the event engine keeps for one socket, in slots so an idle user costs a few hundred
+    bytes. username stays None until it is accepted; it is the same bytes object that keys
+    Server.usernames. decoder reads through the server's shared receive chunk"""
+    __slots__ = (
+        'socket', 'address', 'client_id', 'username', 'version', 'room', 'compression', 'connected_at',
+        'last_activity', 'ping_sent', 'message_bucket', 'byte_bucket', 'paused', 'rate_limited', 'decoder',
+        'outbound'
+    )
+
+    def __init__(self, socket, address, high_water_mark=DEFAULT_HIGH_WATER_MARK, client_id=0, receive_chunk=None):
+        self.socket = socket
+        self.address = address
+        self.client_id = client_id
+        self.username = None
+        self.version = None
+        self.room = None
+        self.compression = False
+        self.connected_at = self.last_activity = time.monotonic()
+        self.ping_sent = False
+        self.message_bucket = None
+        self.byte_bucket = None
+        self.paused = False
+        self.rate_limited = False
+        self.decoder = protocol.FrameDecoder(chunk=receive_chunk)
+        self.outbound = outbound_queue.OutboundQueue(high_water_mark)
 
 
 class Server:
-    def __init__(self, IP, PORT):
-        self.server_socket = server_socket.Socket(IP, PORT)
-        self.clients = {}
-        self.sockets_list = [self.server_socket]
-        self.HEADER_LENGTH = 16
-        self.instantiated_logger = logger.Logger(__name__)
-        self.instantiated_logger.initialise_logging()
-        self.root_database_connection = psycopg2.connect(
-            dbname='postgres', user='rizwan', host='localhost', password='password123'
+    def __init__(self, IP, PORT, high_water_mark=DEFAULT_HIGH_WATER_MARK, slow_consumer_policy='disconnect',
+                 reuse_port=False, db_pool_size=4, db_workers=4, worker_id=0, flush_delay=0.0,
+                 flush_size=DEFAULT_FLUSH_SIZE, nodelay=True, send_buffer=None, receive_buffer=None, history_dir=None,
+                 history_replay=history_store.DEFAULT_RECENT, history_open_rooms=history_store.DEFAULT_MAX_OPEN_ROOMS,
+                 queued_logging=False, log_sample_every=1, log_max_per_second=0,
+                 compression_threshold=protocol.DEFAULT_COMPRESSION_THRESHOLD,
+                 compression_level=protocol.DEFAULT_COMPRESSION_LEVEL, handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, ping_interval=DEFAULT_PING_INTERVAL, message_rate=DEFAULT_MESSAGE_RATE,
+                 message_burst=DEFAULT_MESSAGE_BURST, byte_rate=DEFAULT_BYTE_RATE, byte_burst=DEFAULT_BYTE_BURST,
+                 max_connections=None, max_accepts=DEFAULT_MAX_ACCEPTS, listen_fd=None, storage_engine=None):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f'slow_consumer_policy must be one of {SLOW_CONSUMER_POLICIES}')
+
+        """v1 has no control frames to ping with, so TCP keepalive finds v1 peers that have gone.
+        listen_fd is a listener handed over by the process this one replaces"""
+        self.server_socket = server_socket.Socket(
+            IP, PORT, reuse_port, nodelay, send_buffer, receive_buffer, keepalive_idle=idle_timeout or None,
+            fileno=listen_fd
+        )
+        self.server_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.connections = {}
+        """One receive buffer for every client socket: each read is copied out of it straight away"""
+        self.receive_chunk = memoryview(bytearray(protocol.RECEIVE_CHUNK_SIZE))
+        """Logged in v2 connections, the only ones presence updates go to"""
+        self.presence = set()
+        self.HEADER_LENGTH = protocol.HEADER_LENGTH
+        self.instantiated_logger = logger.Logger(
+            __name__, queued=queued_logging, sample_every=log_sample_every, max_per_second=log_max_per_second
         )
-        self.dbname = 'chatdb'
-        self.client_socket_usernames_accepted = []
+        self.instantiated_logger.initialise_logging()
+        self.diagnostics = diagnostics.Diagnostics(self.instantiated_logger.log_directory, f'chat-server-{worker_id}')
+        """Phase timing is off until toggle_phase_timing, and then every phase is measured"""
+        self.phases = diagnostics.NO_PHASE_TIMER
+        """In-process unless told otherwise, so a server needs no external service to start"""
+        self.storage = storage_engine or storage.MemoryStorage()
+        self.db_pool = None
+        self.db_pool_size = db_pool_size
+        self.db_workers = db_workers
+        self.stream_clients = {}
+        self.high_water_mark = high_water_mark
+        self.slow_consumer_policy = slow_consumer_policy
+        self.pending_removals = set()
+        self.flush_delay = flush_delay
+        self.flush_size = flush_size
+        self.dirty = set()
+        self.dirty_since = None
+        self.in_tick = False
+        self.counters = collections.Counter(dict.fromkeys(COUNTERS, 0))
+        self.fanout_size = metrics.Histogram(metrics.FANOUT_BUCKETS)
+        self.broadcast_latency = metrics.Histogram()
+        self.loop_time = metrics.Histogram()
+        self.read_time = None
+        self.unflushed_broadcasts = []
+        self.admin = None
+        self.admin_address = None
+        """(threshold, level) for v2 clients that negotiated compression, None if it is turned off"""
+        self.compression = (compression_threshold, compression_level) if compression_threshold else None
+        self.bus = None
+        self.worker_id = worker_id
+        self.client_ids = itertools.count(1)
+        self.remote_users = {}
+        self.remote_usernames = {}
+        self.rooms = {}
+        self.usernames = {}
+        self.username_registry = username_registry.UsernameRegistry()
+        self.history = history_store.HistoryStore(
+            history_dir, history_replay, max_open_rooms=history_open_rooms
+        ) if history_dir else None
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.timers = timer_wheel.TimerWheel(now=time.monotonic())
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        if max_connections is None:
+            """Open history rooms hold descriptors too, so they come out of the connection budget"""
+            history_descriptors = history_store.DESCRIPTORS_PER_ROOM * history_open_rooms if history_dir else 0
+            max_connections = default_max_connections(RESERVED_DESCRIPTORS + history_descriptors)
+        self.max_connections = max_connections
+        self.max_accepts = max_accepts
+        """Connections whose reads are paused until their byte bucket refills"""
+        self.resume_timers = timer_wheel.TimerWheel(tick=0.05, now=time.monotonic())
+        self.unwatched = set()
+        self.handoff = None
+        self.handed_off = False
+
+    def register_connection(self, socket, address):
+        """Registers a client socket with the selector so it is only visited when it becomes readable"""
+        connection = Connection(socket, address, self.high_water_mark, self.next_client_id(), self.receive_chunk)
+        self.connections[socket] = connection
+        self.selector.register(socket, selectors.EVENT_READ, connection)
+
+        if self.handshake_timeout:
+            self.timers.schedule(connection, connection.connected_at + self.handshake_timeout)
+
+        if self.message_rate:
+            connection.message_bucket = rate_limit.TokenBucket(self.message_rate, self.message_burst, connection.connected_at)
+
+        if self.byte_rate:
+            connection.byte_bucket = rate_limit.TokenBucket(self.byte_rate, self.byte_burst, connection.connected_at)
+
+        return connection
+
+    def next_client_id(self):
+        """v2 sender ids. The low byte is the worker id so ids stay unique across --workers"""
+        return (next(self.client_ids) % 0xFFFFFF) << 8 | self.worker_id
+
+    def connection_for(self, socket, address=None):
+        connection = self.connections.get(socket)
+        if connection is None:
+            connection = self.register_connection(socket, address)
+
+        return connection
+
+    def close_connection(self, socket):
+        """The one teardown path, whatever ended the connection: drops it from every index, timer and
+        queue, releases the username and closes the socket. Safe to call for sockets the selector never saw"""
+        connection = self.connections.pop(socket, None)
+        self.pending_removals.discard(socket)
+        self.unwatched.discard(socket)
+
+        if connection is not None:
+            self.timers.cancel(connection)
+            self.resume_timers.cancel(connection)
+            self.dirty.discard(connection)
+
+            if connection.username is not None:
+                self.forget_client(connection)
+
+        try:
+            self.selector.unregister(socket)
+        except (KeyError, ValueError):
+            pass
+
+        socket.close()
 
-    def remove_client(self, db_connection, socket):
-        username = self.clients[socket]['data'].decode('utf-8')
+    def forget_client(self, connection):
+        username = connection.username.decode('utf-8')
         try:
             self.instantiated_logger.logger.info(
                 f'Closed connection from: {username}'
             )
 
-            self.sockets_list.remove(socket)
+            del self.usernames[connection.username]
+            self.presence.discard(connection)
+            self.leave_room(connection)
+            self.release_username(username)
+            self.announce_leave(connection)
 
-            del self.clients[socket]
+        except Exception as e:
+            self.instantiated_logger.logger.exception(e)
 
-            cur = db_connection.cursor()
+    def check_timeouts(self, connection, now):
+        """Runs when a connection's timer fires. Activity only moves last_activity, so the timer may
+        have fired early; then it is set again from the latest activity"""
+        if connection.username is None:
+            if now - connection.connected_at >= self.handshake_timeout:
+                self.counters['handshake_timeouts'] += 1
+                self.pending_removals.add(connection.socket)
+            return
+
+        if connection.version != 2 or not self.idle_timeout:
+            return
+
+        idle = now - connection.last_activity
+
+        if idle >= self.idle_timeout:
+            self.instantiated_logger.logger.info(f'Idle timeout for {connection.address}')
+            self.counters['idle_timeouts'] += 1
+            self.pending_removals.add(connection.socket)
+            return
+
+        if self.ping_interval and idle >= self.ping_interval and not connection.ping_sent:
+            connection.ping_sent = True
+            self.counters['pings_sent'] += 1
+            self.queue_frame(connection, protocol.encode_v2(protocol.PING))
+
+        self.schedule_timeout(connection)
+
+    def schedule_timeout(self, connection):
+        """v2 clients are pinged after ping_interval of silence and dropped after idle_timeout"""
+        if connection.version != 2 or not self.idle_timeout:
+            self.timers.cancel(connection)
+            return
+
+        wait = self.idle_timeout if connection.ping_sent or not self.ping_interval else self.ping_interval
+        self.timers.schedule(connection, connection.last_activity + wait)
+
+    def expire_timers(self):
+        now = time.monotonic()
+
+        for connection in self.timers.expire(now):
+            if connection is self.username_registry:
+                self.username_registry.retry()
+                self.flush_usernames()
+            elif connection.socket in self.connections:
+                self.check_timeouts(connection, now)
+
+    def admit_client(self, connection, username):
+        """Adds a client whose username was just reserved. close_connection only releases names that
+        made it onto a connection, so one that fails before then is released here"""
+        try:
+            self.add_client(username, connection.socket, connection.address)
+        except BaseException:
+            if connection.username is None:
+                self.release_username(username.decode('utf-8'))
+            raise
+
+    def add_client(self, username, socket, client_address):
+        self.instantiated_logger.logger.info(
+            f'Added client {client_address[0]}:{client_address[1]}, name: {username.decode("utf-8")}'
+        )
 
-            cur.execute(
-                """
-                    DELETE FROM
-                        usernames
-                    WHERE
-                        username=%(username)s
-                """, {
-                        'username': username
-                    })
+        connection = self.connection_for(socket, client_address)
+        connection.username = username
+        self.usernames[username] = connection
 
-        except Exception as e:
-            self.instantiated_logger.logger.exception(e)
+        if connection.version == 2:
+            self.presence.add(connection)
 
-    def add_client(self, client_name, socket, client_address):
-        username = client_name["data"].decode("utf-8")
-        self.instantiated_logger.logger.info(f'Added client {client_address[0]}:{client_address[1]}, name: {username}')
+        self.schedule_timeout(connection)
+        self.join_room(connection, DEFAULT_ROOM)
+        self.replay_history(connection)
+        self.announce_join(connection)
+
+    def join_room(self, connection, room):
+        """A client is in one room at a time; messages only reach the members of the sender's room"""
+        self.leave_room(connection)
+        members = self.rooms.get(room)
+
+        if members is None:
+            members = self.rooms[room] = set()
+
+        members.add(connection)
+        connection.room = room
+
+    def leave_room(self, connection):
+        members = self.rooms.get(connection.room)
+
+        if members is not None:
+            members.discard(connection)
 
-        self.clients[socket] = client_name
+            if not members:
+                del self.rooms[connection.room]
+
+        connection.room = None
+
+    def change_room(self, connection, room):
+        """Handles a JOIN/LEAVE frame or a v1 /join, /leave command and confirms it to the client. room
+        is None for a name that was not UTF-8"""
+        room = room.strip() if room is not None else None
+
+        if not room or len(room) > 32:
+            self.notify(connection, 'room names should be UTF-8 text between 1 and 32 characters long', protocol.REJECTED)
+            return
+
+        self.join_room(connection, room)
+        self.notify(connection, room, protocol.JOIN, f'You are now in room {room}')
+        self.replay_history(connection)
+
+    def replay_history(self, connection):
+        """Sends the room's latest messages, straight from the history ring buffer as stored frames"""
+        if self.history is None:
+            return
+
+        for frame in self.history.recent(connection.room, connection.version):
+            self.queue_frame(connection, frame)
+
+    def send_history_range(self, connection, request):
+        """Answers a v2 HISTORY_REQUEST for scrollback with HISTORY frames read by message id"""
+        if self.history is None or len(request) != history_store.HISTORY_REQUEST.size:
+            return
+
+        first_id, count = history_store.HISTORY_REQUEST.unpack(request)
+        for frame in self.history.read_range(connection.room, first_id, count, connection.version):
+            self.queue_frame(connection, frame)
+
+    def notify(self, connection, text, frame_type, v1_text=None):
+        """Sends a v2 client a frame of the given type, and a v1 client a message from the chatbot"""
+        if connection.version == 2:
+            self.queue_frame(connection, protocol.encode_v2(frame_type, text.encode('utf-8')))
+        else:
+            self.queue_frame(connection, encode_message(1, 0, CHATBOT_USERNAME, (v1_text or text).encode('utf-8')))
+
+    def handle_command(self, connection, data):
+        """v1 clients have no frame types, so room changes are chat commands. Returns False for
+        anything that is not a command so it is sent as a normal message"""
+        if data.startswith(b'/join '):
+            self.change_room(connection, decode_text(data[len(b'/join '):]))
+            return True
+
+        if data.strip() == b'/leave':
+            self.change_room(connection, DEFAULT_ROOM)
+            return True
+
+        if data.startswith(b'/msg '):
+            recipient, _, text = data[len(b'/msg '):].partition(b' ')
+            self.send_direct(connection, recipient, text)
+            return True
+
+        if data.strip() == b'/who':
+            online = sorted(name.decode('utf-8') for name in itertools.chain(self.usernames, self.remote_usernames))
+            self.notify(connection, 'Online: ' + ', '.join(online), protocol.WHO)
+            return True
+
+        return False
+
+    def send_direct(self, connection, recipient, data):
+        """Delivers a message to one user, found through the username index rather than by visiting
+        every client. A user on another worker is reached through the bus"""
+        target = self.usernames.get(recipient)
+        self.counters['direct_messages'] += 1
+
+        if target is not None:
+            self.deliver_direct(connection.client_id, connection.username, target, data)
+        elif recipient in self.remote_usernames:
+            self.publish_to_bus(worker_bus.DIRECT, worker_bus.encode_message(
+                connection.client_id, connection.username, recipient.decode('utf-8'), data
+            ))
+        else:
+            self.counters['direct_undeliverable'] += 1
+            self.notify(connection, f'{recipient.decode("utf-8", errors="replace")} is not online', protocol.UNDELIVERABLE)
+
+    def deliver_direct(self, sender_id, username, target, data):
+        if target.version != 2:
+            self.queue_frame(target, encode_message(1, sender_id, username, DIRECT_PREFIX + data))
+            return
+
+        flags = 0
+        if target.compression:
+            data, flags = protocol.compress_payload(data, *self.compression)
+
+        self.queue_frame(target, protocol.encode_v2(protocol.DIRECT, data, sender=sender_id, flags=flags))
+
+    def send_roster(self, connection):
+        """Everyone online, as USER_JOINED frames; from then on the client is kept up to date by the
+        USER_JOINED and USER_LEFT deltas sent as users come and go"""
+        for other in self.usernames.values():
+            if other is not connection:
+                self.queue_frame(connection, protocol.encode_v2(
+                    protocol.USER_JOINED, other.username, sender=other.client_id
+                ))
+
+        for client_id, remote_username in self.remote_users.items():
+            self.queue_frame(connection, protocol.encode_v2(protocol.USER_JOINED, remote_username, sender=client_id))
+
+    def announce_join(self, connection):
+        """Tells v2 clients, here and on other workers, which id the new user's messages will carry.
+        A new v2 client is first sent everyone already online"""
+        username = connection.username
+
+        if connection.version == 2:
+            self.send_roster(connection)
+
+        self.fanout_v2(protocol.encode_v2(protocol.USER_JOINED, username, sender=connection.client_id), connection.socket)
+
+        if self.bus is not None:
+            self.publish_to_bus(worker_bus.JOINED, worker_bus.encode_presence(connection.client_id, username))
+
+    def announce_leave(self, connection):
+        self.fanout_v2(protocol.encode_v2(protocol.USER_LEFT, sender=connection.client_id))
+
+        if self.bus is not None:
+            self.publish_to_bus(worker_bus.LEFT, worker_bus.encode_presence(connection.client_id))
+
+    def receive(self, connection):
+        """Reads into the connection's decoder. The first bytes of a connection decide its protocol"""
+        received = connection.decoder.receive_from(connection.socket)
+        self.counters['bytes_received'] += received
+
+        if connection.byte_bucket is not None:
+            self.charge_bytes(connection, received)
+
+        if connection.version is None:
+            connection.version = protocol.detect_version(connection.decoder)
+
+            if connection.version == 2:
+                connection.decoder = protocol.V2FrameDecoder.take_over(connection.decoder)
+
+        return received
+
+    def charge_bytes(self, connection, received):
+        """Bytes are charged after they are read. A client that overdraws its byte bucket is not read
+        from until the debt is paid off, so TCP flow control slows the sender down"""
+        now = time.monotonic()
+        delay = connection.byte_bucket.consume(received, now)
+
+        if delay and not connection.paused:
+            connection.paused = True
+            self.counters['reads_paused'] += 1
+            self.resume_timers.schedule(connection, now + delay)
+            self.watch(connection)
+
+    def resume_reads(self):
+        for connection in self.resume_timers.expire(time.monotonic()):
+            if connection.socket in self.connections:
+                connection.paused = False
+                self.watch(connection)
+
+    def allow_frame(self, connection):
+        """Message bucket check for each frame from a logged in client. The first frame dropped in a
+        burst gets the client a notice; the rest are dropped silently until one is let through"""
+        if connection.message_bucket is None or connection.message_bucket.take(1, time.monotonic()):
+            connection.rate_limited = False
+            return True
+
+        self.counters['messages_rate_limited'] += 1
+
+        if not connection.rate_limited:
+            connection.rate_limited = True
+            self.notify(connection, RATE_LIMITED_MESSAGE, protocol.RATE_LIMITED)
+
+        return False
 
     def read_message(self, socket_client):
+        """Returns the next frame from the socket, reading until one is complete. Frames that arrived
+        in the same read stay buffered on the connection for the next call"""
+        connection = self.connection_for(socket_client)
         try:
-            message_header = socket_client.recv(self.HEADER_LENGTH)
+            while True:
+                message = connection.decoder.next_frame()
+                if message is not None:
+                    return message
 
-            """If socket closed by client, or as soon as client used shutdown"""
-            if len(message_header) == 0:
+                """If socket closed by client, or as soon as client used shutdown"""
+                if self.receive(connection) == 0:
+                    return False
+
+        except Exception as e:
+            """Any other exception - something happened. Exit"""
+            return False
+
+    def read_messages(self, socket_client):
+        """Does a single large read and returns every complete frame now available. Returns an empty
+        list if the read would block and False once the peer has gone"""
+        connection = self.connection_for(socket_client)
+        try:
+            if self.receive(connection) == 0:
                 return False
 
+            return list(connection.decoder.frames())
+
+        except IOError as e:
+            if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
+                return []
+
+            self.instantiated_logger.logger.info(f'Reading error: {str(e)}')
+            return False
+
+        except ValueError as e:
+            self.instantiated_logger.logger.info(f'Framing error: {str(e)}')
+            return False
+
+    def log_message(self, username, data):
+        """Chat messages are the one per-message log line, so they go through the sampler and are
+        only decoded and formatted if a handler emits them"""
+        if self.instantiated_logger.sampler.allow():
+            self.instantiated_logger.logger.info(
+                'Received message from %s: %s', logger.LazyText(username), logger.LazyText(data)
+            )
+
+    def broadcast_messages(self, read_socket, message):
+        sender = self.connections[read_socket]
+        self.fanout_message(sender.client_id, sender.username, message['data'], sender.room, sender)
+        self.unflushed_broadcasts.append(self.read_time or time.perf_counter())
+
+        if self.bus is not None:
+            self.publish_to_bus(worker_bus.BROADCAST, worker_bus.encode_message(
+                sender.client_id, sender.username, sender.room, message['data']
+            ))
+
+    def fanout_message(self, sender_id, username, data, room, sender=None):
+        """Sends to the members of one room only, so the cost is the room size, not the user count.
+        The wire frame is encoded once per protocol version in use; every recipient queue of that
+        version shares a reference to the same bytes"""
+        frames = {}
+
+        if self.history is not None:
+            self.history.append(room, sender_id, username, data)
+
+        recipients = 0
+
+        for connection in self.rooms.get(room, ()):
+            if connection is sender:
+                continue
+
+            """Compressed frames are cached like any other encoding, so zlib runs at most once per broadcast"""
+            encoding = (connection.version, connection.compression)
+            frame = frames.get(encoding)
+
+            if frame is None:
+                frame = frames[encoding] = encode_message(
+                    connection.version, sender_id, username, data, self.compression if connection.compression else None
+                )
+
+            self.queue_frame(connection, frame)
+            recipients += 1
+
+        self.fanout_size.observe(recipients)
+        self.counters['messages_sent'] += recipients
+
+    def fanout_v2(self, frame, read_socket=None):
+        """Presence updates only mean something to v2 clients"""
+        for connection in self.presence:
+            if connection.socket is not read_socket:
+                self.queue_frame(connection, frame)
+
+    def send_frame(self, socket, frame):
+        connection = self.connections.get(socket)
+
+        if connection is not None:
+            self.queue_frame(connection, frame)
+
+    def queue_frame(self, connection, frame):
+        """Queues a frame on the client's outbound buffer. Inside a loop iteration the write is deferred
+        so every frame for this client in the iteration goes out in one sendmsg; outside one (or past
+        flush_size) it is written straight away. Whatever the socket does not take is flushed when the
+        selector reports it writable"""
+        socket = connection.socket
+
+        if socket in self.pending_removals:
+            return
+
+        if not connection.outbound.push(frame):
+            """Only a client whose socket will not take the coalesced backlog counts as slow"""
+            self.flush_outbound(connection)
+
+            if socket in self.pending_removals or not connection.outbound.push(frame):
+                if self.slow_consumer_policy == 'drop':
+                    self.counters['frames_dropped'] += 1
+                else:
+                    self.instantiated_logger.logger.info(f'Evicting slow consumer {connection.address}')
+                    self.counters['clients_evicted'] += 1
+                    self.pending_removals.add(socket)
+                return
+
+        self.counters['bytes_queued'] += len(frame)
+        self.schedule_flush(connection)
+
+    def schedule_flush(self, connection):
+        if not self.in_tick or len(connection.outbound) >= self.flush_size:
+            self.flush_outbound(connection)
+            return
+
+        if not self.dirty:
+            self.dirty_since = time.monotonic()
+
+        self.dirty.add(connection)
+
+    def flush_dirty(self):
+        """Writes everything coalesced since the last flush, one syscall per connection"""
+        dirty, self.dirty = self.dirty, set()
+        self.dirty_since = None
+
+        for connection in dirty:
+            if connection.socket not in self.pending_removals:
+                self.flush_outbound(connection)
+
+    def flush_outbound(self, connection):
+        """Writes queued frames and only watches for write readiness while something is still queued"""
+        try:
+            self.counters['bytes_sent'] += connection.outbound.flush_to(connection.socket)
+        except OSError as e:
+            self.instantiated_logger.logger.info(f'Sending error: {str(e)}')
+            self.pending_removals.add(connection.socket)
+            return
+
+        self.watch(connection)
+
+    def watch(self, connection):
+        """Sets what the selector waits for: reads unless they are paused, writes while something is queued.
+        A paused connection with nothing to write is unregistered until its reads resume"""
+        events = 0 if connection.paused else selectors.EVENT_READ
+        if len(connection.outbound):
+            events |= selectors.EVENT_WRITE
+
+        key = self.selector.get_map().get(connection.socket)
+
+        if key is None:
+            """Only re-register sockets this method unregistered, never ones the selector was not given"""
+            if events and connection.socket in self.unwatched:
+                self.unwatched.discard(connection.socket)
+                self.selector.register(connection.socket, events, connection)
+        elif not events:
+            self.unwatched.add(connection.socket)
+            self.selector.unregister(connection.socket)
+        elif key.events != events:
+            self.selector.modify(connection.socket, events, connection)
+
+    def attach_bus(self, bus):
+        """Joins a worker bus: broadcasts are published to the other workers and usernames are reserved
+        through the hub"""
+        self.bus = bus
+        self.selector.register(bus.socket, selectors.EVENT_READ, bus)
+
+    def publish_to_bus(self, kind, body):
+        if not self.bus.publish(kind, body):
+            self.instantiated_logger.logger.info('Worker bus is not draining - message not shared with other workers')
+            return
+
+        self.schedule_flush(self.bus)
+
+    def handle_bus_readable(self):
+        messages = self.bus.received_messages()
+
+        if messages is False:
+            raise ConnectionError('worker bus hub closed')
+
+        for kind, body in messages:
+            if kind == worker_bus.BROADCAST:
+                sender_id, username, room, data = worker_bus.decode_message(body)
+                self.fanout_message(sender_id, username, data, room)
+
+            elif kind == worker_bus.JOINED:
+                client_id, username = worker_bus.decode_presence(body)
+                self.remote_users[client_id] = username
+                self.remote_usernames[username] = client_id
+                self.fanout_v2(protocol.encode_v2(protocol.USER_JOINED, username, sender=client_id))
+
+            elif kind == worker_bus.LEFT:
+                client_id, _ = worker_bus.decode_presence(body)
+                username = self.remote_users.pop(client_id, None)
+                if self.remote_usernames.get(username) == client_id:
+                    del self.remote_usernames[username]
+                self.fanout_v2(protocol.encode_v2(protocol.USER_LEFT, sender=client_id))
+
+            elif kind == worker_bus.DIRECT:
+                sender_id, username, recipient, data = worker_bus.decode_message(body)
+                target = self.usernames.get(recipient.encode('utf-8'))
+                if target is not None:
+                    self.deliver_direct(sender_id, username, target, data)
+
+    def reserve_username(self, username):
+        """Checks and claims the username in memory. When several workers share the port the hub has
+        the final say, since each worker's registry only sees its own clients"""
+        if self.bus is not None and not self.bus.reserve(username):
+            return False
+
+        return self.username_registry.reserve(username)
+
+    def release_username(self, username):
+        self.username_registry.release(username)
+
+        if self.bus is not None:
+            self.bus.release(username)
+
+    def process_removals(self):
+        """Tears down sockets marked for removal while the loop was iterating over clients"""
+        while self.pending_removals:
+            socket = self.pending_removals.pop()
+
+            if self.bus is not None and socket is self.bus.socket:
+                raise ConnectionError('worker bus hub closed')
+
+            self.close_connection(socket)
+
+    def create_username_database(self, usernames=()):
+        """Creates the storage engine's table of usernames, or adopts it if it already exists. usernames
+        are those of connections taken over from a previous process"""
+        self.storage.prepare(usernames)
+        return self.connect_username_database()
+
+    def connect_username_database(self):
+        """Sets up the connection pool. All storage work goes through it, never on the loop thread"""
+        self.db_pool = db_pool.DatabasePool(self.storage.connect, self.db_pool_size, self.db_workers)
+        self.selector.register(self.db_pool.wakeup_receiver, selectors.EVENT_READ, self.db_pool)
+        return self.db_pool
+
+    def flush_usernames(self):
+        """Hands the registry's next write-behind batch to the pool; the result comes back to the loop"""
+        if self.db_pool is None:
+            return
+
+        batch = self.username_registry.take_batch()
+
+        if batch is not None:
+            self.db_pool.submit(self.storage.persist_usernames, *batch, callback=self.usernames_flushed)
+
+    def run_db_completions(self):
+        self.db_pool.run_completions()
+        self.flush_usernames()
+
+    def usernames_flushed(self, result, error):
+        """A failed batch is retried from the timer wheel, backing off while the storage keeps failing"""
+        registry = self.username_registry
+        registry.batch_done(error is None)
+
+        if error is not None:
+            delay = registry.retry_delay()
+            self.instantiated_logger.logger.error(
+                f'Username batch failed {registry.failures} times in a row, retrying in {delay:.1f}s', exc_info=error
+            )
+            self.timers.schedule(registry, time.monotonic() + delay)
+
+    def accept_connections(self):
+        """Accepts up to max_accepts connections from the backlog; the rest wait for the next iteration,
+        so a reconnect storm cannot starve clients that are already connected. New sockets wait in the
+        selector until their username arrives"""
+        for _ in range(self.max_accepts or sys.maxsize):
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except IOError as e:
+                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
+                    self.instantiated_logger.logger.info(f'Accept error: {str(e)}')
+                return
+
+            self.counters['accepts'] += 1
+
+            if self.max_connections and len(self.connections) >= self.max_connections:
+                self.reject_connection(client_socket)
+                continue
+
+            client_socket.setblocking(False)
+            self.register_connection(client_socket, client_address)
+
+        self.counters['accept_limit_reached'] += 1
+
+    def reject_connection(self, client_socket):
+        """The protocol version is not known yet, so the reason goes out as a v1 frame; a v2 client
+        sees a reply that is not a HELLO followed by the connection closing"""
+        self.counters['connections_rejected'] += 1
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(protocol.encode_frame(SERVER_FULL_MESSAGE.encode('utf-8')))
+        except OSError:
+            pass
+
+        client_socket.close()
+
+    def handle_readable(self, connection):
+        socket = connection.socket
+        self.read_time = time.perf_counter()
+        connection.last_activity = time.monotonic()
+        connection.ping_sent = False
+        messages = self.read_messages(socket)
+
+        if messages is False:
+            self.close_connection(socket)
+            return
+
+        for message in messages:
+            if connection.username is None:
+                if connection.version == 2:
+                    self.handle_v2_handshake(connection, message)
+                else:
+                    handle_username(socket, message, self)
+                continue
+
+            if connection.version == 2 and message['type'] in (protocol.PING, protocol.PONG):
+                if message['type'] == protocol.PING:
+                    self.queue_frame(connection, protocol.encode_v2(protocol.PONG))
+                continue
+
+            if not self.allow_frame(connection):
+                continue
+
+            if connection.version == 2:
+                if message['type'] == protocol.JOIN:
+                    self.change_room(connection, decode_text(message['data']))
+                    continue
+
+                if message['type'] == protocol.LEAVE:
+                    self.change_room(connection, DEFAULT_ROOM)
+                    continue
+
+                if message['type'] == protocol.HISTORY_REQUEST:
+                    self.send_history_range(connection, message['data'])
+                    continue
+
+                if message['type'] == protocol.DIRECT:
+                    self.send_direct(connection, *protocol.decode_direct(message['data']))
+                    continue
+
+                if message['type'] == protocol.WHO:
+                    """The roster, then an empty WHO to mark its end"""
+                    self.send_roster(connection)
+                    self.queue_frame(connection, protocol.encode_v2(protocol.WHO))
+                    continue
+
+                if message['type'] != protocol.MESSAGE:
+                    continue
+
+            elif message['data'][:1] == b'/' and self.handle_command(connection, message['data']):
+                continue
+
+            self.counters['messages_received'] += 1
+            self.log_message(connection.username, message['data'])
+            self.phases.measure('broadcast', self.broadcast_messages, socket, message)
+
+    def handle_v2_handshake(self, connection, message):
+        """v2 clients send HELLO, which is answered with the version the server speaks, then USERNAME"""
+        if message['type'] == protocol.HELLO:
+            try:
+                version, features = protocol.decode_hello(message)
+            except ValueError as e:
+                self.queue_frame(connection, protocol.encode_v2(protocol.REJECTED, str(e).encode('utf-8')))
+                return
+
+            accepted = features & protocol.FEATURE_COMPRESSION if self.compression else 0
+            connection.compression = bool(accepted)
+            self.queue_frame(connection, protocol.encode_hello(min(version, protocol.PROTOCOL_VERSION), accepted))
+            return
+
+        if message['type'] != protocol.USERNAME:
+            return
+
+        username = decode_text(message['data'])
+        reject_message = validate_username(username) if username is not None else USERNAME_ENCODING_MESSAGE
+
+        if reject_message is None and not self.reserve_username(username):
+            reject_message = USERNAME_TAKEN_MESSAGE
+
+        if reject_message is not None:
+            self.counters['username_rejects'] += 1
+            self.queue_frame(connection, protocol.encode_v2(protocol.REJECTED, reject_message.encode('utf-8')))
+            return
+
+        self.queue_frame(connection, protocol.encode_v2(protocol.ACCEPTED, sender=connection.client_id))
+        self.admit_client(connection, message['data'])
+
+    def run_once(self, timeout=None):
+        """One event loop iteration. Only sockets with pending events are visited, so idle clients cost nothing.
+        Frames queued while handling the events are written together at the end, or once flush_delay
+        has passed since the oldest of them"""
+        if self.dirty:
+            remaining = max(0.0, self.flush_delay - (time.monotonic() - self.dirty_since))
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        for timers in (self.timers, self.resume_timers):
+            if timers:
+                next_tick = timers.time_to_next_tick(time.monotonic())
+                timeout = next_tick if timeout is None else min(timeout, next_tick)
+
+        self.in_tick = True
+        try:
+            ready = self.phases.measure('select', self.selector.select, timeout)
+            started = time.perf_counter()
+
+            for key, events in ready:
+                if key.fileobj is self.server_socket:
+                    self.accept_connections()
+                    continue
+
+                if key.data is self.admin:
+                    self.admin.handle_event(key.fileobj)
+                    continue
+
+                if key.data is self.handoff:
+                    self.hand_off()
+                    if self.handed_off:
+                        return
+                    continue
+
+                if events & selectors.EVENT_WRITE:
+                    self.phases.measure('write', self.flush_outbound, key.data)
+
+                if key.data is self.bus:
+                    if events & selectors.EVENT_READ:
+                        self.phases.measure('bus', self.handle_bus_readable)
+                    continue
+
+                if key.data is self.db_pool:
+                    self.phases.measure('db', self.run_db_completions)
+                    continue
+
+                if events & selectors.EVENT_READ and key.fileobj not in self.pending_removals:
+                    try:
+                        self.phases.measure('read', self.handle_readable, key.data)
+                    except Exception as e:
+                        """Whatever one peer sent costs it its connection, never the event loop"""
+                        self.instantiated_logger.logger.exception(e)
+                        self.counters['connection_errors'] += 1
+                        self.close_connection(key.fileobj)
+
+            self.phases.measure('timers', self.expire_timers)
+            self.phases.measure('timers', self.resume_reads)
+
+        finally:
+            self.in_tick = False
+
+        self.process_removals()
+        self.phases.measure('db', self.flush_usernames)
+
+        if self.history is not None:
+            self.phases.measure('history', self.history.flush)
+
+        if self.dirty and time.monotonic() - self.dirty_since >= self.flush_delay:
+            self.phases.measure('write', self.flush_dirty)
+
+        finished = time.perf_counter()
+        self.loop_time.observe(finished - started)
+
+        if not self.dirty:
+            """Everything queued this iteration has been handed to the sockets"""
+            for read_time in self.unflushed_broadcasts:
+                self.broadcast_latency.observe(finished - read_time)
+            self.unflushed_broadcasts.clear()
+
+    def attach_admin(self, address):
+        """Serves /metrics on a local TCP port or Unix socket from this server's event loop, and the
+        diagnostics hooks, each of which answers with what it did"""
+        self.admin_address = address
+        self.admin = admin_endpoint.AdminEndpoint(address, self.selector, {
+            '/metrics': self.render_metrics,
+            '/profile': lambda: self.run_diagnostic(self.diagnostics.toggle_profile),
+            '/tracemalloc': lambda: self.run_diagnostic(self.diagnostics.snapshot_allocations),
+            '/tracemalloc-stop': lambda: self.run_diagnostic(self.diagnostics.stop_allocations),
+            '/phases': lambda: self.run_diagnostic(self.toggle_phase_timing),
+        })
+
+    def run_diagnostic(self, hook):
+        """Runs a diagnostics hook, logging and returning its summary"""
+        summary = hook()
+        self.instantiated_logger.logger.info(f'Diagnostics: {summary}')
+        return summary + '\n'
+
+    def toggle_phase_timing(self):
+        if self.phases is diagnostics.NO_PHASE_TIMER:
+            self.phases = diagnostics.PhaseTimer()
+            return 'phase timing started'
+
+        phases, self.phases = self.phases, diagnostics.NO_PHASE_TIMER
+        return f'phase timing stopped, wrote {self.diagnostics.write("phases", phases.report())}'
+
+    def handle_diagnostic_signals(self):
+        """SIGUSR1 toggles profiling and phase timing together, SIGUSR2 takes an allocation snapshot.
+        Handlers run on the main thread between event loop steps, which is the thread cProfile must see"""
+        def toggle_profiling(signum, frame):
+            self.run_diagnostic(self.diagnostics.toggle_profile)
+            self.run_diagnostic(self.toggle_phase_timing)
+
+        signal.signal(signal.SIGUSR1, toggle_profiling)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.run_diagnostic(self.diagnostics.snapshot_allocations))
+
+    def render_metrics(self):
+        histograms = {
+            'fanout_recipients': self.fanout_size,
+            'broadcast_latency_seconds': self.broadcast_latency,
+            'loop_iteration_seconds': self.loop_time,
+        }
+        if self.db_pool is not None:
+            histograms['db_wait_seconds'] = self.db_pool.wait_time
+            histograms['db_query_seconds'] = self.db_pool.query_time
+
+        gauges = {'connections': len(self.connections), 'clients': len(self.usernames), 'rooms': len(self.rooms)}
+        return metrics.render(self.counters, gauges, histograms)
+
+    def serve_forever(self):
+        while not self.handed_off:
+            self.run_once()
+
+    def attach_handoff(self, path):
+        """Waits on a Unix socket for a replacement process started with the same path (see hand_off)"""
+        self.handoff = handoff.HandoffEndpoint(path, self.selector)
+
+    def hand_off(self):
+        """Passes the listener and every connection to the replacement that connected to the handoff
+        endpoint, then stops serving without closing anything the replacement now owns. New connections
+        wait in the listen backlog meanwhile. The database pool and history are closed first, so the
+        replacement finds every write finished. If the transfer fails, this server carries on serving"""
+        successor = self.handoff.accept()
+        if successor is None:
+            return
+
+        path = self.handoff.path
+        self.handoff.close()
+        self.handoff = None
+        self.selector.unregister(self.server_socket)
+
+        if self.admin is not None:
+            self.admin.close()
+            self.admin = None
+
+        if self.history is not None:
+            """Rooms are reopened on next use, should this server have to carry on"""
+            self.history.close()
+
+        had_db_pool = self.db_pool is not None
+        if had_db_pool:
+            self.selector.unregister(self.db_pool.wakeup_receiver)
+            self.db_pool.close()
+            self.db_pool = None
+
+        connections = list(self.connections.values())
+        state = {
+            'listener': 0,
+            'next_client_id': next(self.client_ids),
+            'connections': [self.connection_state(connection, fd) for fd, connection in enumerate(connections, 1)],
+        }
+
+        try:
+            handoff.send_state(successor, state, [self.server_socket.fileno()] + [c.socket.fileno() for c in connections])
+        except OSError as e:
+            self.instantiated_logger.logger.exception(e)
+            self.resume_after_handoff(path, had_db_pool)
+            return
+        finally:
+            successor.close()
+
+        self.handed_off = True
+        self.history = None
+        self.instantiated_logger.logger.info(f'Handed off {len(connections)} connections')
+
+        """The replacement holds its own descriptors for these sockets, so closing ours ends nothing.
+        Connections whose reads are paused are not registered with the selector"""
+        for connection in connections:
+            if connection.socket not in self.unwatched:
+                self.selector.unregister(connection.socket)
+            connection.socket.close()
+
+        self.connections.clear()
+        self.unwatched.clear()
+        self.presence.clear()
+        self.usernames.clear()
+        self.rooms.clear()
+        self.dirty.clear()
+        self.pending_removals.clear()
+
+    def resume_after_handoff(self, path, had_db_pool):
+        """Undoes what hand_off shut down before a transfer that failed, and waits for the next replacement"""
+        self.instantiated_logger.logger.info('Handoff failed, carrying on serving')
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+        if had_db_pool:
+            self.connect_username_database()
+
+        if self.admin_address is not None:
+            self.attach_admin(self.admin_address)
+
+        self.attach_handoff(path)
+
+    def connection_state(self, connection, fd):
+        """What a replacement needs to carry on with a connection. Bytes still in the decoder are at most
+        one partial frame, since complete frames are handled as soon as they are read"""
+        decoder = connection.decoder
+        return {
+            'fd': fd,
+            'address': connection.address,
+            'client_id': connection.client_id,
+            'username': connection.username.decode('utf-8') if connection.username is not None else None,
+            'version': connection.version,
+            'room': connection.room,
+            'compression': connection.compression,
+            'received': handoff.encode_bytes(decoder.buffer[decoder.offset:]),
+            'outbound': handoff.encode_bytes(b''.join(connection.outbound.frames)),
+        }
+
+    def adopt(self, state, fds):
+        """Carries on serving the connections handed over by a previous process. Nothing is announced or
+        replayed: for the clients the connection never went away"""
+        self.client_ids = itertools.count(state['next_client_id'])
+
+        for record in state['connections']:
+            socket = handoff.adopt_socket(fds[record['fd']])
+            connection = self.register_connection(socket, tuple(record['address']) if record['address'] else None)
+            connection.client_id = record['client_id']
+            connection.version = record['version']
+            connection.compression = record['compression']
+
+            if connection.version == 2:
+                connection.decoder = protocol.V2FrameDecoder.take_over(connection.decoder)
+
+            connection.decoder.feed(handoff.decode_bytes(record['received']))
+            outbound = handoff.decode_bytes(record['outbound'])
+
+            if outbound and not connection.outbound.push(outbound):
+                self.close_connection(socket)
+                continue
+
+            if record['username'] is not None:
+                username = record['username'].encode('utf-8')
+                connection.username = username
+                self.usernames[username] = connection
+                if connection.version == 2:
+                    self.presence.add(connection)
+                self.username_registry.adopt(record['username'])
+                self.join_room(connection, record['room'] or DEFAULT_ROOM)
+                self.schedule_timeout(connection)
+
+            self.watch(connection)
+
+        self.instantiated_logger.logger.info(f'Took over {len(state["connections"])} connections')
+
+    async def read_stream_message(self, reader):
+        """asyncio counterpart of read_message using the same header framing and frame length bound"""
+        try:
+            message_header = await reader.readexactly(self.HEADER_LENGTH)
             message_length = int(message_header.decode('utf-8').strip())
-            message = socket_client.recv(message_length)
+
+            if message_length < 0 or message_length > protocol.MAX_FRAME_LENGTH:
+                raise ValueError(f'frame length {message_length} out of range')
+
+            message = await reader.readexactly(message_length)
             return {'header': message_header, 'data': message}
 
-        except Exception as e:
-            """Any other exception - something happened. Exit"""
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
             return False
 
-    def broadcast_messages(self, read_socket, message):
-        for client in self.clients:
-            if client != read_socket:
-                sender_client = self.clients[read_socket]
-                client.send(sender_client['header'] + sender_client['data']
-                            + message['header'] + message['data'])
-
-    def create_username_database(self):
-        """Creates database and table of usernames"""
-
-        """Create database"""
-        dbname = self.dbname
-        self.root_database_connection.set_session(readonly=False, autocommit=True)
-        cur = self.root_database_connection.cursor()
-        cur.execute("DROP DATABASE IF EXISTS " + dbname)
-        cur.execute('CREATE DATABASE ' + dbname)
-        cur.close()
-        self.root_database_connection.close()
-
-        """Connect to created database"""
-        conn = psycopg2.connect(dbname=dbname, user='rizwan', host='localhost', password='password123')
-
-        """Create a table of usernames"""
-        cur = conn.cursor()
-        cur.execute('CREATE TABLE usernames(username varchar(30))')
-        conn.commit()
-        cur.close()
-        return conn
+    def write_stream_message(self, writer, message):
+        writer.write(protocol.encode_frame(message.encode('utf-8'), self.HEADER_LENGTH))
+
+    async def accept_stream_username(self, reader, writer):
+        """Username handshake for one coroutine, so a slow client only ever holds up itself"""
+        while True:
+            client_name = await self.read_stream_message(reader)
+
+            if client_name is False:
+                return False
+
+            username = decode_text(client_name['data'])
+            reject_message = validate_username(username) if username is not None else USERNAME_ENCODING_MESSAGE
+
+            if reject_message is None and not self.reserve_username(username):
+                reject_message = USERNAME_TAKEN_MESSAGE
+
+            if reject_message is not None:
+                self.write_stream_message(writer, reject_message)
+                continue
+
+            self.write_stream_message(writer, USERNAME_ACCEPTED_MESSAGE)
+            self.flush_usernames()
+            return client_name
+
+    def broadcast_stream_messages(self, sender_writer, message):
+        sender_client = self.stream_clients[sender_writer]
+        frame = sender_client['header'] + sender_client['data'] + message['header'] + message['data']
+
+        if self.history is not None:
+            self.history.append(DEFAULT_ROOM, 0, sender_client['data'], message['data'])
+            self.history.flush()
+
+        for writer in self.stream_clients:
+            if writer is sender_writer:
+                continue
+
+            """The transport buffer plays the role of the outbound queue in asyncio mode"""
+            if writer.transport.get_write_buffer_size() + len(frame) > self.high_water_mark:
+                if self.slow_consumer_policy == 'drop':
+                    self.counters['frames_dropped'] += 1
+                else:
+                    self.counters['clients_evicted'] += 1
+                    writer.transport.abort()
+                continue
+
+            self.counters['bytes_queued'] += len(frame)
+            writer.write(frame)
+
+    async def handle_stream(self, reader, writer):
+        """Serves one client connection in asyncio mode"""
+        client_address = writer.get_extra_info('peername')
+        client_name = await self.accept_stream_username(reader, writer)
+
+        if client_name is False:
+            writer.close()
+            return
+
+        username = client_name['data'].decode('utf-8')
+        self.instantiated_logger.logger.info(f'Added client {client_address[0]}:{client_address[1]}, name: {username}')
+        self.stream_clients[writer] = client_name
+
+        if self.history is not None:
+            """asyncio mode has no rooms, everyone talks in the default one"""
+            writer.writelines(self.history.recent(DEFAULT_ROOM, 1))
+
+        try:
+            while True:
+                message = await self.read_stream_message(reader)
+
+                if message is False:
+                    break
+
+                self.log_message(client_name['data'], message['data'])
+                self.broadcast_stream_messages(writer, message)
+                await writer.drain()
+
+        finally:
+            self.instantiated_logger.logger.info(f'Closed connection from: {username}')
+            del self.stream_clients[writer]
+            writer.close()
+            self.release_username(username)
+            self.flush_usernames()
+
+    async def serve_async(self):
+        """Runs the listener under asyncio; each connection becomes its own handle_stream coroutine"""
+        self.selector.unregister(self.server_socket)
+
+        if self.db_pool is not None:
+            asyncio.get_running_loop().add_reader(self.db_pool.wakeup_receiver, self.run_db_completions)
+
+        stream_server = await asyncio.start_server(self.handle_stream, sock=self.server_socket)
+
+        async with stream_server:
+            await stream_server.serve_forever()
+
+    def serve_forever_async(self):
+        asyncio.run(self.serve_async())
+
+    def close(self):
+        for socket in list(self.connections):
+            self.close_connection(socket)
+
+        if self.db_pool is not None:
+            self.db_pool.close()
+            self.db_pool = None
+
+        if self.history is not None:
+            self.history.close()
+
+        if self.admin is not None:
+            self.admin.close()
+            self.admin = None
+
+        if self.handoff is not None:
+            self.handoff.close()
+            self.handoff = None
+
+        summary = self.diagnostics.close()
+        if summary is not None:
+            self.instantiated_logger.logger.info(f'Diagnostics: {summary}')
+
+        self.selector.close()
+        self.server_socket.close()
+        self.instantiated_logger.close()
 
 
 parser = argparse.ArgumentParser(
@@ -120,171 +1339,468 @@ parser.add_argument(
     nargs='?',
     default=1234,
     metavar='Port',
-    type=str,
+    type=int,
     help='the port of the client socket'
 )
 
+parser.add_argument(
+    '--high-water-mark',
+    default=DEFAULT_HIGH_WATER_MARK,
+    type=int,
+    help='bytes that may be queued for one client before the slow consumer policy applies'
+)
 
-def reject_username(reject_message, server, client_socket):
-    reject_message = reject_message.encode('utf-8')
-    reject_message_header = f'{len(reject_message):<{server.HEADER_LENGTH}}'.encode('utf-8')
-    client_socket.send(reject_message_header + reject_message)
+parser.add_argument(
+    '--slow-consumer-policy',
+    default='disconnect',
+    choices=SLOW_CONSUMER_POLICIES,
+    help='drop frames for, or disconnect, a client whose outbound queue is full'
+)
 
+parser.add_argument(
+    '--flush-delay',
+    default=0.0,
+    type=float,
+    help='milliseconds a queued frame may wait to be coalesced with later ones (0: flush every loop iteration)'
+)
 
-def store_username(db_connection, client_socket, username, server):
-    if len(username) < 2 or len(username) > 32:
-        reject_username('username should be between 2 and 31 characters long - try again', server, client_socket)
-        return False
+parser.add_argument(
+    '--flush-size',
+    default=DEFAULT_FLUSH_SIZE,
+    type=int,
+    help='bytes queued for one client that trigger an immediate write'
+)
 
-    banned_chars = "@#:`'\""
-    for char in username:
-        if char in banned_chars:
-            reject_username(
-                'username contains invalid characters - try again ("@", "#", ":" and all quotation marks not accepted)',
-                server, client_socket)
-            return False
+parser.add_argument(
+    '--no-tcp-nodelay',
+    dest='tcp_nodelay',
+    action='store_false',
+    help='leave Nagle enabled on client sockets'
+)
 
-    cur = db_connection.cursor()
-
-    cur.execute("""
-        SELECT 
-            username 
-        FROM 
-            usernames 
-        WHERE 
-            username=%(username)s
-    """, {
-        'username': username
-    })
-
-    row = cur.fetchone()
-
-    if row is None:
-        cur.execute("""
-        INSERT INTO 
-            usernames (username) 
-        VALUES 
-            (%(username)s)
-    """, {
-            'username': username
-        })
+parser.add_argument(
+    '--send-buffer',
+    default=None,
+    type=int,
+    help='SO_SNDBUF for the listener and client sockets (default: kernel autotuning)'
+)
 
-        db_connection.commit()
-        accept_username_message = 'Username assigned to you'.encode('utf-8')
-        accept_username_message_header = f'{len(accept_username_message):<{server.HEADER_LENGTH}}'.encode('utf-8')
-        client_socket.send(accept_username_message_header + accept_username_message)
-        return username.encode('utf-8')
-    else:
-        reject_username('Username already taken - please enter another', server, client_socket)
-        return False
+parser.add_argument(
+    '--receive-buffer',
+    default=None,
+    type=int,
+    help='SO_RCVBUF for the listener and client sockets (default: kernel autotuning)'
+)
 
+parser.add_argument(
+    '--handshake-timeout',
+    default=DEFAULT_HANDSHAKE_TIMEOUT,
+    type=float,
+    help='seconds a new connection has to get a username accepted; 0 for no limit'
+)
 
-def accept_username(db_connection, socket, server):
-    client_name = server.read_message(socket)
+parser.add_argument(
+    '--idle-timeout',
+    default=DEFAULT_IDLE_TIMEOUT,
+    type=float,
+    help='seconds of silence before a v2 client is dropped, and the TCP keepalive idle time for all clients; '
+         '0 turns both off'
+)
 
-    if client_name is False:
-        return False
+parser.add_argument(
+    '--ping-interval',
+    default=DEFAULT_PING_INTERVAL,
+    type=float,
+    help='seconds of silence before a v2 client is sent a PING'
+)
 
-    username = client_name['data'].decode('utf-8')
-    accepted_username = store_username(db_connection, socket, username, server)
+parser.add_argument(
+    '--message-rate',
+    default=DEFAULT_MESSAGE_RATE,
+    type=float,
+    help='messages per second each client may send on average; 0 for no limit'
+)
 
-    if not accepted_username:
-        return False
+parser.add_argument(
+    '--message-burst',
+    default=DEFAULT_MESSAGE_BURST,
+    type=int,
+    help='messages a client may send in a burst above --message-rate'
+)
 
-    server.client_socket_usernames_accepted.append(socket)
+parser.add_argument(
+    '--byte-rate',
+    default=DEFAULT_BYTE_RATE,
+    type=int,
+    help='bytes per second read from each client on average; reading pauses while a client is over it. 0 for no limit'
+)
 
-    server.add_client(client_name, socket, socket.getpeername())
+parser.add_argument(
+    '--byte-burst',
+    default=DEFAULT_BYTE_BURST,
+    type=int,
+    help='bytes a client may send in a burst above --byte-rate'
+)
 
-    return True
+parser.add_argument(
+    '--max-connections',
+    type=int,
+    help='connections accepted at once before new ones are turned away; defaults to the open file limit '
+         f'less {RESERVED_DESCRIPTORS} and the descriptors of open history rooms, 0 for no limit'
+)
 
+parser.add_argument(
+    '--max-accepts',
+    default=DEFAULT_MAX_ACCEPTS,
+    type=int,
+    help='connections accepted per event loop iteration; 0 for no limit'
+)
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    server = Server(args.IP, args.PORT)
-    db_connection = server.create_username_database()
-
-    while True:
-        read_sockets, _, exception_sockets = select.select(server.sockets_list, [], server.sockets_list)
-        for socket in read_sockets:
-            if socket == server.server_socket:
-                try:
-                    client_socket, client_address = server.server_socket.accept()
-                    client_socket.setblocking(False)
-                    server.sockets_list.append(client_socket)
-                    username_accepted = accept_username(db_connection, client_socket, server)
-
-                    if not username_accepted:
-                        continue
-
-                except IOError as e:
-                    """When there is no incoming data, error is going to be raised. Some operating systems will 
-                    indicate using EGAIN, some EWOULDBLOCK.We check for both - if one of them - that's
-                    expected, means no incoming data, continue as normal. If we got different error code - something 
-                    happened"""
-
-                    if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                        server.instantiated_logger.logger.info(f'Reading error: {str(e)}')
-                    """Server  did not receive anything"""
-                    continue
+parser.add_argument(
+    '--compression-threshold',
+    default=protocol.DEFAULT_COMPRESSION_THRESHOLD,
+    type=int,
+    help='v2 clients that ask for compression get messages of at least this many bytes zlib compressed; '
+         '0 turns compression off'
+)
 
-                except Exception as e:
-                    """ Any other exception - something happened."""
-                    server.instantiated_logger.logger.info(f'Reading error: {str(e)}')
+parser.add_argument(
+    '--compression-level',
+    default=protocol.DEFAULT_COMPRESSION_LEVEL,
+    type=int,
+    choices=range(1, 10),
+    metavar='1-9',
+    help='zlib level for compressed messages'
+)
 
-            else:
+parser.add_argument(
+    '--admin',
+    metavar='ADDRESS',
+    help='serve metrics at HOST:PORT or on a Unix socket path, e.g. 127.0.0.1:9100 (with --workers, '
+         'worker N uses PORT+N or PATH.N)'
+)
 
-                if socket not in server.client_socket_usernames_accepted:
-                    username_accepted = accept_username(db_connection, socket, server)
+parser.add_argument(
+    '--storage',
+    default='postgres',
+    choices=storage.ENGINES,
+    help='where usernames are persisted: in this process, a local SQLite file, or Postgres'
+)
 
-                    if not username_accepted:
-                        continue
+parser.add_argument(
+    '--storage-path',
+    default=storage.DEFAULT_SQLITE_PATH,
+    help='database file for --storage sqlite'
+)
 
-                else:
-                    message = None
+parser.add_argument(
+    '--handoff',
+    metavar='PATH',
+    help='Unix socket for zero-downtime restarts: a server started with the same PATH takes over the '
+         'listening socket and every connection from the one already running there'
+)
 
-                    try:
-                        message = server.read_message(socket)
-
-                    except IOError as e:
-                        """When there is no incoming data, error is going to be raised. Some operating systems will 
-                        indicate using EGAIN, some EWOULDBLOCK.We check for both - if one of them - that's
-                        expected, means no incoming data, continue as normal. If we got different error code - something 
-                        happened"""
-                        if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                            server.instantiated_logger.logger.info(f'Reading error: {str(e)}')
-                        """Server did not receive anything"""
-                        continue
+parser.add_argument(
+    '--log-mode',
+    choices=('queue', 'sync'),
+    default='queue',
+    help='queue: a background thread writes the logs; sync: log lines are written from the event loop'
+)
 
-                    except Exception as e:
-                        """ Any other exception - something happened."""
-                        server.instantiated_logger.logger.info(f'Reading error: {str(e)}')
+parser.add_argument(
+    '--log-sample',
+    default=1,
+    type=int,
+    help='log one in every N chat messages'
+)
+
+parser.add_argument(
+    '--log-rate',
+    default=100,
+    type=int,
+    help='log at most this many chat messages per second, 0 for no limit'
+)
+
+parser.add_argument(
+    '--history-dir',
+    default='History',
+    help='directory for message history segments; an empty value turns history off'
+)
+
+parser.add_argument(
+    '--history-replay',
+    default=history_store.DEFAULT_RECENT,
+    type=int,
+    help='number of recent messages replayed to a client joining a room'
+)
+
+parser.add_argument(
+    '--history-open-rooms',
+    default=history_store.DEFAULT_MAX_OPEN_ROOMS,
+    type=int,
+    help='rooms whose history files are kept open; size it to the rooms active at once, since a message '
+         f'to a closed room reopens its files. Each open room holds {history_store.DESCRIPTORS_PER_ROOM} descriptors'
+)
+
+parser.add_argument(
+    '--db-pool-size',
+    default=4,
+    type=int,
+    help='maximum number of open database connections'
+)
+
+parser.add_argument(
+    '--db-workers',
+    default=4,
+    type=int,
+    help='threads running database operations off the event loop'
+)
+
+parser.add_argument(
+    '--workers',
+    default=1,
+    type=int,
+    help='number of worker processes sharing the port through SO_REUSEPORT'
+)
+
+parser.add_argument(
+    '--asyncio',
+    action='store_true',
+    help='serve each connection as an asyncio coroutine instead of the selectors event loop'
+)
+
+
+def encode_message(version, sender_id, username, data, compression=None):
+    """v1 repeats the sender's username frame in front of every message; v2 only carries the sender id.
+    compression is (threshold, level) for a v2 client that negotiated it"""
+    if version == 2:
+        if compression is None:
+            return protocol.encode_v2(protocol.MESSAGE, data, sender=sender_id)
+
+        payload, flags = protocol.compress_payload(data, *compression)
+        return protocol.encode_v2(protocol.MESSAGE, payload, sender=sender_id, flags=flags)
+
+    return b''.join((protocol.encode_header(len(username)), username, protocol.encode_header(len(data)), data))
+
+
+def reject_username(reject_message, server, client_socket):
+    server.counters['username_rejects'] += 1
+    send_handshake_reply(reject_message, server, client_socket)
 
-                    if socket in server.clients:
-                        if message is False:
-                            server.remove_client(db_connection, socket)
-                            continue
 
-                        server.instantiated_logger.logger.info(
-                            f'Received message from {server.clients[socket]["data"].decode("utf-8")}:'
-                            f' {message["data"].decode("utf-8")}'
-                        )
+def send_handshake_reply(text, server, client_socket):
+    """Queued like any other frame, so a client that pipelines usernames and never reads its
+    replies is treated as a slow consumer rather than filling the socket buffer"""
+    server.queue_frame(
+        server.connection_for(client_socket), protocol.encode_frame(text.encode('utf-8'), server.HEADER_LENGTH)
+    )
 
-                        server.broadcast_messages(socket, message)
 
+USERNAME_ACCEPTED_MESSAGE = 'Username assigned to you'
+USERNAME_TAKEN_MESSAGE = 'Username already taken - please enter another'
+USERNAME_ENCODING_MESSAGE = 'username is not valid UTF-8 - try again'
 
-        for notified_socket in exception_sockets:
-            server.sockets_list.remove(notified_socket)
-            del server.clients[notified_socket]
 
+def decode_text(data):
+    """A username or room name as a client sent it, or None if it is not UTF-8"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
 
 
+def validate_username(username):
+    """Returns the reject message for a malformed username, or None if it may be claimed"""
+    if len(username) < 2 or len(username) > 32:
+        return 'username should be between 2 and 31 characters long - try again'
+
+    if username == CHATBOT_NAME:
+        return 'username is reserved - try again'
+
+    banned_chars = "@#:`'\""
+    for char in username:
+        if char in banned_chars:
+            return 'username contains invalid characters - try again ("@", "#", ":" and all quotation marks not accepted)'
+
+    return None
 
 
+def store_username(client_socket, username, server):
+    reject_message = validate_username(username)
+    if reject_message is not None:
+        reject_username(reject_message, server, client_socket)
+        return False
+
+    if server.reserve_username(username):
+        send_handshake_reply(USERNAME_ACCEPTED_MESSAGE, server, client_socket)
+        return username.encode('utf-8')
 
+    reject_username(USERNAME_TAKEN_MESSAGE, server, client_socket)
+    return False
 
 
+def accept_username(socket, server):
+    client_name = server.read_message(socket)
+
+    if client_name is False:
+        """Peer went away before sending a username"""
+        server.close_connection(socket)
+        return False
+
+    return handle_username(socket, client_name, server)
+
+
+def handle_username(socket, client_name, server):
+    """Validates and stores a username frame that has already been read off the socket"""
+    username = decode_text(client_name['data'])
+
+    if username is None:
+        reject_username(USERNAME_ENCODING_MESSAGE, server, socket)
+        return False
 
+    accepted_username = store_username(socket, username, server)
+
+    if not accepted_username:
+        return False
+
+    server.admit_client(server.connection_for(socket), client_name['data'])
+
+    return True
+
+
+def server_options(args):
+    """Server keyword arguments taken from the command line"""
+    return {
+        'high_water_mark': args.high_water_mark,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'db_pool_size': args.db_pool_size,
+        'db_workers': args.db_workers,
+        'flush_delay': args.flush_delay / 1000,
+        'flush_size': args.flush_size,
+        'nodelay': args.tcp_nodelay,
+        'send_buffer': args.send_buffer,
+        'receive_buffer': args.receive_buffer,
+        'history_dir': args.history_dir,
+        'history_replay': args.history_replay,
+        'history_open_rooms': args.history_open_rooms,
+        'queued_logging': args.log_mode == 'queue',
+        'log_sample_every': args.log_sample,
+        'log_max_per_second': args.log_rate,
+        'compression_threshold': args.compression_threshold,
+        'compression_level': args.compression_level,
+        'handshake_timeout': args.handshake_timeout,
+        'idle_timeout': args.idle_timeout,
+        'ping_interval': args.ping_interval,
+        'message_rate': args.message_rate,
+        'message_burst': args.message_burst,
+        'byte_rate': args.byte_rate,
+        'byte_burst': args.byte_burst,
+        'max_connections': args.max_connections,
+        'max_accepts': args.max_accepts,
+        'storage_engine': storage.create(args.storage, args.storage_path),
+    }
+
+
+def run_worker(args, bus_path, worker_id):
+    options = server_options(args)
+    if options['history_dir']:
+        """Every worker sees every broadcast through the bus, so each keeps its own complete copy"""
+        options['history_dir'] = os.path.join(options['history_dir'], f'worker-{worker_id}')
+
+    server = Server(args.IP, args.PORT, reuse_port=True, worker_id=worker_id, **options)
+    server.connect_username_database()
+
+    if args.admin:
+        server.attach_admin(admin_endpoint.worker_address(args.admin, worker_id))
+
+    server.attach_bus(worker_bus.BusClient(bus_path))
+    server.handle_diagnostic_signals()
+    server.serve_forever()
+
+
+def run_workers(args):
+    """Forks args.workers processes that each bind the port with SO_REUSEPORT. The parent stays behind
+    as the bus hub that relays broadcasts between them and keeps usernames unique"""
+    storage.create(args.storage, args.storage_path).prepare()
+    hub = worker_bus.BusHub()
+    worker_pids = []
+
+    for worker_id in range(args.workers):
+        pid = os.fork()
+
+        if pid == 0:
+            hub.close()
+            try:
+                run_worker(args, hub.path, worker_id)
+            finally:
+                os._exit(1)
+
+        worker_pids.append(pid)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        while worker_pids:
+            hub.run_once(timeout=1)
+            pid, status = os.waitpid(-1, os.WNOHANG)
+
+            if pid:
+                hub.instantiated_logger.logger.info(f'Worker {pid} exited with status {status}')
+                worker_pids.remove(pid)
+
+    finally:
+        for pid in worker_pids:
+            os.kill(pid, signal.SIGTERM)
+
+        hub.close()
+        os.unlink(hub.path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if args.handoff:
+            parser.error('--handoff is not supported with --workers')
+
+        if args.workers > 256:
+            parser.error('--workers is limited to 256, worker ids are one byte of the client id')
+
+        if args.asyncio:
+            parser.error('--workers is only supported by the selectors event loop')
+
+        run_workers(args)
+    else:
+        if args.asyncio and args.admin:
+            parser.error('--admin is only supported by the selectors event loop')
+
+        if args.asyncio and args.handoff:
+            parser.error('--handoff is only supported by the selectors event loop')
+
+        taken_over = handoff.take_over(args.handoff) if args.handoff else None
+
+        if taken_over is None:
+            server = Server(args.IP, args.PORT, **server_options(args))
+            server.create_username_database()
+        else:
+            state, fds = taken_over
+            server = Server(args.IP, args.PORT, listen_fd=fds[state['listener']], **server_options(args))
+            server.create_username_database(
+                [record['username'] for record in state['connections'] if record['username'] is not None]
+            )
 
+        if args.admin:
+            server.attach_admin(args.admin)
 
+        if taken_over is not None:
+            server.adopt(*taken_over)
 
+        if args.handoff:
+            server.attach_handoff(args.handoff)
 
+        if args.asyncio:
+            server.serve_forever_async()
+        else:
+            server.handle_diagnostic_signals()
+            server.serve_forever()
+            server.close()
@@ -0,0 +1,255 @@
+import collections
+import selectors
+import socket
+import threading
+
+import history_store
+import outbound_queue
+import protocol
+
+USERNAME_ACCEPTED_MESSAGE = 'Username assigned to you'
+USERNAME_TAKEN_MESSAGE = 'Username already taken - please enter another'
+SEND_BUFFER_LIMIT = 16 * 1024 * 1024
+CHATBOT_NAME = 'chatbot'
+DIRECT_PREFIX = '(direct) '
+"""v2 frames from the server that carry a notice for the user rather than a chat message"""
+NOTICES = (protocol.REJECTED, protocol.JOIN, protocol.RATE_LIMITED, protocol.UNDELIVERABLE)
+
+
+class ChatClient:
+    """GUI independent chat client: one I/O loop does all socket work for the connection.
+
+    send_username() and send_message() only queue a frame and wake the loop, so they are safe to call
+    from any thread. Everything the server sends is decoded incrementally and handed to the callbacks,
+    which run on the I/O loop's thread:
+
+        on_message(sender, text)      a chat message, or a notice when sender is the chatbot
+        on_username_accepted(name)
+        on_username_rejected(reason)
+        on_disconnect()               the server went away or close() was called
+
+    start() runs the loop on a daemon thread; run() runs it on the calling thread, for bots.
+
+    version 2 speaks the binary protocol: the client offers compression in its HELLO (unless compression
+    is False) and the decoder inflates compressed frames. The v1 chat commands (/join, /leave, /msg and
+    /who) are sent as their v2 frames, and the answers come back through on_message as in v1.
+    """
+
+    def __init__(self, IP, PORT, on_message=None, on_username_accepted=None, on_username_rejected=None,
+                 on_disconnect=None, version=1, compression=True):
+        if version not in (1, protocol.PROTOCOL_VERSION):
+            raise ValueError(f'version must be 1 or {protocol.PROTOCOL_VERSION}')
+
+        self.address = (IP, int(PORT))
+        self.version = version
+        self.features = protocol.FEATURE_COMPRESSION if compression else 0
+        """Features the server accepted in its HELLO"""
+        self.accepted_features = 0
+        """v2 client ids of everyone else online, from the roster and the join and leave deltas"""
+        self.users = {}
+        self.on_message = on_message or (lambda sender, text: None)
+        self.on_username_accepted = on_username_accepted or (lambda username: None)
+        self.on_username_rejected = on_username_rejected or (lambda reason: None)
+        self.on_disconnect = on_disconnect or (lambda: None)
+        self.username = None
+        self.requested_username = None
+        self.sender = None
+        self.socket = None
+        self.decoder = protocol.V2FrameDecoder() if version == 2 else protocol.FrameDecoder()
+        self.outbound = outbound_queue.OutboundQueue(SEND_BUFFER_LIMIT)
+        self.send_queue = collections.deque()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.thread = None
+        self.closed = False
+
+    def connect(self):
+        self.socket = socket.create_connection(self.address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
+        if self.version == 2:
+            self.queue(protocol.encode_hello(protocol.PROTOCOL_VERSION, self.features))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='chat-client-io', daemon=True)
+        self.thread.start()
+
+    def send_username(self, username):
+        self.requested_username = username
+
+        if self.version == 2:
+            self.queue(protocol.encode_v2(protocol.USERNAME, username.encode('utf-8')))
+        else:
+            self.queue(protocol.encode_frame(username.encode('utf-8')))
+
+    def send_message(self, message):
+        if self.version == 2:
+            self.queue(self.encode_v2_message(message))
+        else:
+            self.queue(protocol.encode_frame(message.encode('utf-8')))
+
+    def encode_v2_message(self, message):
+        """v2 has frame types where v1 has chat commands"""
+        if message.startswith('/join '):
+            return protocol.encode_v2(protocol.JOIN, message[len('/join '):].encode('utf-8'))
+
+        if message.strip() == '/leave':
+            return protocol.encode_v2(protocol.LEAVE)
+
+        if message.startswith('/msg '):
+            recipient, _, text = message[len('/msg '):].partition(' ')
+            return protocol.encode_direct(recipient.encode('utf-8'), text.encode('utf-8'))
+
+        if message.strip() == '/who':
+            return protocol.encode_v2(protocol.WHO)
+
+        return protocol.encode_v2(protocol.MESSAGE, message.encode('utf-8'))
+
+    def queue(self, frame):
+        """deque.append is atomic, so callers on other threads never take a lock"""
+        self.send_queue.append(frame)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            """A wakeup is already pending, or the loop has finished"""
+
+    def close(self):
+        """Stops the loop from any thread; the loop closes the socket on its way out"""
+        self.closed = True
+        self.wake()
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        try:
+            while not self.closed:
+                for key, events in self.selector.select():
+                    if key.fileobj is self.wakeup_receiver:
+                        self.drain_wakeups()
+                        continue
+
+                    if events & selectors.EVENT_WRITE:
+                        self.flush()
+
+                    if events & selectors.EVENT_READ and not self.receive():
+                        self.closed = True
+
+        except OSError:
+            """Reported through on_disconnect below"""
+
+        finally:
+            self.shutdown()
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.send_queue:
+            self.outbound.push(self.send_queue.popleft())
+
+        self.flush()
+
+    def flush(self):
+        self.outbound.flush_to(self.socket)
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if len(self.outbound) else selectors.EVENT_READ
+        self.selector.modify(self.socket, events)
+
+    def receive(self):
+        """Returns False once the server has closed the connection"""
+        try:
+            if self.decoder.receive_from(self.socket) == 0:
+                return False
+        except BlockingIOError:
+            return True
+
+        for frame in self.decoder.frames():
+            if self.version == 2:
+                self.handle_v2_frame(frame)
+            else:
+                self.handle_frame(frame['data'])
+
+        return True
+
+    def handle_frame(self, data):
+        """Before login the server answers each username with one frame. After it, every message is a
+        sender username frame followed by the message frame"""
+        if self.username is None:
+            reply = data.decode('utf-8').strip()
+
+            if reply == USERNAME_ACCEPTED_MESSAGE:
+                self.username = self.requested_username
+                self.on_username_accepted(self.username)
+            else:
+                self.on_username_rejected(reply)
+            return
+
+        if self.sender is None:
+            self.sender = data.decode('utf-8').strip()
+            return
+
+        sender, self.sender = self.sender, None
+        self.on_message(sender, data.decode('utf-8', errors='replace'))
+
+    def handle_v2_frame(self, frame):
+        """Messages carry their sender's client id, which the roster maps to a username"""
+        frame_type = frame['type']
+        text = frame['data'].decode('utf-8', errors='replace')
+
+        if frame_type == protocol.HELLO:
+            self.accepted_features = protocol.decode_hello(frame)[1]
+
+        elif frame_type == protocol.ACCEPTED:
+            self.username = self.requested_username
+            self.on_username_accepted(self.username)
+
+        elif frame_type == protocol.REJECTED and self.username is None:
+            self.on_username_rejected(text)
+
+        elif frame_type == protocol.MESSAGE:
+            self.on_message(self.users.get(frame['sender'], CHATBOT_NAME), text)
+
+        elif frame_type == protocol.DIRECT:
+            self.on_message(self.users.get(frame['sender'], CHATBOT_NAME), DIRECT_PREFIX + text)
+
+        elif frame_type == protocol.HISTORY:
+            _, username, data = history_store.decode_history(frame)
+            self.on_message(username.decode('utf-8', errors='replace'), data.decode('utf-8', errors='replace'))
+
+        elif frame_type == protocol.USER_JOINED:
+            self.users[frame['sender']] = text
+
+        elif frame_type == protocol.USER_LEFT:
+            self.users.pop(frame['sender'], None)
+
+        elif frame_type == protocol.WHO:
+            """The end of the roster the server sent in answer to /who"""
+            online = sorted(set(self.users.values()) | {self.username})
+            self.on_message(CHATBOT_NAME, 'Online: ' + ', '.join(online))
+
+        elif frame_type == protocol.PING:
+            self.queue(protocol.encode_v2(protocol.PONG))
+
+        elif frame_type in NOTICES:
+            self.on_message(CHATBOT_NAME, f'You are now in room {text}' if frame_type == protocol.JOIN else text)
+
+    def shutdown(self):
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+
+        if self.socket is not None:
+            self.socket.close()
+
+        self.on_disconnect()
@@ -0,0 +1,127 @@
+import collections
+import concurrent.futures
+import queue
+import socket
+import threading
+import time
+
+import metrics
+
+
+class DatabasePool:
+    """Bounded set of database connections used from a small executor, off the event loop thread.
+
+    submit() runs operation(connection, *args) on a worker thread. The outcome is queued and the loop is
+    woken through a socketpair; run_completions() then calls callback(result, error) on the loop thread,
+    so continuations never race with the rest of the server. Wait for a free connection and time spent
+    in the operation are recorded per call.
+    """
+
+    def __init__(self, connect, size=4, workers=4):
+        self.connect = connect
+        self.size = size
+        self.created = 0
+        self.idle = queue.LifoQueue()
+        self.create_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        self.completions = collections.deque()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.wait_time = metrics.Histogram()
+        self.query_time = metrics.Histogram()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.create_lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                return self.connect()
+            except Exception:
+                with self.create_lock:
+                    self.created -= 1
+                raise
+
+        return self.idle.get()
+
+    def release(self, connection, broken=False):
+        if not broken:
+            self.idle.put(connection)
+            return
+
+        connection.close()
+        with self.create_lock:
+            self.created -= 1
+
+    def submit(self, operation, *args, callback=None):
+        self.executor.submit(self.execute, operation, args, callback)
+
+    def execute(self, operation, args, callback):
+        started = time.perf_counter()
+        result = error = None
+
+        try:
+            connection = self.acquire()
+        except Exception as e:
+            self.complete(callback, None, e, time.perf_counter() - started, 0.0)
+            return
+
+        acquired = time.perf_counter()
+
+        try:
+            result = operation(connection, *args)
+            self.release(connection)
+        except Exception as e:
+            error = e
+            try:
+                connection.rollback()
+                self.release(connection)
+            except Exception:
+                self.release(connection, broken=True)
+
+        self.complete(callback, result, error, acquired - started, time.perf_counter() - acquired)
+
+    def complete(self, callback, result, error, wait, latency):
+        self.completions.append((callback, result, error, wait, latency))
+
+        try:
+            self.wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            """The loop already has a wakeup pending"""
+
+    def run_completions(self):
+        """Call from the event loop thread when wakeup_receiver is readable"""
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.completions:
+            callback, result, error, wait, latency = self.completions.popleft()
+            self.wait_time.observe(wait)
+            self.query_time.observe(latency)
+
+            if callback is not None:
+                callback(result, error)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.run_completions()
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
@@ -0,0 +1,136 @@
+"""Diagnostics switched on and off in a running server, from a signal or an admin command.
+
+Each hook writes what it collected as a file in the log directory and returns a one line summary,
+which the admin endpoint sends back and the server logs:
+
+    profile      starts cProfile on the event loop thread; the next call stops it and writes the
+                 stats (.prof, for pstats or snakeviz) with the top functions by cumulative time
+    tracemalloc  starts tracing allocations; every later call takes a snapshot and writes the top
+                 lines by growth since the previous one. tracemalloc-stop ends tracing
+    phases       starts timing the event loop phases; the next call writes where the time went
+"""
+import collections
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+DEFAULT_TOP = 25
+TRACEMALLOC_FRAMES = 1
+
+
+class NullPhaseTimer:
+    """Stands in while phase timing is off: measure() only makes the call"""
+    __slots__ = ()
+
+    def measure(self, phase, function, *args):
+        return function(*args)
+
+
+NO_PHASE_TIMER = NullPhaseTimer()
+
+
+class PhaseTimer:
+    """Wall time per event loop phase. Times are exclusive: a phase measured inside another, such as
+    a broadcast made while handling a read, is taken out of the outer phase's total"""
+    __slots__ = ('started', 'totals', 'calls', 'nested')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = collections.Counter()
+        self.calls = collections.Counter()
+        self.nested = 0.0
+
+    def measure(self, phase, function, *args):
+        outer, self.nested = self.nested, 0.0
+        start = time.perf_counter()
+
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.totals[phase] += elapsed - self.nested
+            self.calls[phase] += 1
+            self.nested = outer + elapsed
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        lines = [f'{elapsed:.3f}s timed, {sum(self.totals.values()) / elapsed * 100:.1f}% of it in the phases below',
+                 f'{"phase":<12}{"calls":>12}{"total s":>12}{"mean us":>12}{"share %":>10}']
+
+        for phase, total in self.totals.most_common():
+            calls = self.calls[phase]
+            lines.append(f'{phase:<12}{calls:>12}{total:>12.3f}{total / calls * 1e6:>12.1f}{total / elapsed * 100:>10.1f}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class Diagnostics:
+    """The profiling and allocation hooks of one server process, writing into directory"""
+
+    def __init__(self, directory, name, top=DEFAULT_TOP):
+        self.directory = directory
+        self.name = name
+        self.top = top
+        self.profiler = None
+        self.snapshot = None
+
+    def path(self, kind, extension):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{self.name}-{os.getpid()}-{kind}-{stamp}.{extension}')
+
+    def write(self, kind, text):
+        path = self.path(kind, 'txt')
+        with open(path, 'w') as report:
+            report.write(text)
+
+        return path
+
+    def toggle_profile(self):
+        """cProfile only sees the thread that enables it, so call this from the event loop thread"""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return 'profiling started'
+
+        self.profiler.disable()
+        profiler, self.profiler = self.profiler, None
+        stats_path = self.path('profile', 'prof')
+        profiler.dump_stats(stats_path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(self.top)
+        return f'profiling stopped, wrote {stats_path} and {self.write("profile", summary.getvalue())}'
+
+    def snapshot_allocations(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            return 'tracemalloc started; the next snapshot is compared with this one'
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'traced {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB; top {self.top} by growth']
+        lines.extend(str(difference) for difference in snapshot.compare_to(self.snapshot, 'lineno')[:self.top])
+        self.snapshot = snapshot
+        path = self.write('tracemalloc', '\n'.join(lines) + '\n')
+        return f'wrote {path}'
+
+    def stop_allocations(self):
+        self.snapshot = None
+
+        if not tracemalloc.is_tracing():
+            return 'tracemalloc was not running'
+
+        tracemalloc.stop()
+        return 'tracemalloc stopped'
+
+    def close(self):
+        """Writes out a profile that is still running, so it is not lost on shutdown"""
+        if self.profiler is not None:
+            return self.toggle_profile()
+
+        return None
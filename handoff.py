@@ -0,0 +1,136 @@
+import array
+import base64
+import json
+import os
+import selectors
+import socket
+import struct
+
+"""Descriptors passed per message; the kernel refuses more than 253 in one SCM_RIGHTS message"""
+MAX_FDS_PER_MESSAGE = 250
+"""Each message: descriptors attached to it, then the length of the JSON state that follows (0 until the last)"""
+HANDOFF_HEADER = struct.Struct('!II')
+SEND_TIMEOUT = 30.0
+
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+def send_state(sock, state, fds):
+    """Sends the descriptors in batches of MAX_FDS_PER_MESSAGE, then state as JSON. state refers to
+    descriptors by their index in fds"""
+    for start in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        batch = fds[start:start + MAX_FDS_PER_MESSAGE]
+        sock.sendmsg(
+            [HANDOFF_HEADER.pack(len(batch), 0)],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', batch))]
+        )
+
+    body = json.dumps(state).encode('utf-8')
+    sock.sendall(HANDOFF_HEADER.pack(0, len(body)) + body)
+
+
+def receive_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError('handoff ended early')
+        data += chunk
+
+    return bytes(data)
+
+
+def receive_state(sock):
+    """Returns (state, fds) as sent by send_state"""
+    fds = []
+    ancillary_size = socket.CMSG_SPACE(MAX_FDS_PER_MESSAGE * array.array('i').itemsize)
+
+    while True:
+        """A message's descriptors arrive with its first byte, and a read never runs past them"""
+        header, ancillary, flags, _ = sock.recvmsg(HANDOFF_HEADER.size, ancillary_size)
+        if not header:
+            raise ConnectionError('handoff ended early')
+
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                received = array.array('i')
+                received.frombytes(data[:len(data) - len(data) % received.itemsize])
+                fds.extend(received)
+
+        if flags & socket.MSG_CTRUNC:
+            raise ConnectionError('handoff descriptors were truncated')
+
+        header += receive_exactly(sock, HANDOFF_HEADER.size - len(header))
+        _, body_length = HANDOFF_HEADER.unpack(header)
+
+        if body_length:
+            return json.loads(receive_exactly(sock, body_length).decode('utf-8')), fds
+
+
+def adopt_socket(fd):
+    """Socket object for a received client descriptor; family and type are read from the descriptor"""
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(False)
+    return sock
+
+
+def take_over(path):
+    """Asks the process listening on path to hand over its sockets. Returns (state, fds), or None if
+    no process is listening there"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    try:
+        return receive_state(sock)
+    finally:
+        sock.close()
+
+
+class HandoffEndpoint:
+    """Unix socket on which a running server waits for its replacement.
+
+    A new process started with the same path connects, and the running server answers by sending its
+    listening socket and every client socket with the state needed to carry on (see send_state). The
+    path is unlinked as soon as a replacement connects, so that it can listen there for the next one.
+    """
+
+    def __init__(self, path, selector):
+        self.path = path
+        self.selector = selector
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self)
+
+    def accept(self):
+        """Returns the replacement's socket, blocking with a timeout for the transfer, or None"""
+        try:
+            successor, _ = self.listener.accept()
+        except BlockingIOError:
+            return None
+
+        successor.settimeout(SEND_TIMEOUT)
+        return successor
+
+    def close(self):
+        self.selector.unregister(self.listener)
+        self.listener.close()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
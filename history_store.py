@@ -0,0 +1,287 @@
+import bisect
+import collections
+import mmap
+import os
+import struct
+
+import protocol
+
+"""One index entry per message: segment offset, then the v1 and v2 frame lengths. The two frames
+are stored back to back, so a message is one contiguous slice of its segment"""
+INDEX_ENTRY = struct.Struct('!QII')
+"""HISTORY frame payload: message id and username length, then the username and the message"""
+HISTORY_ENTRY = struct.Struct('!IB')
+"""HISTORY_REQUEST frame payload: first message id and how many messages to read"""
+HISTORY_REQUEST = struct.Struct('!II')
+
+DEFAULT_RECENT = 50
+DEFAULT_SEGMENT_ENTRIES = 64 * 1024
+DEFAULT_MAX_OPEN_ROOMS = 256
+"""An open room holds its active segment's file for appending and one for reading, plus the descriptor
+mmap keeps for its index: the index file itself is closed once mapped, but mmap holds a duplicate"""
+DESCRIPTORS_PER_ROOM = 3
+MAX_RANGE_READ = 500
+
+
+def encode_history_frames(message_id, sender_id, username, data):
+    """Returns (v1 frame, v2 frame) for a message, encoded once when it is stored"""
+    v1_frame = b''.join((protocol.encode_header(len(username)), username, protocol.encode_header(len(data)), data))
+    v2_frame = protocol.encode_v2(
+        protocol.HISTORY, HISTORY_ENTRY.pack(message_id, len(username)) + username + data, sender=sender_id
+    )
+    return v1_frame, v2_frame
+
+
+def decode_history(frame):
+    """Returns (message_id, username, data) from a v2 HISTORY frame"""
+    message_id, username_length = HISTORY_ENTRY.unpack_from(frame['data'])
+    username_end = HISTORY_ENTRY.size + username_length
+    return message_id, frame['data'][HISTORY_ENTRY.size:username_end], frame['data'][username_end:]
+
+
+class Segment:
+    """An append-only file of frames plus a preallocated, memory-mapped index of fixed size entries.
+    Entry n describes message first_id + n; an entry with a zero v1 length has not been written"""
+
+    def __init__(self, directory, first_id, entries, writable):
+        self.first_id = first_id
+        self.entries = entries
+        self.path = os.path.join(directory, f'{first_id:016d}.seg')
+        index_path = os.path.join(directory, f'{first_id:016d}.idx')
+
+        if writable and not os.path.exists(index_path):
+            with open(index_path, 'wb') as index_file:
+                index_file.truncate(entries * INDEX_ENTRY.size)
+
+        with open(index_path, 'r+b' if writable else 'rb') as index_file:
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        self.count = self.written_entries()
+        self.file = open(self.path, 'ab') if writable else None
+        self.reader = os.open(self.path, os.O_RDONLY | os.O_CREAT)
+
+        if writable:
+            self.recover()
+
+    def entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)
+
+    def written_entries(self):
+        """Entries are written in order, so the first empty one is found by bisection"""
+        low, high = 0, len(self.index) // INDEX_ENTRY.size
+
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[1]:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def end_of(self, position):
+        offset, v1_length, v2_length = self.entry(position)
+        return offset + v1_length + v2_length
+
+    def end(self):
+        return self.end_of(self.count - 1) if self.count else 0
+
+    def recover(self):
+        """Drops index entries whose frames never reached the file, then any bytes past the last
+        indexed frame, so a crash mid-append leaves a consistent segment"""
+        size = os.fstat(self.reader).st_size
+
+        while self.count and self.end() > size:
+            self.count -= 1
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, 0, 0, 0)
+
+        if size > self.end():
+            self.file.truncate(self.end())
+
+    def full(self):
+        return self.count >= self.entries
+
+    def append(self, v1_frame, v2_frame):
+        offset = self.end()
+        self.file.write(v1_frame)
+        self.file.write(v2_frame)
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, offset, len(v1_frame), len(v2_frame))
+        self.count += 1
+
+    def read(self, first_id, last_id):
+        """Returns [(v1 frame, v2 frame)] for the ids held here, with a single pread"""
+        first = max(first_id - self.first_id, 0)
+        last = min(last_id - self.first_id, self.count)
+
+        if first >= last:
+            return []
+
+        if self.file is not None:
+            self.file.flush()
+
+        start = self.entry(first)[0]
+        data = memoryview(os.pread(self.reader, self.end_of(last - 1) - start, start))
+        frames = []
+
+        for position in range(first, last):
+            offset, v1_length, v2_length = self.entry(position)
+            v1_start = offset - start
+            v2_start = v1_start + v1_length
+            frames.append((bytes(data[v1_start:v2_start]), bytes(data[v2_start:v2_start + v2_length])))
+
+        return frames
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+        self.index.close()
+        os.close(self.reader)
+
+
+class RoomLog:
+    """History of one room: segment files in the room's directory, with the newest messages also
+    kept in a ring buffer so join-time replay never touches the disk"""
+
+    def __init__(self, directory, recent=DEFAULT_RECENT, segment_entries=DEFAULT_SEGMENT_ENTRIES):
+        self.directory = directory
+        self.segment_entries = segment_entries
+        os.makedirs(directory, exist_ok=True)
+
+        self.first_ids = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx'))
+        if not self.first_ids:
+            self.first_ids.append(1)
+
+        self.active = Segment(directory, self.first_ids[-1], segment_entries, writable=True)
+        self.next_id = self.active.first_id + self.active.count
+        self.ring = collections.deque(maxlen=recent)
+        first_recent = max(self.next_id - recent, 1)
+        self.ring.extend(zip(range(first_recent, self.next_id), self.read_segments(first_recent, self.next_id)))
+
+    def append(self, sender_id, username, data):
+        if self.active.full():
+            self.active.close()
+            self.first_ids.append(self.next_id)
+            self.active = Segment(self.directory, self.next_id, self.segment_entries, writable=True)
+
+        message_id = self.next_id
+        frames = encode_history_frames(message_id, sender_id, username, data)
+        self.active.append(*frames)
+        self.ring.append((message_id, frames))
+        self.next_id += 1
+        return message_id
+
+    def recent(self, version):
+        return [frames[version - 1] for _, frames in self.ring]
+
+    def read_range(self, first_id, count, version):
+        """Frames for messages first_id to first_id + count - 1 that exist, oldest first"""
+        first_id = max(first_id, 1)
+        last_id = min(first_id + min(count, MAX_RANGE_READ), self.next_id)
+
+        if first_id >= last_id:
+            return []
+
+        if self.ring and first_id >= self.ring[0][0]:
+            frames = [frames for message_id, frames in self.ring if first_id <= message_id < last_id]
+        else:
+            frames = self.read_segments(first_id, last_id)
+
+        return [frame[version - 1] for frame in frames]
+
+    def read_segments(self, first_id, last_id):
+        frames = []
+        position = max(bisect.bisect_right(self.first_ids, first_id) - 1, 0)
+
+        for segment_first_id in self.first_ids[position:]:
+            if segment_first_id >= last_id:
+                break
+
+            if segment_first_id == self.active.first_id:
+                frames.extend(self.active.read(first_id, last_id))
+                continue
+
+            segment = Segment(self.directory, segment_first_id, self.segment_entries, writable=False)
+            try:
+                frames.extend(segment.read(first_id, last_id))
+            finally:
+                segment.close()
+
+        return frames
+
+    def flush(self):
+        self.active.flush()
+
+    def close(self):
+        self.active.close()
+
+
+class HistoryStore:
+    """Message history for every room, one directory per room under directory.
+
+    Messages are appended as already encoded v1 and v2 frames, so replaying them is a matter of
+    queueing bytes. A room's files are created by its first message, so joining or reading a room
+    that never had one leaves nothing on disk. Rooms are opened on first use; past max_open_rooms
+    the least recently used room's files are closed. Reopening a room maps its index and reads its
+    recent messages back into the ring buffer on the event loop thread, so max_open_rooms should
+    cover the rooms that are active at once: set too low for many small busy rooms, every message
+    pays for a reopen.
+    """
+
+    def __init__(self, directory, recent=DEFAULT_RECENT, segment_entries=DEFAULT_SEGMENT_ENTRIES,
+                 max_open_rooms=DEFAULT_MAX_OPEN_ROOMS):
+        self.directory = directory
+        self.recent_count = recent
+        self.segment_entries = segment_entries
+        self.max_open_rooms = max_open_rooms
+        self.rooms = collections.OrderedDict()
+
+    def room_log(self, room, create=False):
+        """The room's log, opened if need be. None for a room with no history on disk unless create"""
+        log = self.rooms.get(room)
+
+        if log is not None:
+            self.rooms.move_to_end(room)
+            return log
+
+        """Room names come from clients, so the directory name is the hex of the name, never the name"""
+        directory = os.path.join(self.directory, room.encode('utf-8').hex())
+        if not create and not os.path.isdir(directory):
+            return None
+
+        log = RoomLog(directory, self.recent_count, self.segment_entries)
+        self.rooms[room] = log
+
+        if len(self.rooms) > self.max_open_rooms:
+            _, oldest = self.rooms.popitem(last=False)
+            oldest.close()
+
+        return log
+
+    def append(self, room, sender_id, username, data):
+        """Stores a message and returns its id within the room"""
+        return self.room_log(room, create=True).append(sender_id, username, data)
+
+    def recent(self, room, version):
+        """The last messages of the room as frames for the given protocol version"""
+        log = self.room_log(room)
+        return log.recent(version) if log is not None else []
+
+    def read_range(self, room, first_id, count, version):
+        log = self.room_log(room)
+        return log.read_range(first_id, count, version) if log is not None else []
+
+    def flush(self):
+        for log in self.rooms.values():
+            log.flush()
+
+    def close(self):
+        for log in self.rooms.values():
+            log.close()
+
+        self.rooms.clear()
@@ -0,0 +1,325 @@
+"""Headless load generator: many v1 clients that log in, optionally spread over rooms, and send at a
+fixed total rate while measuring end-to-end latency from send to delivery.
+
+Every message carries the run's nonce and its send time (CLOCK_MONOTONIC, shared by all processes
+on the host), so each recipient can compute the latency of each delivery without coordination.
+
+    python3 load_generator.py 127.0.0.1 1234 --connections 2000 --rooms 20 --rate 2000 --duration 10
+"""
+import argparse
+import errno
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import socket
+import time
+
+import metrics
+import outbound_queue
+import protocol
+
+"""Log spaced from 10us to 30s, so p999 is read from a bucket no wider than 10%"""
+LATENCY_BUCKETS = tuple(0.00001 * 1.1 ** n for n in range(158))
+USERNAME_ACCEPTED_MESSAGE = b'Username assigned to you'
+ROOM_JOINED_MESSAGE = b'You are now in room'
+MAX_PENDING_HANDSHAKES = 256
+
+CONNECTING, LOGGING_IN, JOINING, READY = range(4)
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class LoadClient:
+    """One simulated user"""
+
+    def __init__(self, number, username, room, receive_chunk=None):
+        self.number = number
+        self.username = username
+        self.room = room
+        self.socket = None
+        self.state = CONNECTING
+        self.decoder = protocol.FrameDecoder(chunk=receive_chunk)
+        self.outbound = outbound_queue.OutboundQueue(1 << 30)
+        self.sender = None
+
+
+class LoadGenerator:
+    """Drives a share of the clients from one process with a selectors loop"""
+
+    def __init__(self, address, numbers, nonce, rooms, message_size):
+        self.address = address
+        self.nonce = nonce
+        self.message_size = message_size
+        self.selector = selectors.DefaultSelector()
+        """Every client reads through one chunk; the loop copies each read out of it straight away"""
+        receive_chunk = memoryview(bytearray(protocol.RECEIVE_CHUNK_SIZE))
+        self.clients = [LoadClient(number, f'lg{nonce}_{number}'.encode('utf-8'), number % rooms, receive_chunk)
+                        for number in numbers]
+        self.rooms = rooms
+        self.latency = metrics.Histogram(LATENCY_BUCKETS)
+        self.measuring_since = None
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.ready = 0
+        self.pending = 0
+
+    def connect(self, client):
+        client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.socket.setblocking(False)
+        client.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.socket.connect_ex(self.address)
+        self.selector.register(client.socket, selectors.EVENT_WRITE, client)
+        self.send(client, protocol.encode_frame(client.username))
+        self.pending += 1
+
+    def send(self, client, frame):
+        client.outbound.push(frame)
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            client.outbound.flush_to(client.socket)
+        except OSError as e:
+            if e.errno not in (errno.ENOTCONN, errno.EINPROGRESS):
+                self.fail(client)
+            return
+
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if len(client.outbound) else selectors.EVENT_READ
+        self.selector.modify(client.socket, events, client)
+
+    def fail(self, client):
+        self.errors += 1
+        self.selector.unregister(client.socket)
+        client.socket.close()
+        if client.state != READY:
+            self.pending -= 1
+        client.state = None
+
+    def become_ready(self, client):
+        client.state = READY
+        self.ready += 1
+        self.pending -= 1
+
+    def handle_readable(self, client):
+        try:
+            if client.decoder.receive_from(client.socket) == 0:
+                self.fail(client)
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            self.fail(client)
+            return
+
+        for frame in client.decoder.frames():
+            if client.state == LOGGING_IN or client.state == CONNECTING:
+                if frame['data'] != USERNAME_ACCEPTED_MESSAGE:
+                    self.fail(client)
+                    return
+
+                if self.rooms > 1:
+                    client.state = JOINING
+                    self.send(client, protocol.encode_frame(f'/join load{client.room}'.encode('utf-8')))
+                else:
+                    self.become_ready(client)
+                continue
+
+            """After login every message is a sender username frame followed by the message frame"""
+            if client.sender is None:
+                client.sender = frame['data']
+                continue
+
+            sender, client.sender = client.sender, None
+
+            if client.state == JOINING and sender == b'chatbot' and frame['data'].startswith(ROOM_JOINED_MESSAGE):
+                self.become_ready(client)
+                continue
+
+            self.record_delivery(frame['data'])
+
+    def record_delivery(self, data):
+        """Ignores history replayed from earlier runs and anything sent before measuring started"""
+        fields = data.split(b' ', 2)
+        if len(fields) < 2 or fields[0] != self.nonce.encode('utf-8'):
+            return
+
+        sent_ns = int(fields[1])
+        if self.measuring_since is None or sent_ns < self.measuring_since:
+            return
+
+        self.received += 1
+        self.latency.observe((time.monotonic_ns() - sent_ns) / 1e9)
+
+    def message(self):
+        body = f'{self.nonce} {time.monotonic_ns()} '.encode('utf-8')
+        return protocol.encode_frame(body.ljust(self.message_size, b'x'))
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            if client.state is None:
+                continue
+
+            if client.state == CONNECTING and events & selectors.EVENT_WRITE:
+                client.state = LOGGING_IN
+
+            if events & selectors.EVENT_WRITE:
+                self.flush(client)
+
+            if events & selectors.EVENT_READ and client.state is not None:
+                self.handle_readable(client)
+
+    def log_in(self, timeout):
+        """Connects every client, at most MAX_PENDING_HANDSHAKES at a time so the listen backlog
+        never overflows. Returns the seconds it took"""
+        started = time.monotonic()
+        waiting = iter(self.clients)
+        remaining = len(self.clients)
+
+        while (remaining or self.pending) and time.monotonic() - started < timeout:
+            while remaining and self.pending < MAX_PENDING_HANDSHAKES:
+                self.connect(next(waiting))
+                remaining -= 1
+
+            self.poll(0.05)
+
+        return time.monotonic() - started
+
+    def run(self, rate, duration, warmup):
+        """Sends rate messages per second in total, round robin over the ready clients"""
+        senders = [client for client in self.clients if client.state == READY]
+        started = time.monotonic()
+        measure_at = started + warmup
+        end = measure_at + duration
+        due = 0
+
+        while senders:
+            now = time.monotonic()
+            if now >= end:
+                break
+
+            if self.measuring_since is None and now >= measure_at:
+                self.measuring_since = time.monotonic_ns()
+
+            target = int((now - started) * rate)
+            while due < target:
+                client = senders[due % len(senders)]
+                if client.state == READY:
+                    self.send(client, self.message())
+                    if self.measuring_since is not None:
+                        self.sent += 1
+                due += 1
+
+            self.poll(min(0.001, end - now))
+
+        """Let in-flight deliveries land before counting"""
+        drain_until = time.monotonic() + 1.0
+        while time.monotonic() < drain_until:
+            self.poll(0.05)
+
+    def close(self):
+        for client in self.clients:
+            if client.socket is not None:
+                client.socket.close()
+
+        self.selector.close()
+
+
+def run_share(address, numbers, nonce, options, results):
+    generator = LoadGenerator(address, numbers, nonce, options['rooms'], options['message_size'])
+    login_time = generator.log_in(options['login_timeout'])
+    options['barrier'].wait()
+    generator.run(options['rate'] * len(numbers) / options['connections'], options['duration'], options['warmup'])
+    results.put({
+        'ready': generator.ready,
+        'errors': generator.errors,
+        'sent': generator.sent,
+        'received': generator.received,
+        'login_time': login_time,
+        'latency_counts': generator.latency.counts,
+        'latency_sum': generator.latency.sum,
+    })
+    generator.close()
+
+
+def run(address, connections=100, rooms=1, rate=100.0, duration=10.0, warmup=2.0, message_size=64,
+        processes=1, login_timeout=60.0):
+    """Runs one load test against a server that is already listening and returns a results dict"""
+    raise_open_file_limit()
+    nonce = os.urandom(3).hex()
+    processes = max(1, min(processes, connections))
+    results = multiprocessing.Queue()
+    options = {
+        'connections': connections, 'rooms': rooms, 'rate': rate, 'duration': duration, 'warmup': warmup,
+        'message_size': max(message_size, 32), 'login_timeout': login_timeout,
+        'barrier': multiprocessing.Barrier(processes),
+    }
+    workers = [
+        multiprocessing.Process(target=run_share, args=(address, range(share, connections, processes), nonce, options, results))
+        for share in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    shares = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    latency = metrics.Histogram(LATENCY_BUCKETS)
+    for share in shares:
+        latency.counts = [total + count for total, count in zip(latency.counts, share['latency_counts'])]
+        latency.sum += share['latency_sum']
+    latency.count = sum(latency.counts)
+
+    sent = sum(share['sent'] for share in shares)
+    received = sum(share['received'] for share in shares)
+    return {
+        'connections': connections,
+        'ready': sum(share['ready'] for share in shares),
+        'errors': sum(share['errors'] for share in shares),
+        'login_seconds': max(share['login_time'] for share in shares),
+        'sent_per_second': sent / duration,
+        'delivered_per_second': received / duration,
+        'p50_ms': latency.quantile(0.5) * 1000,
+        'p99_ms': latency.quantile(0.99) * 1000,
+        'p999_ms': latency.quantile(0.999) * 1000,
+        'mean_ms': (latency.sum / latency.count * 1000) if latency.count else 0.0,
+    }
+
+
+def format_results(results):
+    return (f'{results["ready"]}/{results["connections"]} connected in {results["login_seconds"]:.2f}s, '
+            f'{results["errors"]} errors\n'
+            f'sent {results["sent_per_second"]:.0f} msg/s, delivered {results["delivered_per_second"]:.0f} msg/s\n'
+            f'latency p50 {results["p50_ms"]:.2f}ms  p99 {results["p99_ms"]:.2f}ms  '
+            f'p999 {results["p999_ms"]:.2f}ms  mean {results["mean_ms"]:.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='load-generator', description='Headless v1 load generator for chat_server')
+    parser.add_argument('IP', nargs='?', default='127.0.0.1')
+    parser.add_argument('PORT', nargs='?', default=1234, type=int)
+    parser.add_argument('--connections', default=1000, type=int, help='number of simulated clients')
+    parser.add_argument('--rooms', default=1, type=int, help='clients are spread evenly over this many rooms')
+    parser.add_argument('--rate', default=1000.0, type=float, help='messages sent per second, over all clients')
+    parser.add_argument('--duration', default=10.0, type=float, help='seconds measured')
+    parser.add_argument('--warmup', default=2.0, type=float, help='seconds of sending before measuring starts')
+    parser.add_argument('--message-size', default=64, type=int, help='message payload bytes, at least 32')
+    parser.add_argument('--processes', default=1, type=int, help='processes sharing the clients')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = run((args.IP, args.PORT), args.connections, args.rooms, args.rate, args.duration, args.warmup,
+                  args.message_size, args.processes)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,79 @@
+import atexit
 import datetime
 import logging
+import logging.handlers
 import os
+import queue
 import time
 
 
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Puts the record on the queue untouched. The stock QueueHandler formats the message in the
+    calling thread; here the listener thread does all the formatting, so logging from the event loop
+    costs building a record and one put"""
+
+    def prepare(self, record):
+        return record
+
+
+class LazyText:
+    """Wraps payload bytes passed as a %-style logging argument, so they are only decoded when a
+    handler actually emits the record"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.decode('utf-8', errors='replace')
+
+
+class Sampler:
+    """Decides which of a stream of events get logged: one in every sample_every, and at most
+    max_per_second of those per second. suppressed counts what was skipped"""
+
+    def __init__(self, sample_every=1, max_per_second=0):
+        self.sample_every = max(sample_every, 1)
+        self.max_per_second = max_per_second
+        self.seen = 0
+        self.window = 0
+        self.window_count = 0
+        self.suppressed = 0
+
+    def allow(self):
+        self.seen += 1
+
+        if self.seen % self.sample_every:
+            self.suppressed += 1
+            return False
+
+        if self.max_per_second:
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window = window
+                self.window_count = 0
+
+            if self.window_count >= self.max_per_second:
+                self.suppressed += 1
+                return False
+
+            self.window_count += 1
+
+        return True
+
+
 class Logger():
-    def __init__(self, file, log_directory='Logs'):
+    def __init__(self, file, log_directory='Logs', queued=False, sample_every=1, max_per_second=0):
         self.stream_handler = None
         self.file_handler = None
+        self.queue_handler = None
+        self.listener = None
+        self.queued = queued
         self.log_directory = log_directory
         self.file = file
         self.logging_logger = logging.getLogger(__name__)
         self.logger = logging.getLogger(self.file)
+        self.sampler = Sampler(sample_every, max_per_second)
 
     def create_new_file(self):
         """Creates a new log file from the current date time stamp and places it inside log directory"""
@@ -55,8 +117,35 @@ class Logger():
             '{asctime} | {levelname:<5} | {module:20}: {funcName:30}: {message}', style='{'
         ))
 
-        self.logger.addHandler(self.stream_handler)
-        self.logger.addHandler(self.file_handler)
+        if not self.queued:
+            self.logger.addHandler(self.stream_handler)
+            self.logger.addHandler(self.file_handler)
+            return
+
+        """Queue mode: the event loop only enqueues records; a background listener thread owns the
+        file and stream handlers and does the formatting and I/O"""
+        record_queue = queue.SimpleQueue()
+        self.queue_handler = RecordQueueHandler(record_queue)
+        self.listener = logging.handlers.QueueListener(
+            record_queue, self.file_handler, self.stream_handler, respect_handler_level=True
+        )
+        self.listener.start()
+        self.logger.addHandler(self.queue_handler)
+        atexit.register(self.close)
+
+    def close(self):
+        """Detaches this instance's handlers; in queue mode, waits for queued records to be written"""
+        for handler in (self.queue_handler, self.stream_handler, self.file_handler):
+            if handler is not None:
+                self.logger.removeHandler(handler)
+
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            atexit.unregister(self.close)
+
+        if self.file_handler is not None:
+            self.file_handler.close()
 
     def toggle_stream_debug(self):
         logger = logging.getLogger(self.file)
@@ -0,0 +1,70 @@
+import bisect
+
+"""Seconds. Spans sub-millisecond loop work up to multi-second DB stalls"""
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+"""Recipients per broadcast"""
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+
+class Histogram:
+    """Fixed bucket histogram. observe() is one bisect and three additions, cheap enough for hot paths.
+    Not locked: observe from one thread only"""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation, inf if it is past the last bucket"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+
+        return float('inf')
+
+    def summary(self):
+        mean = self.sum / self.count if self.count else 0.0
+        return {'count': self.count, 'mean': mean, 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+def render_counter(name, value, kind='counter'):
+    return f'# TYPE {name} {kind}\n{name} {value}\n'
+
+
+def render_histogram(name, histogram):
+    """Prometheus text exposition: cumulative buckets, then sum and count"""
+    lines = [f'# TYPE {name} histogram']
+    cumulative = 0
+
+    for bucket, bucket_count in zip(histogram.buckets, histogram.counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{le="{bucket}"}} {cumulative}')
+
+    lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum {histogram.sum}')
+    lines.append(f'{name}_count {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def render(counters, gauges, histograms, prefix='chat_'):
+    """Text page for an admin scrape. counters and gauges map names to numbers, histograms map names to Histograms"""
+    parts = [render_counter(f'{prefix}{name}_total', value) for name, value in sorted(counters.items())]
+    parts.extend(render_counter(f'{prefix}{name}', value, 'gauge') for name, value in sorted(gauges.items()))
+    parts.extend(render_histogram(f'{prefix}{name}', histogram) for name, histogram in sorted(histograms.items()))
+    return ''.join(parts)
@@ -0,0 +1,79 @@
+import errno
+import itertools
+import os
+
+"""Upper bound on buffers handed to one sendmsg call"""
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
+
+class OutboundQueue:
+    """Bounded buffer of encoded frames waiting for a client socket to become writable.
+
+    Frames are held as-is and only sliced (via memoryview) when a send is partial, so nothing is
+    lost or reordered when a non-blocking send returns short or raises EAGAIN. The same frame object
+    can sit in many queues at once; a broadcast never copies it per recipient. When several frames
+    are queued they are written with one scatter/gather sendmsg instead of being joined. Frames are
+    kept in a list rather than a deque: an empty deque costs 760 bytes on every idle connection, and
+    written frames are dropped with one slice deletion per flush rather than one pop per frame.
+    """
+    __slots__ = ('high_water_mark', 'frames', 'size')
+
+    def __init__(self, high_water_mark):
+        self.high_water_mark = high_water_mark
+        self.frames = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, frame):
+        """Queues a frame. Returns False without queueing if it would take the buffer past the high-water mark"""
+        if self.size + len(frame) > self.high_water_mark:
+            return False
+
+        self.frames.append(frame)
+        self.size += len(frame)
+        return True
+
+    def flush_to(self, socket):
+        """Sends as much as the socket accepts. Returns the number of bytes written; socket errors other
+        than EAGAIN/EWOULDBLOCK are raised to the caller"""
+        written = 0
+
+        while self.frames:
+            try:
+                if len(self.frames) == 1 or not hasattr(socket, 'sendmsg'):
+                    sent = socket.send(self.frames[0])
+                else:
+                    sent = socket.sendmsg(itertools.islice(self.frames, IOV_MAX))
+            except IOError as e:
+                if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
+                    break
+                raise
+
+            written += sent
+            self.size -= sent
+
+            if not sent or not self.consume(sent):
+                break
+
+        return written
+
+    def consume(self, sent):
+        """Drops fully written frames. Returns False if a frame was only partly written"""
+        written = 0
+
+        for frame in self.frames:
+            if sent < len(frame):
+                break
+
+            sent -= len(frame)
+            written += 1
+
+        del self.frames[:written]
+
+        if sent:
+            self.frames[0] = memoryview(self.frames[0])[sent:]
+            return False
+
+        return True
@@ -0,0 +1,229 @@
+import struct
+import zlib
+
+HEADER_LENGTH = 16
+RECEIVE_CHUNK_SIZE = 64 * 1024
+MAX_FRAME_LENGTH = 1024 * 1024
+
+"""Protocol v2: a fixed binary header of payload length, frame type, flags and sender id. A v2 client
+opens with a HELLO frame, whose first byte (the top byte of the length) is always zero - a v1 header
+starts with an ASCII digit, so the server can tell the two apart from the first byte it receives"""
+PROTOCOL_VERSION = 2
+V2_HEADER = struct.Struct('!IBBI')
+V2_HEADER_LENGTH = V2_HEADER.size
+
+HELLO = 0
+USERNAME = 1
+ACCEPTED = 2
+REJECTED = 3
+MESSAGE = 4
+USER_JOINED = 5
+USER_LEFT = 6
+JOIN = 7
+LEAVE = 8
+HISTORY = 9
+HISTORY_REQUEST = 10
+PING = 11
+PONG = 12
+RATE_LIMITED = 13
+DIRECT = 14
+WHO = 15
+UNDELIVERABLE = 16
+
+"""HELLO feature bits. The client offers features, the server answers with those it accepts"""
+FEATURE_COMPRESSION = 0x01
+"""Frame flag bits"""
+FLAG_COMPRESSED = 0x01
+
+"""Payloads shorter than this are never compressed: the zlib overhead would eat any saving"""
+DEFAULT_COMPRESSION_THRESHOLD = 512
+DEFAULT_COMPRESSION_LEVEL = 1
+
+
+def encode_header(length, header_length=HEADER_LENGTH):
+    return f'{length:<{header_length}}'.encode('utf-8')
+
+
+def encode_frame(data, header_length=HEADER_LENGTH):
+    """Prefixes data with the space padded decimal length header"""
+    return encode_header(len(data), header_length) + data
+
+
+def encode_v2(frame_type, data=b'', sender=0, flags=0):
+    return V2_HEADER.pack(len(data), frame_type, flags, sender) + data
+
+
+def encode_hello(version=PROTOCOL_VERSION, features=0):
+    return encode_v2(HELLO, bytes((version, features)))
+
+
+def encode_direct(recipient, data):
+    """DIRECT from a client: recipient length byte and username, then the message. The server
+    delivers only the message, as a DIRECT frame carrying the sender's id"""
+    return encode_v2(DIRECT, bytes((len(recipient),)) + recipient + data)
+
+
+def decode_direct(payload):
+    """Returns (recipient, data) from a client's DIRECT payload"""
+    length = payload[0] if payload else 0
+    return payload[1:1 + length], payload[1 + length:]
+
+
+def decode_hello(frame):
+    """Returns (version, features) offered or accepted in a HELLO frame. Raises ValueError for a payload
+    too short to hold both"""
+    if len(frame['data']) < 2:
+        raise ValueError('HELLO carries a version and a features byte')
+
+    version, features = frame['data'][:2]
+    return version, features
+
+
+def compress_payload(data, threshold=DEFAULT_COMPRESSION_THRESHOLD, level=DEFAULT_COMPRESSION_LEVEL):
+    """Returns (payload, flags): the zlib compressed payload and FLAG_COMPRESSED if the data is at least
+    threshold bytes long and compression makes it smaller, otherwise the data unchanged and 0"""
+    if len(data) < threshold:
+        return data, 0
+
+    compressed = zlib.compress(data, level)
+    if len(compressed) >= len(data):
+        return data, 0
+
+    return compressed, FLAG_COMPRESSED
+
+
+def decompress_payload(payload, max_length=MAX_FRAME_LENGTH):
+    """Inflates a compressed payload, refusing anything that would expand past max_length"""
+    inflater = zlib.decompressobj()
+    try:
+        data = inflater.decompress(payload, max_length)
+    except zlib.error as e:
+        raise ValueError(f'bad compressed payload: {e}')
+
+    if inflater.unconsumed_tail:
+        raise ValueError(f'compressed payload expands past {max_length} bytes')
+
+    return data
+
+
+def detect_version(decoder):
+    """Looks at the first buffered byte of a new connection: 2 for a v2 HELLO, 1 for a v1 header,
+    None if nothing has arrived yet"""
+    if not len(decoder):
+        return None
+
+    return 2 if decoder.buffer[decoder.offset] == 0 else 1
+
+
+class FrameDecoder:
+    """Incremental decoder for header prefixed frames.
+
+    Bytes are read in large chunks into a reusable memoryview and appended to one growing buffer,
+    so short reads never corrupt the stream and several pipelined frames come out of a single recv.
+    Decoders used from one thread can share a chunk, since every read is copied out of it at once.
+    """
+    __slots__ = ('header_length', 'max_frame_length', 'buffer', 'offset', 'chunk')
+
+    def __init__(self, header_length=HEADER_LENGTH, chunk_size=RECEIVE_CHUNK_SIZE, max_frame_length=MAX_FRAME_LENGTH,
+                 chunk=None):
+        self.header_length = header_length
+        self.max_frame_length = max_frame_length
+        self.buffer = bytearray()
+        self.offset = 0
+        self.chunk = memoryview(bytearray(chunk_size)) if chunk is None else chunk
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def receive_from(self, socket):
+        """Does one recv_into and buffers the result. Returns the byte count, 0 meaning the peer closed.
+        BlockingIOError is left for the caller, exactly like a plain recv"""
+        received = socket.recv_into(self.chunk)
+        self.buffer += self.chunk[:received]
+        return received
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frame_length(self):
+        """Payload length from the header at the current offset"""
+        return int(self.buffer[self.offset:self.offset + self.header_length])
+
+    def make_frame(self, header_end, frame_end):
+        return {'header': bytes(self.buffer[self.offset:header_end]), 'data': bytes(self.buffer[header_end:frame_end])}
+
+    def next_frame(self):
+        """Returns the next complete frame or None if more bytes are needed"""
+        header_end = self.offset + self.header_length
+
+        if len(self.buffer) < header_end:
+            self.compact()
+            return None
+
+        length = self.frame_length()
+
+        if length < 0 or length > self.max_frame_length:
+            raise ValueError(f'frame length {length} out of range')
+
+        frame_end = header_end + length
+
+        if len(self.buffer) < frame_end:
+            self.compact()
+            return None
+
+        frame = self.make_frame(header_end, frame_end)
+        self.offset = frame_end
+        return frame
+
+    def frames(self):
+        """Yields every complete frame currently buffered"""
+        while True:
+            frame = self.next_frame()
+
+            if frame is None:
+                return
+
+            yield frame
+
+    def compact(self):
+        """Drops consumed bytes so the buffer only holds the partial frame"""
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+
+class V2FrameDecoder(FrameDecoder):
+    """Decoder for v2 frames: {'header', 'type', 'flags', 'sender', 'data'}. The length is read with
+    struct straight out of the buffer, no decode or strip. Compressed payloads are inflated here, so
+    'data' is always the original bytes; 'flags' still shows FLAG_COMPRESSED"""
+
+    __slots__ = ()
+
+    def __init__(self, chunk_size=RECEIVE_CHUNK_SIZE, max_frame_length=MAX_FRAME_LENGTH, chunk=None):
+        super().__init__(V2_HEADER_LENGTH, chunk_size, max_frame_length, chunk)
+
+    @classmethod
+    def take_over(cls, decoder):
+        """Continues from a v1 decoder's buffer once a connection turns out to speak v2"""
+        upgraded = cls(max_frame_length=decoder.max_frame_length, chunk=decoder.chunk)
+        upgraded.buffer = decoder.buffer
+        upgraded.offset = decoder.offset
+        return upgraded
+
+    def frame_length(self):
+        return V2_HEADER.unpack_from(self.buffer, self.offset)[0]
+
+    def make_frame(self, header_end, frame_end):
+        _, frame_type, flags, sender = V2_HEADER.unpack_from(self.buffer, self.offset)
+        data = bytes(self.buffer[header_end:frame_end])
+
+        if flags & FLAG_COMPRESSED:
+            data = decompress_payload(data, self.max_frame_length)
+
+        return {
+            'header': bytes(self.buffer[self.offset:header_end]),
+            'type': frame_type,
+            'flags': flags,
+            'sender': sender,
+            'data': data
+        }
@@ -0,0 +1,31 @@
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to burst. Time is passed in by the caller,
+    so one clock read per loop step serves every bucket"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        """Takes amount tokens if they are all there. Returns False, taking nothing, if not"""
+        self.refill(now)
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+    def consume(self, amount, now):
+        """Takes amount tokens even if that leaves the bucket in debt, for work that has already been
+        done such as bytes already read. Returns the seconds until the debt is paid off, 0 if there is none"""
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
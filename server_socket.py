@@ -2,8 +2,56 @@ import socket
 
 
 class Socket(socket.socket):
-    def __init__(self, IP, PORT):
+    def __init__(self, IP, PORT, reuse_port=False, nodelay=True, send_buffer=None, receive_buffer=None,
+                 keepalive_idle=None, fileno=None):
+        self.nodelay = nodelay
+        self.keepalive_idle = keepalive_idle
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+
+        """A listener handed over by a previous process is already bound and listening"""
+        if fileno is not None:
+            super().__init__(fileno=fileno)
+            return
+
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        """Lets several worker processes bind the same port; the kernel spreads new connections across them"""
+        if reuse_port:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        """Set before listen() so the window scale negotiated on accepted connections matches the buffers"""
+        self.set_buffer_sizes(self)
         self.bind((IP, PORT))
         self.listen()
+
+    def set_buffer_sizes(self, sock):
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def accept(self):
+        """Accepted sockets get the configured buffers and TCP_NODELAY: the server batches its own writes,
+        so Nagle would only add latency on top"""
+        client_socket, address = super().accept()
+        self.set_buffer_sizes(client_socket)
+
+        if self.nodelay:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.keepalive_idle:
+            self.set_keepalive(client_socket)
+
+        return client_socket, address
+
+    def set_keepalive(self, sock):
+        """Probes a silent peer after keepalive_idle seconds and drops it after three unanswered probes"""
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(int(self.keepalive_idle), 1))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
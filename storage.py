@@ -0,0 +1,188 @@
+"""Storage engines behind the server's username table.
+
+Every engine offers the same operations, all run on DatabasePool threads:
+
+    prepare(usernames)                         create or adopt the schema, leaving exactly usernames stored
+    connect()                                  a connection for the pool; it needs commit, rollback and close
+    persist_usernames(connection, inserts, deletes)
+                                               apply one coalesced write-behind batch from UsernameRegistry
+
+Message history is not stored here; HistoryStore keeps it on local disk. UsernameRegistry stays the
+source of truth for uniqueness, so a login never waits on any engine.
+"""
+import abc
+import sqlite3
+import threading
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+ENGINES = ('memory', 'sqlite', 'postgres')
+DBNAME = 'chatdb'
+DEFAULT_SQLITE_PATH = 'chat.db'
+
+
+class Storage(abc.ABC):
+    @abc.abstractmethod
+    def prepare(self, usernames=()):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def connect(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def persist_usernames(self, connection, inserts, deletes):
+        raise NotImplementedError
+
+
+class MemoryConnection:
+    """Stands in for a database connection; every pool thread shares the one set of usernames"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    """Keeps the table in this process. Nothing survives a restart, which a single node loses nothing
+    by: usernames are only held while their clients are connected"""
+
+    def __init__(self):
+        self.usernames = set()
+        self.lock = threading.Lock()
+
+    def prepare(self, usernames=()):
+        with self.lock:
+            self.usernames = set(usernames)
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    def persist_usernames(self, connection, inserts, deletes):
+        with self.lock:
+            self.usernames.difference_update(deletes)
+            self.usernames.update(inserts)
+
+
+class SQLiteStorage(Storage):
+    """A local database file in WAL mode, so readers never block the writer. Each batch is one
+    transaction, and synchronous=NORMAL only syncs the log at checkpoints rather than every commit"""
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def prepare(self, usernames=()):
+        connection = self.connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS usernames(username varchar(32) PRIMARY KEY)')
+            connection.execute('DELETE FROM usernames')
+            connection.executemany('INSERT INTO usernames (username) VALUES (?)', [(name,) for name in usernames])
+        connection.close()
+
+    def persist_usernames(self, connection, inserts, deletes):
+        with connection:
+            connection.executemany('DELETE FROM usernames WHERE username=?', [(name,) for name in deletes])
+            connection.executemany('INSERT OR IGNORE INTO usernames (username) VALUES (?)', [(name,) for name in inserts])
+
+
+class PostgresStorage(Storage):
+    """The usernames table in a Postgres database, created on first use and kept across restarts"""
+
+    def __init__(self, dbname=DBNAME, user='rizwan', host='localhost', password='password123'):
+        if psycopg2 is None:
+            raise RuntimeError('the postgres storage engine needs psycopg2: pip install -r requirements.txt')
+
+        self.dbname = dbname
+        self.settings = {'user': user, 'host': host, 'password': password}
+
+    def connect(self):
+        return psycopg2.connect(dbname=self.dbname, **self.settings)
+
+    def create_database(self):
+        root_database_connection = psycopg2.connect(dbname='postgres', **self.settings)
+        root_database_connection.set_session(readonly=False, autocommit=True)
+        cur = root_database_connection.cursor()
+        cur.execute('CREATE DATABASE ' + self.dbname)
+        cur.close()
+        root_database_connection.close()
+
+    def prepare(self, usernames=()):
+        """Creates the database and usernames table the first time; after that the existing schema is
+        kept, so a restart finds the database warm. The table is reset to usernames in one transaction.
+        Any other connection error, such as a refused password, is raised as it is"""
+        try:
+            conn = self.connect()
+        except psycopg2.OperationalError as e:
+            if 'does not exist' not in str(e):
+                raise
+
+            self.create_database()
+            conn = self.connect()
+
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS usernames(username varchar(32))')
+        """A table from before usernames were capped at 32 characters is migrated. It is emptied first,
+        so no longer name stands in the way; for a column that is already varchar(32) this is a no-op"""
+        cur.execute('DELETE FROM usernames')
+        cur.execute('ALTER TABLE usernames ALTER COLUMN username TYPE varchar(32)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS usernames_username_key ON usernames (username)')
+        cur.executemany(
+            'INSERT INTO usernames (username) VALUES (%(username)s)', [{'username': username} for username in usernames]
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    def persist_usernames(self, db_connection, inserts, deletes):
+        """The unique index makes a stray duplicate a no-op"""
+        cur = db_connection.cursor()
+
+        cur.executemany(
+            """
+                DELETE FROM
+                    usernames
+                WHERE
+                    username=%(username)s
+            """, [{'username': username} for username in deletes])
+
+        cur.executemany("""
+            INSERT INTO
+                usernames (username)
+            VALUES
+                (%(username)s)
+            ON CONFLICT (username) DO NOTHING
+        """, [{'username': username} for username in inserts])
+
+        db_connection.commit()
+        cur.close()
+
+
+def create(engine, path=DEFAULT_SQLITE_PATH):
+    """Storage for a --storage choice; path is the SQLite database file"""
+    if engine == 'memory':
+        return MemoryStorage()
+
+    if engine == 'sqlite':
+        return SQLiteStorage(path)
+
+    if engine == 'postgres':
+        return PostgresStorage()
+
+    raise ValueError(f'storage engine must be one of {ENGINES}')
@@ -1,9 +1,24 @@
 import chat_server
+import protocol
+import outbound_queue
+import username_registry
+import history_store
+import client_core
+import timer_wheel
+import handoff
+import db_pool
+import logger
+import worker_bus
+import threading
+import storage
+import sqlite3
+import time
+import asyncio
 import pytest
+import os
 import socket
-import psycopg2
-import select
-import psycopg2.errors
+import struct
+import types
 
 
 HEADER_LENGTH = 16
@@ -12,7 +27,7 @@ HEADER_LENGTH = 16
 def add_client(server):
     client_socket, client_address = server.server_socket.accept()
     client_name = server.read_message(client_socket)
-    server.add_client(client_name, client_socket, client_address)
+    server.add_client(client_name['data'], client_socket, client_address)
     return client_socket
 
 def set_and_send_username(username):
@@ -24,10 +39,52 @@ def set_and_send_username(username):
     return s
 
 
+def pump(server, iterations=5):
+    """Runs a few event loop iterations, long enough for loopback traffic to be handled"""
+    for _ in range(iterations):
+        server.run_once(timeout=0.05)
+
+
+def pump_for(server, seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        server.run_once(timeout=0.05)
+
+
+def drain(s):
+    """Everything the server sent until it goes quiet or closes the socket"""
+    s.settimeout(0.2)
+    data = b''
+    try:
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+    except socket.timeout:
+        return data
+
+
+def v2_frames(s):
+    decoder = protocol.V2FrameDecoder()
+    decoder.feed(drain(s))
+    return list(decoder.frames())
+
+
+def admin_request(server, admin_path, path):
+    """GETs path from the admin endpoint on a Unix socket, running the server until it answers"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as admin:
+        admin.connect(admin_path)
+        admin.send(f'GET {path} HTTP/1.0\r\n\r\n'.encode('ascii'))
+        pump(server)
+        return drain(admin)
+
+
 @pytest.fixture()
 def set_up_server():
     server = chat_server.Server('127.0.0.1', 1234)
-    return server
+    yield server
+    server.close()
 
 
 """Tests"""
@@ -40,7 +97,35 @@ def test_add_client(set_up_server):
         username_header = f'{len(username):<{HEADER_LENGTH}}'.encode('utf-8')
         s.send(username_header + username)
     add_client(set_up_server)
-    assert len(set_up_server.clients) == 1
+    assert len(set_up_server.usernames) == 1
+
+
+"""This tests that a failure handling one peer's input closes only that peer: a v1 username that is
+not UTF-8 is rejected, and an error raised while handling a message drops just its sender."""
+def test_peer_errors_are_isolated(set_up_server, monkeypatch):
+    s1 = socket.create_connection(('127.0.0.1', 1234))
+    s1.send(protocol.encode_frame(b'\xff\xfe'))
+    s2 = set_and_send_username('test_user2')
+    pump(set_up_server)
+    assert chat_server.USERNAME_ENCODING_MESSAGE.encode('utf-8') in drain(s1)
+    assert drain(s2).endswith(b'Username assigned to you')
+
+    def fail(connection, data):
+        raise RuntimeError('handler bug')
+
+    monkeypatch.setattr(set_up_server, 'handle_command', fail)
+    s2.send(protocol.encode_frame(b'/anything'))
+    pump(set_up_server)
+    assert drain(s2) == b''
+    assert set_up_server.counters['connection_errors'] == 1
+    assert not set_up_server.usernames
+
+    s1.send(protocol.encode_frame(b'test_user'))
+    pump(set_up_server)
+    assert drain(s1).endswith(b'Username assigned to you')
+
+    s1.close()
+    s2.close()
 
 
 """This tests the server receiving a message from client socket s1, then broadcasting
@@ -75,19 +160,1158 @@ def test_broadcast_message(set_up_server):
 
 """This tests the server rejecting a duplicate username,"""
 def test_duplicate_username_rejected(set_up_server):
-    db_connection = set_up_server.create_username_database()
+    set_up_server.create_username_database()
     s1 = set_and_send_username('test_user')
     client_socket, client_address = set_up_server.server_socket.accept()
-    _ = chat_server.accept_username(db_connection, client_socket, set_up_server)
-    set_up_server.sockets_list.append(client_socket)
+    set_up_server.register_connection(client_socket, client_address)
+    _ = chat_server.accept_username(client_socket, set_up_server)
 
     s2 = set_and_send_username('test_user')
-    read_sockets, _, exception_sockets = select.select(set_up_server.sockets_list, [], set_up_server.sockets_list)
-    for socket in read_sockets:
-        if socket == set_up_server.server_socket:
+    for key, _ in set_up_server.selector.select():
+        if key.fileobj == set_up_server.server_socket:
             client_socket, client_address = set_up_server.server_socket.accept()
-            _ = chat_server.accept_username(db_connection, client_socket, set_up_server)
+            set_up_server.register_connection(client_socket, client_address)
+            _ = chat_server.accept_username(client_socket, set_up_server)
     message_header = s2.recv(HEADER_LENGTH)
     message_length = int(message_header.decode('utf-8').strip())
     message = s2.recv(message_length).decode('utf-8')
-    assert message == 'Username already taken - please enter another'
\ No newline at end of file
+    assert message == 'Username already taken - please enter another'
+
+"""This tests that a login cut short never leaks its username: a client that resets the connection
+right after sending its name, and a login that fails between the reservation and add_client."""
+def test_interrupted_login_releases_username(set_up_server, monkeypatch):
+    server = set_up_server
+    server.create_username_database()
+
+    s1 = set_and_send_username('test_user')
+    s1.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    s1.close()
+    pump(server)
+    assert 'test_user' not in server.username_registry
+
+    def fail(*args):
+        raise OSError('add_client failed')
+
+    monkeypatch.setattr(server, 'add_client', fail)
+    s2 = set_and_send_username('test_user')
+    pump(server)
+    assert server.counters['connection_errors'] == 1
+    assert 'test_user' not in server.username_registry
+
+    monkeypatch.undo()
+    s3 = set_and_send_username('test_user')
+    pump(server)
+    assert server.usernames[b'test_user'].username == b'test_user'
+
+    s2.close()
+    s3.close()
+
+"""This tests a v1 client that pipelines invalid usernames and never reads the rejections: the
+replies back up in its outbound queue until it is evicted as a slow consumer, and the server
+carries on serving everyone else."""
+def test_pipelined_username_rejects_are_queued(set_up_server):
+    server = set_up_server
+    server.byte_rate = 0
+    server.high_water_mark = 64 * 1024
+
+    flood = socket.create_connection(('127.0.0.1', 1234))
+    flood.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    frames = protocol.encode_frame(b'x') * 100000
+    def send_flood():
+        try:
+            flood.sendall(frames)
+        except OSError:
+            """The server hung up on it"""
+
+    sender = threading.Thread(target=send_flood)
+    sender.start()
+
+    deadline = time.monotonic() + 10
+    while not server.counters['clients_evicted'] and time.monotonic() < deadline:
+        server.run_once(timeout=0.05)
+    assert server.counters['clients_evicted'] == 1
+
+    s1 = set_and_send_username('test_user')
+    pump(server)
+    assert drain(s1).endswith(b'Username assigned to you')
+
+    flood.close()
+    sender.join()
+    s1.close()
+
+
+"""This tests the asyncio mode: both users complete the handshake concurrently and
+a message from one is broadcast to the other."""
+def test_async_broadcast_message(set_up_server):
+    set_up_server.create_username_database()
+
+    async def read_frame(reader):
+        header = await reader.readexactly(HEADER_LENGTH)
+        return (await reader.readexactly(int(header.decode('utf-8').strip()))).decode('utf-8')
+
+    async def connect(username):
+        reader, writer = await asyncio.open_connection('127.0.0.1', 1234)
+        username = username.encode('utf-8')
+        writer.write(f'{len(username):<{HEADER_LENGTH}}'.encode('utf-8') + username)
+        assert await read_frame(reader) == 'Username assigned to you'
+        return reader, writer
+
+    async def scenario():
+        serve_task = asyncio.ensure_future(set_up_server.serve_async())
+        (r1, w1), (r2, w2) = await asyncio.gather(connect('test_user'), connect('test_user2'))
+
+        sent_message = 'sent_message'.encode('utf-8')
+        w2.write(f'{len(sent_message):<{HEADER_LENGTH}}'.encode('utf-8') + sent_message)
+        sender = await read_frame(r1)
+        message = await read_frame(r1)
+
+        w1.close()
+        w2.close()
+        serve_task.cancel()
+        return sender, message
+
+    assert asyncio.run(scenario()) == ('test_user2', 'sent_message')
+
+
+"""This tests that the asyncio mode bounds frame lengths like the selectors decoder: a header
+claiming more than MAX_FRAME_LENGTH ends the read without waiting for the body."""
+def test_async_frame_length_bounded(set_up_server):
+    async def read(length):
+        reader = asyncio.StreamReader()
+        reader.feed_data(f'{length:<{HEADER_LENGTH}}'.encode('utf-8') + b'x' * 10)
+        return await asyncio.wait_for(set_up_server.read_stream_message(reader), 1)
+
+    assert asyncio.run(read(protocol.MAX_FRAME_LENGTH + 1)) is False
+    assert asyncio.run(read(-1)) is False
+    assert asyncio.run(read(10))['data'] == b'x' * 10
+
+
+"""This tests the decoder reassembling a frame split across reads and splitting frames
+that were pipelined into a single read."""
+def test_frame_decoder_partial_and_pipelined_frames():
+    decoder = protocol.FrameDecoder()
+    stream = protocol.encode_frame(b'first') + protocol.encode_frame(b'second') + protocol.encode_frame(b'third')
+
+    decoder.feed(stream[:10])
+    assert list(decoder.frames()) == []
+
+    decoder.feed(stream[10:30])
+    assert [frame['data'] for frame in decoder.frames()] == [b'first']
+
+    decoder.feed(stream[30:])
+    assert [frame['data'] for frame in decoder.frames()] == [b'second', b'third']
+    assert len(decoder) == 0
+
+
+"""This tests the outbound queue refusing frames past its high-water mark and keeping
+the unsent tail of a partial send for the next flush."""
+def test_outbound_queue_backpressure():
+    class ShortWriteSocket:
+        def __init__(self):
+            self.sent = b''
+
+        def send(self, data):
+            chunk = bytes(data[:4])
+            self.sent += chunk
+            return len(chunk)
+
+    queue = outbound_queue.OutboundQueue(high_water_mark=10)
+    assert queue.push(b'abcdef')
+    assert not queue.push(b'ghijkl')
+
+    client = ShortWriteSocket()
+    assert queue.flush_to(client) == 4
+    assert len(queue) == 2
+    assert queue.flush_to(client) == 2
+    assert client.sent == b'abcdef'
+
+
+"""This tests the username registry rejecting a name in use and coalescing the writes
+queued for one name into the single state that reaches the database."""
+def test_username_registry_coalesces_writes():
+    registry = username_registry.UsernameRegistry()
+
+    assert registry.reserve('test_user')
+    assert not registry.reserve('test_user')
+    registry.release('test_user')
+    assert registry.reserve('test_user')
+    assert registry.reserve('test_user2')
+    registry.release('test_user2')
+
+    assert registry.take_batch() == (['test_user'], ['test_user2'])
+    registry.release('test_user')
+    assert registry.take_batch() is None
+
+    registry.batch_done(succeeded=False)
+    assert registry.take_batch() is None
+    assert registry.retry_delay() == username_registry.RETRY_DELAY
+    registry.retry()
+    assert registry.take_batch() == ([], ['test_user', 'test_user2'])
+
+    """Each failure in a row doubles the delay, up to the maximum"""
+    for _ in range(20):
+        registry.batch_done(succeeded=False)
+        registry.retry()
+        registry.take_batch()
+    assert registry.retry_delay() == username_registry.MAX_RETRY_DELAY
+    registry.batch_done(succeeded=True)
+    assert registry.failures == 0
+
+
+"""This tests the database pool's error paths: a failing operation is rolled back and its
+connection reused, and a connection that cannot be made is reported without leaking a slot."""
+def test_database_pool_failures():
+    class Connection:
+        def __init__(self):
+            self.rollbacks = 0
+            self.closed = False
+
+        def rollback(self):
+            self.rollbacks += 1
+
+        def close(self):
+            self.closed = True
+
+    connections = []
+
+    def connect():
+        connections.append(Connection())
+        return connections[-1]
+
+    def persist(connection, fail):
+        if fail:
+            raise RuntimeError('persist failed')
+        return connection
+
+    pool = db_pool.DatabasePool(connect, size=1, workers=1)
+    results = []
+
+    def wait_for(count):
+        deadline = time.monotonic() + 5
+        while len(results) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+            pool.run_completions()
+
+    try:
+        pool.submit(persist, True, callback=lambda result, error: results.append((result, error)))
+        pool.submit(persist, False, callback=lambda result, error: results.append((result, error)))
+        wait_for(2)
+        assert isinstance(results[0][1], RuntimeError)
+        assert results[1] == (connections[0], None)
+        assert len(connections) == 1 and connections[0].rollbacks == 1
+    finally:
+        pool.close()
+
+    def refuse():
+        raise ConnectionError('database is down')
+
+    pool = db_pool.DatabasePool(refuse, size=1, workers=1)
+    results = []
+    try:
+        pool.submit(persist, False, callback=lambda result, error: results.append((result, error)))
+        wait_for(1)
+        assert isinstance(results[0][1], ConnectionError)
+        assert pool.created == 0
+    finally:
+        pool.close()
+
+
+"""This tests write-behind retries: while the storage engine keeps failing, the batch is retried
+from the timer wheel with a growing delay rather than on every loop iteration, and it is written
+once the engine recovers."""
+def test_failed_username_batches_back_off(monkeypatch):
+    class FailingStorage(storage.MemoryStorage):
+        failing = True
+        attempts = 0
+
+        def persist_usernames(self, connection, inserts, deletes):
+            self.attempts += 1
+            if self.failing:
+                raise RuntimeError('storage is down')
+            super().persist_usernames(connection, inserts, deletes)
+
+    monkeypatch.setattr(username_registry, 'RETRY_DELAY', 0.1)
+    engine = FailingStorage()
+    server = chat_server.Server('127.0.0.1', 1234, storage_engine=engine)
+    server.timers = timer_wheel.TimerWheel(tick=0.05, now=time.monotonic())
+    try:
+        server.create_username_database()
+        s1 = set_and_send_username('test_user')
+        pump_for(server, 1.0)
+        assert 2 <= engine.attempts <= 6
+        assert server.username_registry.failures == engine.attempts
+
+        engine.failing = False
+        deadline = time.monotonic() + 5
+        while 'test_user' not in engine.usernames and time.monotonic() < deadline:
+            server.run_once(timeout=0.05)
+        assert engine.usernames == {'test_user'}
+        assert server.username_registry.failures == 0
+
+        s1.close()
+    finally:
+        server.close()
+
+
+"""This tests a v2 client negotiating the binary protocol next to a v1 client: it learns
+the v1 user's id from the roster and gets that user's messages tagged with it."""
+def test_v2_negotiation_alongside_v1(set_up_server):
+    def read_v2_frame(s):
+        decoder = protocol.V2FrameDecoder()
+        while True:
+            frame = decoder.next_frame()
+            if frame is not None:
+                return frame
+            decoder.receive_from(s)
+
+    s1 = set_and_send_username('test_user')
+    pump(set_up_server)
+    assert s1.recv(1024).endswith(b'Username assigned to you')
+
+    s2 = socket.create_connection(('127.0.0.1', 1234))
+    s2.send(protocol.encode_hello() + protocol.encode_v2(protocol.USERNAME, b'test_user2'))
+    pump(set_up_server)
+    decoder = protocol.V2FrameDecoder()
+    decoder.feed(s2.recv(4096))
+    hello, accepted, roster = list(decoder.frames())
+    assert protocol.decode_hello(hello) == (2, 0)
+    assert accepted['type'] == protocol.ACCEPTED
+    assert (roster['type'], roster['data']) == (protocol.USER_JOINED, b'test_user')
+
+    s1.send(protocol.encode_frame(b'sent_message'))
+    pump(set_up_server)
+    message = read_v2_frame(s2)
+
+    s1.close()
+    s2.close()
+
+    assert (message['type'], message['sender'], message['data']) == (protocol.MESSAGE, roster['sender'], b'sent_message')
+
+
+"""This tests malformed v2 handshakes: a HELLO without its features byte and a username that is
+not UTF-8 are each answered with REJECTED, and the server carries on with the next attempt."""
+def test_malformed_v2_handshake_rejected(set_up_server):
+    s = socket.create_connection(('127.0.0.1', 1234))
+    s.send(protocol.encode_v2(protocol.HELLO) + protocol.encode_v2(protocol.USERNAME, b'\xff\xfe'))
+    pump(set_up_server)
+    assert [frame['type'] for frame in v2_frames(s)] == [protocol.REJECTED, protocol.REJECTED]
+
+    s.send(protocol.encode_hello() + protocol.encode_v2(protocol.USERNAME, b'test_user'))
+    pump(set_up_server)
+    assert [frame['type'] for frame in v2_frames(s)] == [protocol.HELLO, protocol.ACCEPTED]
+    assert set(set_up_server.usernames) == {b'test_user'}
+
+    s.close()
+
+
+"""This tests two workers joined by the bus hub, in one process: a broadcast on one worker reaches
+clients of the other, a username held on one worker is refused on the other, and the hub frees the
+usernames of a worker that has died."""
+def test_workers_share_broadcasts_and_usernames(set_up_server, tmp_path):
+    hub = worker_bus.BusHub(str(tmp_path / 'bus.sock'))
+    running = threading.Event()
+    running.set()
+
+    def run_hub():
+        while running.is_set():
+            hub.run_once(timeout=0.05)
+
+    hub_thread = threading.Thread(target=run_hub)
+    hub_thread.start()
+    first = set_up_server
+    second = chat_server.Server('127.0.0.1', 1235, worker_id=1)
+
+    try:
+        first.attach_bus(worker_bus.BusClient(hub.path))
+        second.attach_bus(worker_bus.BusClient(hub.path))
+
+        alice = set_and_send_username('alice')
+        pump(first)
+        assert drain(alice).endswith(b'Username assigned to you')
+        pump(second)
+        assert b'alice' in second.remote_usernames
+
+        bob = socket.create_connection(('127.0.0.1', 1235))
+        bob.send(protocol.encode_frame(b'alice'))
+        pump(second)
+        assert drain(bob).endswith(chat_server.USERNAME_TAKEN_MESSAGE.encode('utf-8'))
+        bob.send(protocol.encode_frame(b'bob'))
+        pump(second)
+        assert drain(bob).endswith(b'Username assigned to you')
+
+        alice.send(protocol.encode_frame(b'hello from worker 0'))
+        pump(first)
+        pump(second)
+        assert drain(bob).endswith(b'alice' + protocol.encode_frame(b'hello from worker 0'))
+
+        """Worker 0 dies: the hub drops its links, frees alice and tells worker 1 she has gone"""
+        first.selector.unregister(first.bus.socket)
+        first.bus.close()
+        first.bus = None
+        pump(second)
+        assert b'alice' not in second.remote_usernames
+        carol = socket.create_connection(('127.0.0.1', 1235))
+        carol.send(protocol.encode_frame(b'alice'))
+        pump(second)
+        assert drain(carol).endswith(b'Username assigned to you')
+
+        alice.close()
+        bob.close()
+        carol.close()
+    finally:
+        second.close()
+        running.clear()
+        hub_thread.join()
+        hub.close()
+
+
+"""This tests write coalescing: frames queued for a client during one loop iteration go out in a
+single flush at its end, while a backlog of flush_size bytes is written straight away even with a
+flush delay pending."""
+def test_frames_coalesced_per_iteration(set_up_server, monkeypatch):
+    server = set_up_server
+    s1 = set_and_send_username('test_user')
+    s2 = set_and_send_username('test_user2')
+    pump(server)
+    drain(s1)
+    drain(s2)
+    receiver = server.usernames[b'test_user2']
+
+    flushes = []
+    flush_outbound = server.flush_outbound
+
+    def record_flush(connection):
+        flushes.append(connection)
+        flush_outbound(connection)
+
+    monkeypatch.setattr(server, 'flush_outbound', record_flush)
+    burst = b''.join(protocol.encode_frame(f'message{number}'.encode('utf-8')) for number in range(5))
+
+    s1.send(burst)
+    server.run_once(timeout=1)
+    assert flushes.count(receiver) == 1
+    assert drain(s2).count(b'message') == 5
+
+    """A long flush delay holds small frames back, but a backlog of flush_size is written at once"""
+    server.flush_delay = 10
+    flushes.clear()
+    s1.send(burst)
+    server.run_once(timeout=1)
+    assert flushes.count(receiver) == 0 and receiver in server.dirty
+
+    server.flush_size = 1
+    s1.send(burst)
+    server.run_once(timeout=1)
+    assert flushes.count(receiver) == 5
+    assert drain(s2).count(b'message') == 10
+
+    s1.close()
+    s2.close()
+
+
+"""This tests rooms: a v1 client that joins another room with /join stops getting lobby
+messages, and the username index tracks who is connected."""
+def test_rooms_limit_broadcasts(set_up_server):
+    s1 = set_and_send_username('test_user')
+    s2 = set_and_send_username('test_user2')
+    s3 = set_and_send_username('test_user3')
+    pump(set_up_server)
+    for s in (s1, s2, s3):
+        assert s.recv(1024).endswith(b'Username assigned to you')
+
+    assert set(set_up_server.usernames) == {b'test_user', b'test_user2', b'test_user3'}
+    assert len(set_up_server.rooms[chat_server.DEFAULT_ROOM]) == 3
+
+    s3.send(protocol.encode_frame(b'/join games'))
+    pump(set_up_server)
+    assert s3.recv(1024).endswith(b'You are now in room games')
+    assert len(set_up_server.rooms[chat_server.DEFAULT_ROOM]) == 2
+
+    s1.send(protocol.encode_frame(b'sent_message'))
+    pump(set_up_server)
+    assert s2.recv(1024).endswith(b'sent_message')
+    s3.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        s3.recv(1024)
+
+    s3.close()
+    pump(set_up_server)
+    assert 'games' not in set_up_server.rooms
+    assert b'test_user3' not in set_up_server.usernames
+
+    s1.send(protocol.encode_frame(b'/join \xff'))
+    pump(set_up_server)
+    assert b'room names should be UTF-8' in drain(s1)
+    assert set_up_server.usernames[b'test_user'].room == chat_server.DEFAULT_ROOM
+
+    s1.close()
+    s2.close()
+
+
+"""This tests history: a client that logs in after messages were sent gets them replayed,
+and older messages can be read back by id from the segment files."""
+def test_history_replayed_on_join(set_up_server, tmp_path):
+    set_up_server.history = history_store.HistoryStore(str(tmp_path), recent=2, segment_entries=2)
+
+    s1 = set_and_send_username('test_user')
+    pump(set_up_server)
+    assert s1.recv(1024).endswith(b'Username assigned to you')
+
+    for number in range(3):
+        s1.send(protocol.encode_frame(f'message{number}'.encode('utf-8')))
+    pump(set_up_server)
+
+    s2 = set_and_send_username('test_user2')
+    pump(set_up_server)
+    decoder = protocol.FrameDecoder()
+    frames = []
+    while len(frames) < 5:
+        decoder.receive_from(s2)
+        frames.extend(frame['data'] for frame in decoder.frames())
+
+    s1.close()
+    s2.close()
+
+    assert frames == [b'Username assigned to you', b'test_user', b'message1', b'test_user', b'message2']
+
+    older = set_up_server.history.read_range(chat_server.DEFAULT_ROOM, 1, 2, 2)
+    decoder = protocol.V2FrameDecoder()
+    decoder.feed(b''.join(older))
+    assert [history_store.decode_history(frame) for frame in decoder.frames()] == [
+        (1, b'test_user', b'message0'), (2, b'test_user', b'message1')
+    ]
+
+    """Reading a room that never had a message leaves nothing on disk"""
+    assert set_up_server.history.recent('quiet', 1) == []
+    assert set_up_server.history.read_range('quiet', 1, 10, 2) == []
+    assert not (tmp_path / 'quiet'.encode('utf-8').hex()).exists()
+
+
+"""This tests log sampling: one event in every sample_every is logged, at most max_per_second of
+them in each second, and everything skipped is counted."""
+def test_log_sampler(monkeypatch):
+    sampler = logger.Sampler(sample_every=3)
+    assert [sampler.allow() for _ in range(9)] == [False, False, True] * 3
+    assert sampler.suppressed == 6
+
+    now = [100.0]
+    monkeypatch.setattr(logger.time, 'monotonic', lambda: now[0])
+    sampler = logger.Sampler(max_per_second=2)
+    assert [sampler.allow() for _ in range(4)] == [True, True, False, False]
+    now[0] = 101.5
+    assert [sampler.allow() for _ in range(3)] == [True, True, False]
+    assert sampler.suppressed == 3
+
+    assert str(logger.LazyText(b'caf\xc3\xa9 \xff')) == 'caf\xe9 \ufffd'
+
+
+"""This tests queue mode logging: records put on the queue by the logging thread are written to
+the log file by the listener thread once close() has drained the queue."""
+def test_queued_logging_reaches_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queued = logger.Logger('queued_logging_test', queued=True)
+    queued.initialise_logging()
+
+    for number in range(100):
+        queued.logger.info(
+            'Received message from %s: %s', logger.LazyText(b'test_user'), logger.LazyText(b'message%d' % number)
+        )
+    queued.close()
+
+    log_files = list((tmp_path / 'Logs').glob('queued_logging_test *.log'))
+    assert len(log_files) == 1
+    written = log_files[0].read_text()
+    assert written.count('Received message from test_user') == 100
+    assert 'message99' in written
+    assert queued.listener is None
+
+
+"""This tests the admin endpoint: a scrape after a broadcast reports the counters and
+histograms in Prometheus text format."""
+def test_admin_metrics(set_up_server, tmp_path):
+    admin_path = str(tmp_path / 'admin.sock')
+    set_up_server.attach_admin(admin_path)
+
+    s1 = set_and_send_username('test_user')
+    s2 = set_and_send_username('test_user2')
+    pump(set_up_server)
+    s1.send(protocol.encode_frame(b'sent_message'))
+    pump(set_up_server)
+
+    response = admin_request(set_up_server, admin_path, '/metrics')
+    s1.close()
+    s2.close()
+
+    assert response.startswith(b'HTTP/1.0 200 OK')
+    assert b'chat_accepts_total 2\n' in response
+    assert b'chat_messages_received_total 1\n' in response
+    assert b'chat_messages_sent_total 1\n' in response
+    assert b'chat_fanout_recipients_count 1\n' in response
+    assert b'chat_broadcast_latency_seconds_count 1\n' in response
+
+    """Counters nothing has touched yet are reported too"""
+    for counter in chat_server.COUNTERS:
+        assert f'chat_{counter}_total '.encode('utf-8') in response
+    assert b'chat_messages_rate_limited_total 0\n' in response
+    assert b'chat_reads_paused_total 0\n' in response
+
+
+"""This tests that a large admin reply to a peer that is not reading never blocks the event loop:
+the rest of the reply waits for write readiness and is written as the peer reads it."""
+def test_admin_reply_does_not_block(set_up_server, tmp_path):
+    admin_path = str(tmp_path / 'admin.sock')
+    set_up_server.attach_admin(admin_path)
+    body = 'x' * (4 * 1024 * 1024)
+    set_up_server.admin.routes['/large'] = lambda: body
+
+    admin = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    admin.connect(admin_path)
+    admin.send(b'large\n')
+
+    started = time.monotonic()
+    pump(set_up_server)
+    assert time.monotonic() - started < 1.0
+    assert len(set_up_server.admin.replies) == 1
+
+    received = bytearray()
+    admin.setblocking(False)
+    deadline = time.monotonic() + 5
+
+    while time.monotonic() < deadline:
+        set_up_server.run_once(timeout=0.01)
+        try:
+            data = admin.recv(1024 * 1024)
+        except BlockingIOError:
+            continue
+        if not data:
+            break
+        received += data
+
+    admin.close()
+    assert received.decode('utf-8') == body
+    assert set_up_server.admin.replies == {}
+
+
+"""This tests the headless client core: two clients log in through their I/O loops and
+one receives the other's message through the callback."""
+def test_client_core_round_trip(set_up_server):
+    events = []
+
+    def pump_until(condition):
+        for _ in range(100):
+            set_up_server.run_once(timeout=0.02)
+            if condition():
+                return
+
+    clients = [
+        client_core.ChatClient(
+            '127.0.0.1', 1234,
+            on_message=lambda sender, text: events.append(('message', sender, text)),
+            on_username_accepted=lambda username: events.append(('accepted', username))
+        )
+        for _ in range(2)
+    ]
+    for number, client in enumerate(clients):
+        client.connect()
+        client.start()
+        client.send_username(f'test_user{number}')
+
+    pump_until(lambda: len(events) == 2)
+    clients[0].send_message('sent_message')
+    pump_until(lambda: len(events) == 3)
+
+    for client in clients:
+        client.close()
+
+    assert sorted(events[:2]) == [('accepted', 'test_user0'), ('accepted', 'test_user1')]
+    assert events[2] == ('message', 'test_user0', 'sent_message')
+
+
+"""This tests the client core speaking v2: it negotiates compression and gets a large message
+inflated, names senders from the roster, and its chat commands travel as v2 frames."""
+def test_client_core_v2_with_compression(set_up_server):
+    events = []
+    flags = []
+
+    def pump_until(condition):
+        for _ in range(100):
+            set_up_server.run_once(timeout=0.02)
+            if condition():
+                return
+
+    v2 = client_core.ChatClient(
+        '127.0.0.1', 1234, version=2,
+        on_message=lambda sender, text: events.append((sender, text)),
+        on_username_accepted=lambda username: events.append(('accepted', username))
+    )
+    v1 = client_core.ChatClient(
+        '127.0.0.1', 1234,
+        on_message=lambda sender, text: events.append(('v1', sender, text)),
+        on_username_accepted=lambda username: events.append(('accepted', username))
+    )
+    handle_v2_frame = v2.handle_v2_frame
+    v2.handle_v2_frame = lambda frame: (flags.append(frame['flags']), handle_v2_frame(frame))
+
+    for client, username in ((v2, 'test_user0'), (v1, 'test_user1')):
+        client.connect()
+        client.start()
+        client.send_username(username)
+        pump_until(lambda: ('accepted', username) in events)
+
+    large = 'compress me ' * 200
+    v1.send_message(large)
+    pump_until(lambda: ('test_user1', large) in events)
+    assert v2.accepted_features == protocol.FEATURE_COMPRESSION
+    assert protocol.FLAG_COMPRESSED in flags
+
+    v2.send_message('/msg test_user1 hi')
+    v2.send_message('/who')
+    pump_until(lambda: len(events) == 5)
+
+    v1.close()
+    v2.close()
+
+    assert ('v1', 'test_user0', '(direct) hi') in events
+    assert (client_core.CHATBOT_NAME, 'Online: test_user0, test_user1') in events
+
+
+"""This tests negotiated compression: a v2 client that offers it gets large messages as
+compressed frames, which the v2 decoder inflates back to the original bytes."""
+def test_v2_compression_negotiated(set_up_server):
+    s1 = set_and_send_username('test_user')
+    s2 = socket.create_connection(('127.0.0.1', 1234))
+    s2.send(protocol.encode_hello(features=protocol.FEATURE_COMPRESSION)
+            + protocol.encode_v2(protocol.USERNAME, b'test_user2'))
+    pump(set_up_server)
+    s1.recv(1024)
+
+    decoder = protocol.V2FrameDecoder()
+    frames = []
+    while len(frames) < 3:
+        decoder.receive_from(s2)
+        frames.extend(decoder.frames())
+    assert protocol.decode_hello(frames[0]) == (2, protocol.FEATURE_COMPRESSION)
+
+    pasted = b'2024-01-01 12:00:00 | INFO | worker: request handled in 3ms\n' * 100
+    s1.send(protocol.encode_frame(pasted))
+    pump(set_up_server)
+    while len(decoder) < protocol.V2_HEADER_LENGTH:
+        decoder.receive_from(s2)
+    compressed_length = protocol.V2_HEADER.unpack_from(decoder.buffer, decoder.offset)[0]
+    message = None
+    while message is None:
+        message = decoder.next_frame()
+        if message is None:
+            decoder.receive_from(s2)
+
+    s1.close()
+    s2.close()
+
+    assert message['flags'] & protocol.FLAG_COMPRESSED
+    assert compressed_length < len(pasted) // 10
+    assert message['data'] == pasted
+
+
+"""This tests timeouts: a connection that never sends a username is dropped after the
+handshake timeout, and a v2 client that ignores a PING is dropped after the idle timeout
+with its username released."""
+def test_handshake_and_idle_timeouts(set_up_server):
+    server = set_up_server
+    server.timers = timer_wheel.TimerWheel(tick=0.05, now=time.monotonic())
+    server.handshake_timeout = 0.2
+    server.idle_timeout = 0.6
+    server.ping_interval = 0.2
+
+    silent = socket.create_connection(('127.0.0.1', 1234))
+    v2 = socket.create_connection(('127.0.0.1', 1234))
+    v2.send(protocol.encode_hello() + protocol.encode_v2(protocol.USERNAME, b'test_user'))
+    pump_for(server, 0.4)
+
+    assert silent.recv(1024) == b''
+    assert server.counters['handshake_timeouts'] == 1
+    assert len(server.usernames) == 1
+
+    decoder = protocol.V2FrameDecoder()
+    decoder.feed(v2.recv(4096))
+    assert [frame['type'] for frame in decoder.frames()] == [protocol.HELLO, protocol.ACCEPTED, protocol.PING]
+
+    pump_for(server, 0.6)
+    assert v2.recv(1024) == b''
+    assert server.counters['idle_timeouts'] == 1
+    assert not server.presence and not server.connections and not server.usernames and not server.rooms
+    assert 'test_user' not in server.username_registry
+    assert len(server.timers) == 0
+
+    silent.close()
+    v2.close()
+
+
+"""This tests admission control: a client flooding messages has the excess dropped with one
+notice from the chatbot, and a connection over max_connections is told the server is full."""
+def test_rate_limit_and_max_connections(set_up_server):
+    server = set_up_server
+    server.message_rate = 0.001
+    server.message_burst = 3
+    server.max_connections = 2
+
+    s1 = set_and_send_username('test_user')
+    s2 = set_and_send_username('test_user2')
+    pump(server)
+    drain(s1)
+    drain(s2)
+
+    s1.send(b''.join(protocol.encode_frame(f'flood {i}'.encode('utf-8')) for i in range(10)))
+    pump(server)
+
+    assert drain(s2).count(b'flood') == 3
+    assert drain(s1).count(chat_server.RATE_LIMITED_MESSAGE.encode('utf-8')) == 1
+    assert server.counters['messages_rate_limited'] == 7
+
+    s3 = socket.create_connection(('127.0.0.1', 1234))
+    pump(server)
+    assert chat_server.SERVER_FULL_MESSAGE.encode('utf-8') in drain(s3)
+    assert server.counters['connections_rejected'] == 1
+    assert len(server.connections) == 2
+
+    s1.close()
+    s2.close()
+    s3.close()
+
+
+"""This tests a zero-downtime restart: a second server takes over the listener and the logged in
+clients of the first through the handoff socket, and the clients carry on chatting unaware."""
+def test_handoff_to_replacement_server(set_up_server, tmp_path):
+    old_server = set_up_server
+    path = str(tmp_path / 'handoff.sock')
+    old_server.attach_handoff(path)
+
+    s1 = set_and_send_username('test_user')
+    s2 = socket.create_connection(('127.0.0.1', 1234))
+    s2.send(protocol.encode_hello() + protocol.encode_v2(protocol.USERNAME, b'test_user2'))
+    pump(old_server)
+    s1.recv(1024)
+    decoder = protocol.V2FrameDecoder()
+    frames = []
+    while len(frames) < 2:
+        decoder.receive_from(s2)
+        frames.extend(decoder.frames())
+
+    """Half a frame is in flight when the handoff happens"""
+    frame = protocol.encode_frame(b'still here')
+    s1.send(frame[:10])
+    old_server.run_once(timeout=0.05)
+
+    """s2's reads are paused by its byte bucket, so its socket is not registered with the selector"""
+    paused = old_server.usernames[b'test_user2']
+    paused.paused = True
+    old_server.watch(paused)
+    assert paused.socket in old_server.unwatched
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(handoff.take_over(path)))
+    thread.start()
+    while not old_server.handed_off:
+        old_server.run_once(timeout=0.05)
+    thread.join()
+
+    state, fds = result[0]
+    new_server = chat_server.Server('127.0.0.1', 1234, listen_fd=fds[state['listener']])
+    try:
+        new_server.adopt(state, fds)
+        assert not old_server.connections
+        assert set(new_server.usernames) == {b'test_user', b'test_user2'}
+        assert 'test_user' in new_server.username_registry
+
+        s1.send(frame[10:])
+        s3 = set_and_send_username('test_user3')
+        pump(new_server)
+
+        message = None
+        while message is None:
+            decoder.receive_from(s2)
+            message = next((frame for frame in decoder.frames() if frame['type'] == protocol.MESSAGE), None)
+        assert message['data'] == b'still here'
+        assert len(new_server.usernames) == 3
+
+        s1.close()
+        s2.close()
+        s3.close()
+    finally:
+        new_server.close()
+
+
+"""This tests that Connection stays slotted through its whole life: a login, a read pause and a
+handoff set every attribute it has, and an attribute missing from __slots__ would give it a __dict__
+or fail outright."""
+def test_connection_has_no_instance_dict(set_up_server, tmp_path):
+    old_server = set_up_server
+    old_server.byte_rate = 100
+    old_server.byte_burst = 100
+    old_server.message_rate = 0.001
+    old_server.message_burst = 1
+    path = str(tmp_path / 'handoff.sock')
+    old_server.attach_handoff(path)
+
+    client = socket.create_connection(('127.0.0.1', 1234))
+    client.send(protocol.encode_hello(features=protocol.FEATURE_COMPRESSION)
+                + protocol.encode_v2(protocol.USERNAME, b'test_user'))
+    pump(old_server)
+    v2_frames(client)
+
+    client.send(protocol.encode_v2(protocol.MESSAGE, b'x' * 200) + protocol.encode_v2(protocol.MESSAGE, b'y'))
+    pump(old_server)
+    connection = old_server.usernames[b'test_user']
+    assert connection.paused and connection.socket in old_server.unwatched
+    assert not hasattr(connection, '__dict__')
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(handoff.take_over(path)))
+    thread.start()
+    while not old_server.handed_off:
+        old_server.run_once(timeout=0.05)
+    thread.join()
+
+    state, fds = result[0]
+    new_server = chat_server.Server('127.0.0.1', 1234, listen_fd=fds[state['listener']])
+    try:
+        new_server.adopt(state, fds)
+        adopted = new_server.usernames[b'test_user']
+        assert adopted.version == 2 and adopted.room == chat_server.DEFAULT_ROOM
+        assert not hasattr(adopted, '__dict__')
+        assert not hasattr(chat_server.Connection(None, None), '__dict__')
+        client.close()
+    finally:
+        new_server.close()
+
+
+"""This tests a handoff that fails part way: the replacement hangs up before taking anything, and the
+running server reopens what it shut down and carries on serving, ready for another replacement."""
+def test_failed_handoff_keeps_serving(set_up_server, tmp_path):
+    server = set_up_server
+    path = str(tmp_path / 'handoff.sock')
+    server.attach_handoff(path)
+    server.create_username_database()
+
+    s1 = set_and_send_username('test_user')
+    pump(server)
+    assert drain(s1).endswith(b'Username assigned to you')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as successor:
+        successor.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        successor.connect(path)
+    pump(server)
+
+    assert not server.handed_off
+    assert server.handoff is not None and server.db_pool is not None
+    s2 = set_and_send_username('test_user2')
+    pump(server)
+    assert drain(s2).endswith(b'Username assigned to you')
+    s1.send(protocol.encode_frame(b'still here'))
+    pump(server)
+    assert drain(s2).endswith(b'still here')
+
+    s1.close()
+    s2.close()
+
+
+"""This tests the SQLite storage engine: the schema is adopted with the given usernames kept,
+and a login reaches the table through the write-behind pool without any external service."""
+def test_sqlite_storage_engine(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    server = chat_server.Server('127.0.0.1', 1234, storage_engine=storage.SQLiteStorage(path))
+    try:
+        server.create_username_database(['kept_user'])
+        server.create_username_database(['kept_user'])
+        s1 = set_and_send_username('test_user')
+
+        def stored():
+            with sqlite3.connect(path) as connection:
+                return {row[0] for row in connection.execute('SELECT username FROM usernames')}
+
+        deadline = time.monotonic() + 5
+        while stored() != {'kept_user', 'test_user'} and time.monotonic() < deadline:
+            server.run_once(timeout=0.05)
+        assert stored() == {'kept_user', 'test_user'}
+        assert sqlite3.connect(path).execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+        s1.close()
+    finally:
+        server.close()
+
+
+"""This tests that an engine missing one of the Storage operations fails when it is made, not
+when the pool first calls the missing operation."""
+def test_storage_engine_must_implement_every_operation():
+    class Incomplete(storage.Storage):
+        def prepare(self, usernames=()):
+            pass
+
+        def connect(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+    with pytest.raises(TypeError):
+        storage.Storage()
+    assert all(isinstance(storage.create(engine, ':memory:'), storage.Storage) for engine in ('memory', 'sqlite'))
+
+
+"""This tests the Postgres engine's first start: the database is only created when the server
+reports it missing, and any other connection error, such as a refused password, is raised."""
+def test_postgres_prepare_creates_only_a_missing_database(monkeypatch):
+    class OperationalError(Exception):
+        pass
+
+    def refuse(**settings):
+        raise OperationalError('FATAL:  password authentication failed for user "rizwan"')
+
+    monkeypatch.setattr(storage, 'psycopg2', types.SimpleNamespace(OperationalError=OperationalError, connect=refuse))
+    engine = storage.PostgresStorage()
+    created = []
+    monkeypatch.setattr(engine, 'create_database', lambda: created.append(engine.dbname))
+
+    with pytest.raises(OperationalError):
+        engine.prepare()
+    assert created == []
+
+    def missing(**settings):
+        raise OperationalError(f'FATAL:  database "{settings["dbname"]}" does not exist')
+
+    monkeypatch.setattr(storage.psycopg2, 'connect', missing)
+    with pytest.raises(OperationalError):
+        engine.prepare()
+    assert created == [storage.DBNAME]
+
+    """Once connected, the table is created or migrated to the current column type and reset"""
+    executed = []
+
+    class Cursor:
+        def execute(self, statement, *args):
+            executed.append(statement)
+
+        def executemany(self, statement, rows):
+            executed.extend(statement for _ in rows)
+
+        def close(self):
+            pass
+
+    class Connection:
+        def cursor(self):
+            return Cursor()
+
+        def commit(self):
+            executed.append('COMMIT')
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(storage.psycopg2, 'connect', lambda **settings: Connection())
+    engine.prepare(['test_user'])
+    assert executed == [
+        'CREATE TABLE IF NOT EXISTS usernames(username varchar(32))',
+        'DELETE FROM usernames',
+        'ALTER TABLE usernames ALTER COLUMN username TYPE varchar(32)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS usernames_username_key ON usernames (username)',
+        'INSERT INTO usernames (username) VALUES (%(username)s)',
+        'COMMIT',
+    ]
+
+
+"""This tests that DESCRIPTORS_PER_ROOM is what an open room really costs, since the connection
+budget is sized from it: the count of open descriptors is taken from /proc/self/fd."""
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc/self/fd')
+def test_history_descriptors_per_room(tmp_path):
+    def open_descriptors():
+        return len(os.listdir('/proc/self/fd'))
+
+    history = history_store.HistoryStore(str(tmp_path), max_open_rooms=2)
+    before = open_descriptors()
+
+    history.append('first', 1, b'test_user', b'hello')
+    history.append('second', 1, b'test_user', b'hello')
+    assert open_descriptors() - before == 2 * history_store.DESCRIPTORS_PER_ROOM
+
+    """A third room closes the least recently used one's files"""
+    history.append('third', 1, b'test_user', b'hello')
+    assert open_descriptors() - before == 2 * history_store.DESCRIPTORS_PER_ROOM
+
+    history.close()
+    assert open_descriptors() == before
+
+
+"""This tests direct messages and presence: a direct message reaches only its recipient, in
+either protocol version, an unknown recipient is reported back, and who is online can be asked."""
+def test_direct_messages_and_who(set_up_server):
+    server = set_up_server
+
+    alice = set_and_send_username('alice')
+    carol = set_and_send_username('carol')
+    bob = socket.create_connection(('127.0.0.1', 1234))
+    bob.send(protocol.encode_hello() + protocol.encode_v2(protocol.USERNAME, b'bob'))
+    pump(server)
+    drain(alice)
+    drain(carol)
+    v2_frames(bob)
+
+    alice.send(protocol.encode_frame(b'/msg bob hi bob') + protocol.encode_frame(b'/msg nobody hello?'))
+    bob.send(protocol.encode_direct(b'alice', b'hi alice'))
+    pump(server)
+
+    direct = [frame for frame in v2_frames(bob) if frame['type'] == protocol.DIRECT]
+    assert [frame['data'] for frame in direct] == [b'hi bob']
+    assert direct[0]['sender'] == server.usernames[b'alice'].client_id
+    received = drain(alice)
+    assert b'bob' + protocol.encode_frame(chat_server.DIRECT_PREFIX + b'hi alice') in received
+    assert b'nobody is not online' in received
+    assert drain(carol) == b''
+
+    alice.send(protocol.encode_frame(b'/who'))
+    bob.send(protocol.encode_v2(protocol.WHO))
+    pump(server)
+    assert b'Online: alice, bob, carol' in drain(alice)
+    roster = v2_frames(bob)
+    assert sorted(frame['data'] for frame in roster[:-1]) == [b'alice', b'carol']
+    assert roster[-1]['type'] == protocol.WHO
+    assert server.counters['direct_messages'] == 3
+    assert server.counters['direct_undeliverable'] == 1
+
+    alice.close()
+    bob.close()
+    carol.close()
+
+
+"""This tests the diagnostics hooks through the admin endpoint: profiling, phase timing and
+allocation snapshots each write their report into the log directory once stopped."""
+def test_diagnostics_write_reports(set_up_server, tmp_path):
+    server = set_up_server
+    server.diagnostics.directory = str(tmp_path / 'diagnostics')
+    admin_path = str(tmp_path / 'admin.sock')
+    server.attach_admin(admin_path)
+
+    def request(path):
+        return admin_request(server, admin_path, path)
+
+    assert b'profiling started' in request('/profile')
+    assert b'phase timing started' in request('/phases')
+    assert b'tracemalloc started' in request('/tracemalloc')
+
+    s1 = set_and_send_username('test_user')
+    s2 = set_and_send_username('test_user2')
+    pump(server)
+    s1.send(protocol.encode_frame(b'sent_message'))
+    pump(server)
+
+    assert b'wrote' in request('/tracemalloc')
+    assert b'tracemalloc stopped' in request('/tracemalloc-stop')
+    assert b'phase timing stopped' in request('/phases')
+    assert b'profiling stopped' in request('/profile')
+    s1.close()
+    s2.close()
+
+    reports = {path.name.split('-')[4]: path for path in (tmp_path / 'diagnostics').glob('*.txt')}
+    assert set(reports) == {'profile', 'phases', 'tracemalloc'}
+    assert len(list((tmp_path / 'diagnostics').glob('*-profile-*.prof'))) == 1
+    phases = reports['phases'].read_text()
+    for phase in ('select', 'read', 'broadcast', 'db'):
+        assert f'\n{phase} ' in phases
+    assert server.phases is chat_server.diagnostics.NO_PHASE_TIMER
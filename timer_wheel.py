@@ -0,0 +1,51 @@
+class TimerWheel:
+    """Hashed timer wheel: deadlines are hashed by tick into a fixed ring of slots.
+
+    schedule() and cancel() are O(1) whatever the number of timers. expire() only visits the slots
+    the clock has moved through; a timer more than one rotation away just stays in its slot until a
+    later pass finds it due. Each item has at most one timer, so scheduling an item again replaces its
+    previous deadline.
+    """
+
+    def __init__(self, tick=0.5, slots=512, now=0.0):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.current = int(now / tick)
+        self.scheduled = {}
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def schedule(self, item, deadline):
+        self.cancel(item)
+        """A deadline already in the past lands in the current slot, so the next expire() finds it"""
+        slot = max(int(deadline / self.tick), self.current) % len(self.slots)
+        self.slots[slot][item] = deadline
+        self.scheduled[item] = slot
+
+    def cancel(self, item):
+        slot = self.scheduled.pop(item, None)
+
+        if slot is not None:
+            del self.slots[slot][item]
+
+    def expire(self, now):
+        """Removes and returns the items whose deadline is at or before now"""
+        now_tick = int(now / self.tick)
+        expired = []
+
+        for tick in range(self.current, min(now_tick, self.current + len(self.slots) - 1) + 1):
+            slot = self.slots[tick % len(self.slots)]
+
+            for item, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[item]
+                    del self.scheduled[item]
+                    expired.append(item)
+
+        """The current tick is visited again next time: timers later in this tick are not due yet"""
+        self.current = max(self.current, now_tick)
+        return expired
+
+    def time_to_next_tick(self, now):
+        return self.tick - now % self.tick
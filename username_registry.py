@@ -0,0 +1,78 @@
+"""Seconds before a failed batch is retried, doubling with each failure in a row up to the maximum"""
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+
+class UsernameRegistry:
+    """Usernames of connected clients, held in memory as the source of truth for uniqueness.
+
+    The database is only written behind the event loop: every reserve/release records the wanted end
+    state for that name, so a login followed by a logout before the next flush costs no DB work at all.
+    At most one batch of coalesced inserts and deletes is in flight; whatever changes meanwhile waits
+    for the next batch. After a failed batch nothing more is written until retry() is called, which
+    the server schedules after retry_delay(). Only used from the event loop thread.
+    """
+
+    def __init__(self):
+        self.active = set()
+        self.pending = {}
+        self.in_flight = None
+        self.failures = 0
+        self.backing_off = False
+
+    def __contains__(self, username):
+        return username in self.active
+
+    def __len__(self):
+        return len(self.active)
+
+    def reserve(self, username):
+        """Returns False if the username is already in use"""
+        if username in self.active:
+            return False
+
+        self.active.add(username)
+        self.pending[username] = True
+        return True
+
+    def adopt(self, username):
+        """Marks a username in use that the database already holds, such as one taken over from a
+        previous server process, without writing it again"""
+        self.active.add(username)
+
+    def release(self, username):
+        if username not in self.active:
+            return
+
+        self.active.discard(username)
+        self.pending[username] = False
+
+    def take_batch(self):
+        """Returns (inserts, deletes) to persist, or None if nothing is due or a batch is still in flight"""
+        if self.in_flight is not None or self.backing_off or not self.pending:
+            return None
+
+        self.in_flight, self.pending = self.pending, {}
+        inserts = [username for username, present in self.in_flight.items() if present]
+        deletes = [username for username, present in self.in_flight.items() if not present]
+        return inserts, deletes
+
+    def batch_done(self, succeeded):
+        """On failure the batch goes back for the next attempt without overriding anything marked since,
+        and writes stop until retry()"""
+        if succeeded:
+            self.failures = 0
+        else:
+            for username, present in self.in_flight.items():
+                self.pending.setdefault(username, present)
+
+            self.failures += 1
+            self.backing_off = True
+
+        self.in_flight = None
+
+    def retry_delay(self):
+        return min(RETRY_DELAY * 2 ** (self.failures - 1), MAX_RETRY_DELAY)
+
+    def retry(self):
+        self.backing_off = False
@@ -0,0 +1,275 @@
+import os
+import selectors
+import socket
+import struct
+import tempfile
+
+import logger
+import outbound_queue
+import protocol
+
+"""Bus messages are ordinary header framed payloads whose first byte says what they carry"""
+HELLO_BROADCAST = b'b'
+HELLO_REGISTRY = b'r'
+BROADCAST = b'B'
+JOINED = b'J'
+LEFT = b'L'
+RESERVE = b'R'
+RELEASE = b'U'
+RESERVED = b'Y'
+TAKEN = b'N'
+DIRECT = b'D'
+
+"""Events relayed unchanged to every other worker"""
+RELAYED = (BROADCAST, JOINED, LEFT, DIRECT)
+
+"""BROADCAST body: sender id, username and room lengths, then the username, room and message"""
+BUS_MESSAGE = struct.Struct('!IHH')
+"""DIRECT body: laid out like BROADCAST, with the recipient's username where the room goes"""
+"""JOINED/LEFT body: client id, followed by the username for JOINED"""
+BUS_PRESENCE = struct.Struct('!I')
+
+BUS_HIGH_WATER_MARK = 64 * 1024 * 1024
+BUS_MAX_FRAME_LENGTH = 4 * protocol.MAX_FRAME_LENGTH
+
+
+def encode_message(sender_id, username, room, data):
+    room = room.encode('utf-8')
+    return BUS_MESSAGE.pack(sender_id, len(username), len(room)) + username + room + data
+
+
+def decode_message(body):
+    """Returns (sender_id, username, room, data)"""
+    sender_id, username_length, room_length = BUS_MESSAGE.unpack_from(body)
+    username_end = BUS_MESSAGE.size + username_length
+    room_end = username_end + room_length
+    return sender_id, body[BUS_MESSAGE.size:username_end], body[username_end:room_end].decode('utf-8'), body[room_end:]
+
+
+def encode_presence(client_id, username=b''):
+    return BUS_PRESENCE.pack(client_id) + username
+
+
+def decode_presence(body):
+    """Returns (client_id, username); username is empty for LEFT"""
+    return BUS_PRESENCE.unpack_from(body)[0], body[BUS_PRESENCE.size:]
+
+
+def default_bus_path():
+    return os.path.join(tempfile.gettempdir(), f'chat-server-bus-{os.getpid()}.sock')
+
+
+class BusLink:
+    """One worker connection as seen by the hub"""
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.role = None
+        self.decoder = protocol.FrameDecoder(max_frame_length=BUS_MAX_FRAME_LENGTH)
+        self.outbound = outbound_queue.OutboundQueue(BUS_HIGH_WATER_MARK)
+        self.usernames = set()
+        self.joined = {}
+
+
+class BusHub:
+    """Runs in the parent of the worker processes. Relays every broadcast and join/leave from one worker
+    to all the others and owns the set of usernames in use, so uniqueness holds across workers. It also
+    remembers who is on each worker, to bring a new worker up to date and to announce a dead worker's
+    clients as gone."""
+
+    def __init__(self, path=None):
+        self.path = path or default_bus_path()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.links = {}
+        self.usernames = {}
+        self.instantiated_logger = logger.Logger(__name__)
+        self.instantiated_logger.initialise_logging()
+
+    def accept_link(self):
+        try:
+            link_socket, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+
+        link_socket.setblocking(False)
+        link = BusLink(link_socket)
+        self.links[link_socket] = link
+        self.selector.register(link_socket, selectors.EVENT_READ, link)
+
+    def close_link(self, link):
+        for username in link.usernames:
+            self.usernames.pop(username, None)
+
+        self.links.pop(link.socket, None)
+        self.selector.unregister(link.socket)
+        link.socket.close()
+
+        for client_id in link.joined:
+            self.relay(link, LEFT + encode_presence(client_id))
+
+    def relay(self, link, message):
+        for other in list(self.links.values()):
+            if other is not link and other.role == HELLO_BROADCAST:
+                self.send(other, message)
+
+    def send(self, link, message):
+        if link.socket not in self.links:
+            return
+
+        if not link.outbound.push(protocol.encode_frame(message)):
+            self.instantiated_logger.logger.info('Bus link is not draining - dropping message')
+            return
+
+        self.flush(link)
+
+    def flush(self, link):
+        try:
+            link.outbound.flush_to(link.socket)
+        except OSError:
+            self.close_link(link)
+            return
+
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if len(link.outbound) else selectors.EVENT_READ
+        self.selector.modify(link.socket, events, link)
+
+    def handle_message(self, link, message):
+        kind, body = message[:1], message[1:]
+
+        if kind == HELLO_REGISTRY:
+            link.role = kind
+
+        elif kind == HELLO_BROADCAST:
+            link.role = kind
+            for other in list(self.links.values()):
+                for joined_message in other.joined.values():
+                    self.send(link, joined_message)
+
+        elif kind in RELAYED:
+            if kind == JOINED:
+                link.joined[decode_presence(body)[0]] = message
+            elif kind == LEFT:
+                link.joined.pop(decode_presence(body)[0], None)
+
+            self.relay(link, message)
+
+        elif kind == RESERVE:
+            username = body.decode('utf-8')
+            if username in self.usernames:
+                self.send(link, TAKEN)
+            else:
+                self.usernames[username] = link
+                link.usernames.add(username)
+                self.send(link, RESERVED)
+
+        elif kind == RELEASE:
+            username = body.decode('utf-8')
+            if self.usernames.get(username) is link:
+                del self.usernames[username]
+                link.usernames.discard(username)
+
+    def handle_readable(self, link):
+        try:
+            if link.decoder.receive_from(link.socket) == 0:
+                self.close_link(link)
+                return
+
+            for frame in link.decoder.frames():
+                self.handle_message(link, frame['data'])
+
+        except BlockingIOError:
+            return
+
+        except (OSError, ValueError) as e:
+            self.instantiated_logger.logger.info(f'Bus link error: {str(e)}')
+            self.close_link(link)
+
+    def run_once(self, timeout=None):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept_link()
+                continue
+
+            if events & selectors.EVENT_WRITE:
+                self.flush(key.data)
+
+            if events & selectors.EVENT_READ and key.fileobj in self.links:
+                self.handle_readable(key.data)
+
+    def close(self):
+        """Closes the hub's sockets. Forked workers call this to drop their inherited copies"""
+        for link_socket in list(self.links):
+            link_socket.close()
+
+        self.links.clear()
+        self.selector.close()
+        self.listener.close()
+
+
+class BusClient:
+    """A worker's end of the bus.
+
+    The broadcast link is non-blocking and is registered with the worker's selector; it exposes
+    socket/outbound/decoder/paused like a Connection so the server flushes it the same way. Username
+    reservations use a second, blocking link so a reply can never interleave with broadcasts.
+    """
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.socket.sendall(protocol.encode_frame(HELLO_BROADCAST))
+        self.socket.setblocking(False)
+        self.decoder = protocol.FrameDecoder(max_frame_length=BUS_MAX_FRAME_LENGTH)
+        self.outbound = outbound_queue.OutboundQueue(BUS_HIGH_WATER_MARK)
+        self.paused = False
+
+        self.registry_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.registry_socket.connect(path)
+        self.registry_socket.sendall(protocol.encode_frame(HELLO_REGISTRY))
+        self.registry_decoder = protocol.FrameDecoder()
+
+    def publish(self, kind, body):
+        """Queues an event for the other workers. Returns False if the hub is not keeping up"""
+        return self.outbound.push(protocol.encode_frame(kind + body))
+
+    def received_messages(self):
+        """Reads from the broadcast link and returns the (kind, body) events other workers published,
+        or False if the hub has gone"""
+        try:
+            if self.decoder.receive_from(self.socket) == 0:
+                return False
+
+        except BlockingIOError:
+            return []
+
+        return [(frame['data'][:1], frame['data'][1:]) for frame in self.decoder.frames()]
+
+    def reserve(self, username):
+        """Asks the hub for the username. Returns True if no worker holds it.
+
+        Known limit: this is a blocking round trip on the worker's event loop, once per login attempt,
+        to a hub that serves every worker from one thread. Every client of the worker waits on it, so a
+        login storm across many workers is bounded by the hub's turnaround rather than by the workers"""
+        self.registry_socket.sendall(protocol.encode_frame(RESERVE + username.encode('utf-8')))
+
+        while True:
+            reply = self.registry_decoder.next_frame()
+            if reply is not None:
+                return reply['data'] == RESERVED
+
+            if self.registry_decoder.receive_from(self.registry_socket) == 0:
+                raise ConnectionError('bus hub closed')
+
+    def release(self, username):
+        self.registry_socket.sendall(protocol.encode_frame(RELEASE + username.encode('utf-8')))
+
+    def close(self):
+        self.socket.close()
+        self.registry_socket.close()